@@ -1,58 +1,155 @@
 #!/usr/bin/env python
 
-from os import walk, stat
-from os.path import join
+from os import stat, nice
+from select import select
+from sys import argv, exit
 from stat import *
 from time import time
 from logging import debug, info, warning, error, critical, exception
-from defs import DEFAULT_ARGS
-from compression import compressors
-from init import init
+from os.path import splitext, join, exists
+from defs import DEFAULT_ARGS, UNITS, INCOMPRESSIBLE
+from init import init, setting, configured_roots, home
+from rules import load_rules
+from retention import Policy, select as select_versions
+from pipeline import Pipeline
+from chunking import chunks
+from walker import Walker
+from inotify import Inotify, IN_Q_OVERFLOW, IN_ISDIR, IN_CREATE, IN_MOVED_TO
 from math import log
+from random import sample
+from multiprocessing import cpu_count
 
-from md5 import new as MD5
-hash_function = lambda data: MD5(data).digest()
 
-cache, storage = init()
+# Back-ups lock the cache, so garbage collection cannot run at the same time
+cache, storage = init(True, True, True)
 
 def no_compression(data, level = None):
     return data
 
-def apply_rules(path):
-    return DEFAULT_ARGS
+def rules_path():
+    '''Returns the path of the rules file, or None if there is none.'''
+    path = setting('backup', 'rules')
+    if not path and home and exists(join(home, '.backup', 'rules')):
+        path = join(home, '.backup', 'rules')
+    return path
 
+try:
+    rules = load_rules(rules_path())
+except (IOError, ValueError), e:
+    critical('Unable to read rules: %s', e)
+    exit(1)
 
-class UpdateScanner:
-
-    def store_block(self, hash, data, compress, level):
-
-        if cache.hasBlock(hash):
-            return
-
-        # Compress block data into 'cdata'
-        try:
-            compressor = compressors[compress]
-        except KeyError:
-            raise 'Unsupported compression method: ' + compress
+def apply_rules(path, isdir = False):
+    if isdir:
+        return rules.directory(path)
+    return rules.file(path)
 
-        if level: cdata = compressor.compress(data, level)
-        else:     cdata = compressor.compress(data)
-        if len(cdata) >= len(data):
-            # Compressed version is larger than uncompressed; store as is
-            debug('Reverting to uncompressed data')
-            compressor = compressors['none']
-            cdata      = compressor.compress(data)
 
-        # Store remotely
-        info( 'Storing data block with hash %s, size %d (compressed: %d)',
-              hash.encode('hex'), len(data), len(cdata) )
-        storage.setBlock(hash, compressor.cid, cdata)
+class UpdateScanner:
 
-        # Store in cache
-        cache.addBlock(hash)
+    def __init__(self):
+        self.pipeline = Pipeline( storage, self.block_stored,
+            setting('backup', 'compressors', 1),
+            setting('backup', 'uploaders', 4),
+            setting('backup', 'queue', 16),
+            setting('backup', 'hashers', cpu_count()),
+            cache.hasBlock )
+        self.changes = 0    # number of entries stored since the last commit
+
+    def block_stored(self, job):
+        # Called by the pipeline once a block has been stored remotely
+        cache.addBlock(job.hash, job.location, job.csize)
+
+    def store_entry(self, path, version, metadata, blocks, st):
+        # Store updated file remotely
+        storage.setEntry(path, version, metadata, blocks)
 
+        # Update cache
+        for hash in blocks:
+            cache.incBlockRef(hash)
+        cache.setEntry(path, version, metadata, blocks)
+        cache.setInode( st[ST_DEV], st[ST_INO], st[ST_SIZE], st[ST_MTIME],
+                        path, version )
+        self.changes += 1
+
+    def find_moved(self, path, st, args):
+        '''Returns a stored entry for the same file (identified by device,
+           inode, size and modification time) that was stored under a
+           different path, or None if there is no such entry.'''
+        identity = cache.getInode(st[ST_DEV], st[ST_INO])
+        if not identity:
+            return None
+        size, mtime, old_path, version = identity
+        if size <> st[ST_SIZE] or mtime <> st[ST_MTIME] or old_path == path:
+            return None
+        entry = cache.getEntry(old_path, version)
+        if not entry:
+            return None
+        if args['verify_moved'] and not self.verify_blocks(path, entry, args['verify_moved']):
+            warning( 'File "%s" matches "%s" version %d, but failed verification',
+                     path, old_path, version )
+            return None
+        info( 'File "%s" was moved from "%s"; reusing blocks of version %d',
+              path, old_path, version )
+        return entry
+
+    def verify_blocks(self, path, entry, count):
+        '''Checks a random sample of `count` blocks of the entry against the
+           contents of the file at `path`. Entries with content-defined blocks
+           cannot be sampled, and always fail.'''
+        blocksize, blocks = entry['metadata'].get('k'), entry['blocks']
+        if not blocksize:
+            debug('Block offsets unknown for content-defined blocks')
+            return False
+        f = file(path, "rb")
+        try:
+            return self.match_blocks( f, blocksize, blocks,
+                sample(xrange(len(blocks)), min(count, len(blocks))) )
+        finally:
+            f.close()
 
-    def consider_file(self, path, args):
+    def match_blocks(self, f, blocksize, blocks, indices):
+        '''Returns whether the blocks with the given indices match the
+           contents of the file `f` (with fixed blocks of `blocksize` bytes).'''
+        for i in indices:
+            f.seek(i*blocksize)
+            if storage.hash_function(f.read(blocksize)) <> blocks[i]:
+                return False
+        return True
+
+    def find_appended(self, path, f, st, entry, args):
+        '''Returns the full blocks of the stored version of a file if data
+           appears to have been appended to it since, and positions `f` after
+           them. Otherwise, an empty list is returned and `f` is positioned at
+           the start of the file.
+
+           Data is assumed to have been appended if the file (with fixed-size
+           blocks) has grown, and the last full block of the stored version
+           and a random sample of its other full blocks still match.'''
+        if not entry or not args['verify_appended'] or args['chunking'] <> 'fixed':
+            return []
+        blocksize, size = entry['metadata'].get('k'), entry['metadata'].get('s')
+        if blocksize <> args['blocksize'] or not size or st[ST_SIZE] <= size:
+            return []
+        count = size/blocksize
+        if not count or len(entry['blocks']) < count:
+            return []
+        indices = [ count - 1 ] + sample( xrange(count - 1),
+            min(args['verify_appended'] - 1, count - 1) )
+        if not self.match_blocks(f, blocksize, entry['blocks'], indices):
+            debug('File "%s" grew, but its stored blocks changed', path)
+            f.seek(0)
+            return []
+        debug( 'File "%s" grew; reusing %d blocks of version %d',
+               path, count, entry['version'] )
+        f.seek(count*blocksize)
+        return entry['blocks'][:count]
+
+
+    def consider_file(self, path, args, st = None):
+        '''Backs up a file if it was modified. If the file is modified but may
+           not be backed up yet (due to the cooldown or period arguments), the
+           time at which it should be considered again is returned.'''
 
         debug('Considering file "%s" for backup', path)
 
@@ -60,7 +157,8 @@ class UpdateScanner:
 
         # Read metadata for file
         metadata = {}
-        st = stat(path)
+        if not st:
+            st = stat(path)
         mtime, mode = st[ST_MTIME], st[ST_MODE]
         metadata['p'] = mode&0777
         if S_ISLNK(mode): metadata['p'] |= 01000
@@ -72,109 +170,255 @@ class UpdateScanner:
         metadata['o'] = st[ST_UID]
         metadata['g'] = st[ST_GID]
         metadata['t'] = int(time())
+        if args['chunking'] == 'fixed':
+            metadata['k'] = args['blocksize']
+        else:
+            metadata['k'] = 0
 
         # Compare modification time
         entry = cache.getEntry(path)
         if entry and entry['metadata']['m'] == mtime:
             debug('Not modified; skipping')
+            if not cache.getInode(st[ST_DEV], st[ST_INO]):
+                cache.setInode( st[ST_DEV], st[ST_INO], st[ST_SIZE], mtime,
+                                path, entry['version'] )
             return
 
         if mtime + args['cooldown'] > now:
             debug('Still hot; skipping')
-            return
+            return mtime + args['cooldown']
 
         if entry and entry['metadata']['t'] + args['period'] > now:
             debug('Recently backed up; skipping.')
-            return
-
-        # Read blocks from file
-        blocks = []
-        f = file(path, "rb")
-        try:
-            while True:
-                data = f.read(args['blocksize'])
-                if not data:
-                    break
-                hash = hash_function(data)
-                self.store_block(hash, data, args['compress'], args['level'])
-                blocks.append(hash)
-        finally:
-            f.close()
+            return entry['metadata']['t'] + args['period']
+
+        # Reuse the blocks of a moved file, or read blocks from file (only
+        # after the blocks of the stored version, if data was appended)
+        moved = self.find_moved(path, st, args)
+        jobs  = []
+        if moved:
+            # The blocks were split as recorded in the moved entry
+            blocks = moved['blocks']
+            if 'k' in moved['metadata']:
+                metadata['k'] = moved['metadata']['k']
+            else:
+                del metadata['k']
+        else:
+            bypass = splitext(path)[1][1:].lower() in INCOMPRESSIBLE
+            f = file(path, "rb")
+            try:
+                try:
+                    blocks = self.find_appended(path, f, st, entry, args)
+                    for data in chunks(f, args):
+                        jobs.append(self.pipeline.submit(
+                            data, args['compress'], args['level'],
+                            args['probe'], bypass ))
+                    blocks = blocks + self.pipeline.hashes(jobs)
+                except:
+                    # Let the blocks submitted so far be stored and counted,
+                    # so that none of them stays pending
+                    self.pipeline.commit(jobs, lambda: None)
+                    raise
+            finally:
+                f.close()
 
         # Compare file with cached entry
         # TODO: check a relevant portion of the metadata too?
         if entry and entry['blocks'] == blocks:
             debug('Modification time updated, but contents have not changed; touching')
             cache.setEntry(path, entry['version'], metadata, blocks)
+            cache.setInode( st[ST_DEV], st[ST_INO], st[ST_SIZE], mtime,
+                            path, entry['version'] )
+            self.pipeline.commit(jobs, lambda: None)
             return
 
         # Select new version for this file
         if entry: version = entry['version'] + 1
         else:     version = 1
 
-        # Store updated file remotely
-        storage.setEntry(path, version, metadata, blocks)
+        # Store the entry once all of its blocks have been stored
+        self.pipeline.commit( jobs, lambda:
+            self.store_entry(path, version, metadata, blocks, st) )
+
+
+    def process(self, roots):
+        '''Backs up the files in the given root directories (or directory).'''
+        if isinstance(roots, str):
+            roots = [ roots ]
+
+        walker = Walker(roots, self.prune, setting('backup', 'walkers', 4))
+        for path, st in walker:
+            args = apply_rules(path)
+            if args['skip']:
+                continue
+            try:
+                self.consider_file(path, args, st)
+            except (IOError, OSError), e:
+                # Removed or made unreadable since it was walked
+                warning('Cannot back up "%s": %s', path, e)
+        walker.report()
+
+        self.commit()
+        self.pipeline.stats.report()
+
+    def prune(self, dirpath):
+        '''Returns whether a directory should be skipped.'''
+        return apply_rules(dirpath, True)['skip']
+
+    def commit(self):
+        '''Waits for all pending blocks and entries to be stored, and updates
+           the revision of the cache and storage.'''
+        self.pipeline.flush()
+        cache.updateRevision(storage)
+        self.changes = 0
 
-        # Update cache
-        for hash in blocks:
-            cache.incBlockRef(hash)
-        cache.setEntry(path, version, metadata, blocks)
 
+class Daemon (UpdateScanner):
+    '''Backs up files continuously, as they are modified.
 
+    Directories are watched with inotify, and modified files are backed up
+    once their cooldown and period have passed. The watched trees are scanned
+    completely at start-up, periodically (every `rescan` seconds) and when
+    events were lost, to catch changes that were not reported.
 
-    def process(self, dirpath):
-        def report_exception(ex):
-            warning( '%s: %s', ex.filename, ex.strerror )
+    Changes are committed in batches: at most `commit` seconds after the
+    first uncommitted change, or once `commit_entries` entries are pending,
+    so that packs and manifests are not written for every modified file.'''
 
-        try:
-            for path, dirs, files in walk(dirpath, True, report_exception):
-                kept = []
-                for name in dirs:
-                    dirpath = join(path, name)
-                    args    = apply_rules(dirpath)
-                    if not args['skip']:
-                        kept.append(name)
-                        #consider_dir(dirpath, args)
-                dirs[:] = kept
-
-                for name in files:
-                    filepath = join(path, name)
-                    args     = apply_rules(filepath)
-                    if not args['skip']:
-                        self.consider_file(filepath, args)
-        except:
-            raise
+    def __init__(self, roots):
+        UpdateScanner.__init__(self)
+        self.roots       = roots
+        self.dirty       = {}   # path -> time at which it should be considered
+        self.inotify     = Inotify()
+        self.rescan_time = None
+        self.commit_time = None # when pending changes should be committed
+        self.watch_failed = False
 
-        cache.updateRevision(storage)
+    def watch(self, dirpath):
+        try:
+            self.inotify.watch(dirpath)
+        except OSError, e:
+            if not self.watch_failed:
+                warning( 'Cannot watch "%s" (%s); changes in some directories '
+                         'will only be found by rescans', dirpath, e.strerror )
+                self.watch_failed = True
+
+    def prune(self, dirpath):
+        if UpdateScanner.prune(self, dirpath):
+            return True
+        self.watch(dirpath)
+        return False
+
+    def consider_file(self, path, args, st = None):
+        retry = UpdateScanner.consider_file(self, path, args, st)
+        if retry:
+            self.dirty[path] = retry
+        return retry
+
+    def commit(self):
+        UpdateScanner.commit(self)
+        self.commit_time = None
+
+    def rescan(self):
+        info('Rescanning %s', ', '.join(self.roots))
+        for root in self.roots:
+            self.watch(root)
+        self.process(self.roots)
+        Purger().purge()
+        self.rescan_time = time() + setting('daemon', 'rescan', 1*UNITS['day'])
+
+    def handle(self, path, mask):
+        if mask & IN_Q_OVERFLOW:
+            warning('Events were lost; rescanning')
+            self.rescan_time = time()
+        elif path is None:
+            pass
+        elif mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO) and not self.prune(path):
+                # Walk the new directory, to watch its subdirectories and
+                # consider the files it already contains
+                for filepath, st in Walker([ path ], self.prune):
+                    self.dirty[filepath] = time()
+        else:
+            self.dirty.setdefault(path, time())
+
+    def run(self):
+        nice(setting('daemon', 'nice', 10))
+        self.rescan()
+        while True:
+            wakeup = min([ self.rescan_time ] + self.dirty.values() +
+                         filter(None, [ self.commit_time ]))
+            ready, _, _ = select([ self.inotify ], [], [], max(wakeup - time(), 0))
+            if ready:
+                for path, mask in self.inotify.read():
+                    self.handle(path, mask)
+
+            now = time()
+            for path in [ p for p in self.dirty if self.dirty[p] <= now ]:
+                del self.dirty[path]
+                args = apply_rules(path)
+                if args['skip']:
+                    continue
+                try:
+                    self.consider_file(path, args)
+                except (IOError, OSError), e:
+                    debug('Cannot back up "%s": %s', path, e)
+            self.pipeline.poll()
+            if self.commit_time is None and \
+                    (self.changes or self.pipeline.commits):
+                self.commit_time = time() + \
+                    setting('daemon', 'commit', 5*UNITS['minute'])
+            if self.commit_time is not None and (time() >= self.commit_time or
+                    self.changes >= setting('daemon', 'commit_entries', 1000)):
+                self.commit()
+
+            if time() >= self.rescan_time:
+                self.rescan()
 
 
 class Purger:
+    '''Removes the versions that the retention policy (configured in the
+       [purge] section) does not keep.'''
+
     def __init__(self):
-        pass
+        self.policy = Policy( setting('purge', 'keep_last', 0),
+                              setting('purge', 'keep_hourly', 0),
+                              setting('purge', 'keep_daily', 0),
+                              setting('purge', 'keep_weekly', 0),
+                              setting('purge', 'keep_monthly', 0) )
 
     def purge(self):
-        now = int(time())
-        for path in cache.listEntries():
-            debug('Purging for "%s"... ', path);
-            for version in cache.listVersions(path):
-                entry = cache.getEntry(path, version)
-                metadata = entry['metadata']
-                if 't' not in metadata:
-                    warning( 'Version %d of file "%s" cannot be purged because '+
-                             'it has no storage timestamp!', version, path )
-                    continue
-
-                age = now - metadata['t']
-                if age <= 0:
-                    if age < 0:
-                        warning( 'Version %d of file "%s" has negative age of %d',
-                                 version, path, age )
-                    continue
-                slot
-                
-                debug('\tversion %d stored %d sec ago', version, age)
+        if not self.policy.enabled():
+            debug('No retention policy configured; not purging')
+            return 0
+
+        start = time()
+        paths, indices, versions, times = cache.listVersionTimes()
+        keep = select_versions(indices, times, self.policy, int(start))
+        drop = [ i for i, k in enumerate(keep) if not k ]
+        info( 'Keeping %d of %d versions of %d files (selected in %.1f s)',
+              len(keep) - len(drop), len(keep), len(paths), time() - start )
+
+        for i in drop:
+            path, version = paths[indices[i]], versions[i]
+            debug('Purging version %d of "%s"', version, path)
+            storage.delEntry(path, version)
+            cache.delEntry(path, version)
+        if drop:
+            cache.updateRevision(storage)
+        return len(drop)
 
 
 if __name__ == "__main__":
-    UpdateScanner().process('/home/maks/Desktop/Backup/test')
+    if not cache or not storage:
+        exit(1)
+    daemon = argv[1:2] == [ '--daemon' ]
+    roots = argv[1 + daemon:] or configured_roots()
+    if not roots:
+        critical('No directories to back up specified')
+        exit(1)
+    if daemon:
+        Daemon(roots).run()
+    else:
+        UpdateScanner().process(roots)
     Purger().purge()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''Benchmarks fixed-size against content-defined chunking.
+
+Usage: bench_chunking [<file>...]
+
+Every file (or, if none are given, a set of generated files) is edited a
+number of times by inserting, deleting and overwriting small runs of bytes at
+random offsets. All versions are then split into blocks by each chunker, and
+the chunking throughput and deduplication ratio (total bytes divided by the
+bytes in unique blocks) are reported.'''
+
+from sys import argv
+from time import time
+from random import Random
+from StringIO import StringIO
+from md5 import new as MD5
+from chunking import fixed_chunks, content_chunks
+
+EDITS    = 5        # edited versions per file
+CHANGES  = 3        # changes per edited version
+MB       = 1048576.0
+
+def generate(rnd, size):
+    '''Returns semi-compressible test data: random and repetitive text runs.'''
+    words = [ ''.join([ chr(rnd.randint(97, 122)) for i in xrange(rnd.randint(2, 9)) ])
+              for j in xrange(500) ]
+    parts, length = [], 0
+    while length < size:
+        if rnd.random() < 0.5:
+            part = ''.join([ chr(rnd.getrandbits(8)) for i in xrange(4096) ])
+        else:
+            part = ' '.join([ rnd.choice(words) for i in xrange(800) ]) + '\n'
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)[:size]
+
+def edit(rnd, data):
+    '''Returns a copy of `data` with a few small random changes.'''
+    for i in xrange(CHANGES):
+        pos = rnd.randint(0, len(data))
+        run = ''.join([ chr(rnd.getrandbits(8)) for j in xrange(rnd.randint(1, 100)) ])
+        kind = rnd.randint(0, 2)
+        if kind == 0:   data = data[:pos] + run + data[pos:]
+        elif kind == 1: data = data[:pos] + data[pos + len(run):]
+        else:           data = data[:pos] + run + data[pos + len(run):]
+    return data
+
+def measure(name, chunker, corpus):
+    total, unique, elapsed, seen = 0, 0, 0.0, set()
+    for data in corpus:
+        start = time()
+        blocks = list(chunker(StringIO(data)))
+        elapsed += time() - start
+        for block in blocks:
+            total += len(block)
+            hash = MD5(block).digest()
+            if hash not in seen:
+                seen.add(hash)
+                unique += len(block)
+    print '%-28s %8.1f MB/s %8.2fx dedup %8d blocks' % (
+        name, total/MB/max(elapsed, 1e-9), float(total)/max(unique, 1), len(seen) )
+
+if __name__ == '__main__':
+    rnd = Random(42)
+    if len(argv) > 1:
+        bases = [ file(path, 'rb').read() for path in argv[1:] ]
+    else:
+        bases = [ generate(rnd, size) for size in (4*2**20, 16*2**20, 32*2**20) ]
+
+    corpus = []
+    for data in bases:
+        corpus.append(data)
+        for i in xrange(EDITS):
+            data = edit(rnd, data)
+            corpus.append(data)
+    print '%d versions of %d files, %.1f MB total' % (
+        len(corpus), len(bases), sum(map(len, corpus))/MB )
+
+    for size in (64*1024, 1024*1024):
+        measure( 'fixed %dk' % (size/1024),
+                 lambda f: fixed_chunks(f, size), corpus )
+        measure( 'content %dk/%dk/%dk' % (size/4096, size/1024, size/256),
+                 lambda f: content_chunks(f, size/4, size, size*4), corpus )
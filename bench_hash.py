@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+'''Benchmarks the block hash functions.
+
+Usage: bench_hash [<block size>...]
+
+Every available hash function (see hash.py) hashes blocks of every size (by
+default, the block sizes commonly used for backing up: 64 KB to 4 MB), first
+with a single thread and then with a thread per CPU, and the throughput of
+each is reported. Since the functions release the interpreter lock while
+hashing, the throughput with several threads should scale with the number of
+CPUs.'''
+
+from sys import argv
+from os import urandom
+from time import time
+from threading import Thread
+from multiprocessing import cpu_count
+from defs import parse_quantity
+from hash import functions
+
+TOTAL = 256*2**20   # bytes hashed per measurement
+MB    = 1048576.0
+
+def measure(function, data, threads):
+    '''Returns the throughput in MB/s of hashing TOTAL bytes of blocks with
+       `threads` threads.'''
+    count = max(TOTAL/len(data)/threads, 1)
+    def work():
+        for i in xrange(count):
+            function(data)
+    start = time()
+    workers = [ Thread(target = work) for i in xrange(threads) ]
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+    return count*threads*len(data)/MB/max(time() - start, 1e-9)
+
+if __name__ == '__main__':
+    if len(argv) > 1:
+        sizes = map(parse_quantity, argv[1:])
+    else:
+        sizes = [ 64*1024, 256*1024, 1024*1024, 4096*1024 ]
+    threads = cpu_count()
+    print '%-12s %10s %12s %20s' % ( 'function', 'block size', 'MB/s',
+                                     'MB/s (%d threads)' % threads )
+    for name in sorted(functions):
+        for size in sizes:
+            data = urandom(size)
+            print '%-12s %9dk %12.1f %20.1f' % ( name, size/1024,
+                measure(functions[name], data, 1),
+                measure(functions[name], data, threads) )
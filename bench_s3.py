@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+'''Benchmarks the S3 storage module against a local stand-in server.
+
+Usage: bench_s3 [<latency ms> [<connect latency ms>]]
+
+Starts a minimal S3-compatible server on localhost, which delays every request
+by the given latency, and every new connection by the connect latency (to
+simulate TCP and TLS handshakes). It then stores, retrieves and deletes a set
+of objects with a new connection per request, with a single persistent
+connection, and with several threads sharing the connection pool.'''
+
+from sys import argv
+from time import time, sleep
+from threading import Thread, Lock
+from urlparse import urlparse, parse_qs
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from socket import IPPROTO_TCP, TCP_NODELAY
+from xml.sax.saxutils import escape, unescape
+from md5 import new as MD5
+import re
+from storage.S3 import StorageS3
+from defs import CONFIG_DEFAULTS
+
+OBJECTS = 200
+SIZE    = 64*1024
+THREADS = 8
+
+
+class FakeS3Server (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, connect_latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeS3Handler)
+        self.latency         = latency
+        self.connect_latency = connect_latency
+        self.objects         = {}
+        self.lock            = Lock()
+        self.connections     = 0
+
+
+class FakeS3Handler (BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize         = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.server.connections += 1
+        sleep(self.server.connect_latency)
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body = '', headers = {}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def do_PUT(self):
+        sleep(self.server.latency)
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        path = urlparse(self.path).path
+        if path.count('/') > 1:
+            self.server.objects[path] = data
+        self.reply(200)
+
+    def do_DELETE(self):
+        sleep(self.server.latency)
+        self.server.objects.pop(urlparse(self.path).path, None)
+        self.reply(204)
+
+    def do_POST(self):
+        # Multi-object delete
+        sleep(self.server.latency)
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        bucket = urlparse(self.path).path.rstrip('/')
+        for key in re.findall('<Key>(.*?)</Key>', data):
+            self.server.objects.pop(bucket + '/' + unescape(key), None)
+        self.reply(200, '<DeleteResult></DeleteResult>')
+
+    def do_GET(self):
+        sleep(self.server.latency)
+        url = urlparse(self.path)
+        if url.path.count('/') == 1:
+            return self.list(url.path, parse_qs(url.query))
+        data = self.server.objects.get(url.path)
+        if data is None:
+            return self.reply(404, '<Error><Message>Not found</Message></Error>')
+        range = self.headers.get('Range')
+        if range:
+            first, last = map(int, range.split('=')[1].split('-'))
+            return self.reply(206, data[first:last + 1])
+        self.reply(200, data)
+
+    def list(self, bucket, query):
+        prefix = bucket + '/' + query.get('prefix', [''])[0]
+        marker = bucket + '/' + query.get('marker', [''])[0]
+        keys = sorted([ k for k in self.server.objects.keys()
+                        if k.startswith(prefix) and k > marker ])
+        body = '<ListBucketResult>%s<IsTruncated>%s</IsTruncated></ListBucketResult>' % (
+            ''.join([ '<Contents><Key>%s</Key><ETag>"%s"</ETag><Size>%d</Size>'
+                      '</Contents>' % ( escape(k[len(bucket) + 1:]),
+                      MD5(self.server.objects[k]).hexdigest(),
+                      len(self.server.objects[k]) )
+                      for k in keys[:1000] ]),
+            ('false', 'true')[len(keys) > 1000] )
+        self.reply(200, body)
+
+
+def run(storage, threads, operation, keys):
+    def work(i):
+        for key in keys[i::threads]:
+            operation(key)
+    start = time()
+    workers = [ Thread(target = work, args = (i,)) for i in xrange(threads) ]
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+    return time() - start
+
+def measure(name, storage, threads, server):
+    keys = [ 'bbench%d' % i for i in xrange(OBJECTS) ]
+    data = 'x'*SIZE
+    connections = server.connections
+    results = []
+    for operation in ( lambda key: storage.store(key, data),
+                       lambda key: storage.retrieve(key),
+                       lambda key: storage.delete(key) ):
+        results.append(OBJECTS/run(storage, threads, operation, keys))
+    print '%-32s %8.1f %8.1f %8.1f req/s  %6.1f MB/s stored  %4d connections' % (
+        (name,) + tuple(results) + (results[0]*SIZE/1048576.0,
+                                    server.connections - connections) )
+
+if __name__ == '__main__':
+    latency         = len(argv) > 1 and float(argv[1])/1000 or 0.02
+    connect_latency = len(argv) > 2 and float(argv[2])/1000 or 0.03
+    server = FakeS3Server(latency, connect_latency)
+    thread = Thread(target = server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    url = 'http://127.0.0.1:%d/bucket/repository/' % server.server_address[1]
+    storage = StorageS3(url, 'id', 'key', CONFIG_DEFAULTS)
+    print '%d objects of %d bytes; latency %.0f ms, connect latency %.0f ms' % (
+        OBJECTS, SIZE, latency*1000, connect_latency*1000 )
+    print '%-32s %8s %8s %8s' % ('', 'store', 'retrieve', 'delete')
+
+    storage.setConnections(1, 0)
+    measure('new connection per request', storage, 1, server)
+    storage.setConnections(1, 30)
+    measure('persistent connection', storage, 1, server)
+    storage.setConnections(THREADS, 30)
+    measure('pool, %d threads' % THREADS, storage, THREADS, server)
+    storage.close()
+    server.shutdown()
+    sleep(0.1)
@@ -1,87 +1,761 @@
-from os import unlink
+'''Local cache of the repository contents.
+
+The cache is an SQLite database with the following tables:
+
+  info      key/value pairs (currently only the revision)
+  blocks    one row per data block: its reference count, the time it was
+            added and its stored size (if known) and, for packed blocks, its
+            location
+  entries   one row per path, with the latest version stored, and the
+            directory it is in and its name
+  dirs      one row per directory: its parent and name, and the number of
+            entries below it and the total size of their latest versions
+  versions  one row per version of a path, with typed metadata columns and
+            the list of block hashes (concatenated) as a blob
+  objects   the size and MD5 digest of the value of stored packs and unpacked
+            blocks, as recorded when they were stored
+  inodes    maps file identities (device, inode, size and modification time)
+            to the version of the entry that was last stored for them
+
+Writes are grouped into transactions of `batch` entries. While a transaction
+is open the stored revision is invalidated, so if the process dies before the
+revision is updated, the cache is detected as stale and rebuilt.
+
+Caches created by earlier versions (using anydbm) are migrated automatically.'''
+
+from os import unlink, rename
+from os.path import exists, dirname, basename
 from random import randint
 from anydbm import open as dbopen
+from whichdb import whichdb
 from pickle import dumps, loads
 from time import time
+from array import array
+from itertools import islice
+from rules import WILDCARDS, glob_to_regex
+import re
+import sqlite3
 
 def uuid():
     # Random 9-digit number
     return `randint(0, 10**9 - 1)`
 
+# Metadata keys that are stored in typed columns of the versions table
+METADATA_COLUMNS = [
+    ('s', 'size'), ('c', 'ctime'), ('m', 'mtime'), ('t', 'stored'),
+    ('p', 'perm'), ('o', 'owner'), ('g', 'grp'),   ('k', 'chunk') ]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS info (
+    key         TEXT PRIMARY KEY,
+    value       TEXT );
+CREATE TABLE IF NOT EXISTS blocks (
+    hash        BLOB PRIMARY KEY,
+    refs        INTEGER NOT NULL DEFAULT 0,
+    pack        TEXT,
+    offset      INTEGER,
+    length      INTEGER,
+    cid         TEXT,
+    added       INTEGER );
+CREATE TABLE IF NOT EXISTS entries (
+    path        TEXT PRIMARY KEY,
+    latest      INTEGER NOT NULL,
+    dir         INTEGER,
+    name        TEXT );
+CREATE TABLE IF NOT EXISTS dirs (
+    id          INTEGER PRIMARY KEY,
+    parent      INTEGER,
+    name        TEXT NOT NULL,
+    files       INTEGER NOT NULL DEFAULT 0,
+    size        INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (parent, name) );
+CREATE TABLE IF NOT EXISTS versions (
+    path        TEXT NOT NULL,
+    version     INTEGER NOT NULL,
+    %s,
+    extra       BLOB,
+    nblocks     INTEGER NOT NULL,
+    blocks      BLOB NOT NULL,
+    PRIMARY KEY (path, version) );
+CREATE INDEX IF NOT EXISTS versions_stored ON versions (stored);
+CREATE TABLE IF NOT EXISTS objects (
+    key         BLOB PRIMARY KEY,
+    size        INTEGER NOT NULL,
+    digest      TEXT );
+CREATE TABLE IF NOT EXISTS inodes (
+    dev         INTEGER NOT NULL,
+    ino         INTEGER NOT NULL,
+    size        INTEGER NOT NULL,
+    mtime       INTEGER NOT NULL,
+    path        TEXT NOT NULL,
+    version     INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino) );
+''' % ',\n    '.join([ '%-11s INTEGER' % column for key, column in METADATA_COLUMNS ])
+
+# Indices on columns that may have been added to an existing database
+INDICES = '''
+CREATE INDEX IF NOT EXISTS entries_dir ON entries (dir, name);
+'''
+
+VERSION_COLUMNS = ', '.join([ column for key, column in METADATA_COLUMNS ])
+ENTRY_COLUMNS   = ', '.join([ 'v.' + column for key, column in METADATA_COLUMNS ])
+
+
+def join_blocks(blocks):
+    return buffer(''.join(blocks))
+
+def split_blocks(data, count):
+    data = str(data)
+    if not count:
+        return []
+    size = len(data)/count
+    return [ data[i:i + size] for i in xrange(0, len(data), size) ]
+
+def make_entry(path, version, row):
+    '''Returns an entry from a row of the versions table, consisting of the
+       metadata columns, extra, nblocks and blocks.'''
+    metadata = {}
+    if row[-3] is not None:
+        metadata.update(loads(str(row[-3])))
+    for (key, column), value in zip(METADATA_COLUMNS, row):
+        if value is not None:
+            metadata[key] = value
+    return { 'path': path, 'version': version, 'metadata': metadata,
+             'blocks': split_blocks(row[-1], row[-2]) }
+
+def is_dbm(dbpath):
+    '''Returns whether `dbpath` refers to a cache in the old anydbm format.'''
+    return bool(whichdb(dbpath))
+
 
 class Cache:
 
+    # Number of entries written per transaction
+    batch = 100
+
     def __init__(self, dbpath, storage = None):
+        self.dirty   = False
+        self.pending = 0
+        self.dirs    = {}   # directory path -> ids of it and its ancestors
+        self.deltas  = {}   # directory id -> [ entries, size ] not yet written
         if not storage:
             # Open existing cache database
-            self.db = dbopen(dbpath, 'w', 0600)
+            if is_dbm(dbpath):
+                self.migrate(dbpath)
+            elif not exists(dbpath):
+                raise IOError('Cache database "%s" does not exist' % dbpath)
+            self.open(dbpath)
         else:
             # Create new cache for existing storage
-            self.db = dbopen(dbpath, 'n', 0600)
+            if exists(dbpath):
+                unlink(dbpath)
+            self.open(dbpath)
+            self.dirty = True
             try:
-                for block in storage.listBlocks():
-                    self.addBlock(block)
-                for path, version in storage.listEntries():
-                    metadata, blocks = storage.getEntry(path, version)
-                    self.setEntry(path, version, metadata, blocks)
-                    for block in blocks:
-                        # TODO: report error if block does not exist 
-                        self.incBlockRef(block)
+                for block, location in storage.listBlockLocations():
+                    self.addBlock(block, location)
+                changes = storage.listManifests()
+                if changes is not None:
+                    # Versions added and removed again (such as purged ones)
+                    # may refer to blocks that have been collected since, so
+                    # only the final set of entries is counted
+                    entries = {}
+                    for change in changes:
+                        if change[0] == 'e+':
+                            entries[tuple(change[1:3])] = change[3:]
+                        elif change[0] == 'e-':
+                            entries.pop(tuple(change[1:3]), None)
+                    keys = entries.keys()
+                    keys.sort()
+                    for path, version in keys:
+                        metadata, blocks = entries.pop((path, version))
+                        self.setEntry(path, version, metadata, blocks)
+                        for block in blocks:
+                            self.incBlockRef(block)
+                else:
+                    # Repositories written before manifests were introduced
+                    for path, version in storage.listEntries():
+                        metadata, blocks = storage.getEntry(path, version)
+                        self.setEntry(path, version, metadata, blocks)
+                        for block in blocks:
+                            # TODO: report error if block does not exist
+                            self.incBlockRef(block)
                 self.updateRevision(storage)
             except:
+                self.db.close()
                 unlink(dbpath)
                 raise
 
+    def open(self, dbpath):
+        self.db = sqlite3.connect(dbpath, check_same_thread = False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.db.executescript(SCHEMA)
+        # Caches created before blocks had an added time
+        columns = [ row[1] for row in self.db.execute('PRAGMA table_info(blocks)') ]
+        if 'added' not in columns:
+            self.db.execute('ALTER TABLE blocks ADD COLUMN added INTEGER')
+            self.db.commit()
+        # Caches created before the directory index
+        columns = [ row[1] for row in self.db.execute('PRAGMA table_info(entries)') ]
+        if 'dir' not in columns:
+            self.db.execute('ALTER TABLE entries ADD COLUMN dir INTEGER')
+            self.db.execute('ALTER TABLE entries ADD COLUMN name TEXT')
+            self.indexPaths()
+        self.db.executescript(INDICES)
+
+    def migrate(self, dbpath):
+        '''Converts a cache in the old anydbm format to an SQLite database.'''
+        temp_path = dbpath + '.new'
+        if exists(temp_path):
+            unlink(temp_path)
+        self.open(temp_path)
+        self.dirty = True
+        old = dbopen(dbpath, 'r')
+        try:
+            for key in old.keys():
+                if key[:1] == 'b':
+                    self.addBlock(key[1:])
+                    self.db.execute( 'UPDATE blocks SET refs = ? WHERE hash = ?',
+                                     (int(old[key]), buffer(key[1:])) )
+            for key in old.keys():
+                if key[:1] == 'l':
+                    self.setBlockLocation(key[1:], loads(old[key]))
+                elif key[:1] == 'v':
+                    sep = key.rfind(',')
+                    metadata, blocks = loads(old[key])
+                    self.setEntry(key[1:sep], int(key[sep + 1:]), metadata, blocks)
+            self.db.execute( 'INSERT OR REPLACE INTO info VALUES (?, ?)',
+                             ('rev', old['rev']) )
+            self.db.commit()
+            self.db.close()
+        finally:
+            old.close()
+
+        # Replace the old database files
+        for suffix in ('', '.db', '.dat', '.dir', '.bak', '.pag'):
+            if exists(dbpath + suffix):
+                unlink(dbpath + suffix)
+        rename(temp_path, dbpath)
+        self.dirty = False
+
+    def modified(self):
+        # Invalidates the stored revision before the first change is written
+        if not self.dirty:
+            self.dirty = True
+            self.db.execute( 'INSERT OR REPLACE INTO info VALUES (?, ?)',
+                             ('rev', '-1') )
+            self.db.commit()
+
+    def commit(self):
+        '''Commits pending changes to the database.'''
+        self.writeDeltas()
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
     def getRevision(self):
-        return int(self.db['rev'])
+        row = self.db.execute( 'SELECT value FROM info WHERE key = ?',
+                               ('rev',) ).fetchone()
+        if not row:
+            return -1
+        return int(row[0])
 
     def updateRevision(self, storage = None):
         rev = uuid()
         if storage:
-            storage.setRevision(rev)
-        self.db['rev'] = rev
+            for change in storage.setRevision(rev, self.listAllEntries()):
+                if change[0] == 'o+':
+                    self.setObject(*change[1:])
+                elif change[0] == 'o-':
+                    self.delObject(change[1])
+        self.setRevision(rev)
+
+    def setRevision(self, rev):
+        self.db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', ('rev', rev))
+        self.commit()
+        self.dirty = False
+
+    def replay(self, storage):
+        '''Brings the cache up to date by applying the changes recorded in the
+           storage's journal since the cache's revision. Returns False (without
+           changing the cache) if the journal does not cover that range.'''
+        rev     = storage.getRevision()
+        changes = storage.getJournal(self.getRevision(), rev)
+        if changes is None:
+            return False
+        for change in changes:
+            self.apply(change)
+        self.setRevision(rev)
+        return True
+
+    def apply(self, change):
+        '''Applies a change recorded in the journal or in a manifest.'''
+        if change[0] == 'b+':
+            id, location = change[1:]
+            if not self.hasBlock(id):
+                self.addBlock(id, location)
+            else:
+                # Moved to another pack, or out of one; older journals record
+                # no location for unpacked blocks
+                self.setBlockLocation(id, location or (None, None, None, None))
+        elif change[0] == 'b-':
+            self.delBlock(change[1])
+        elif change[0] == 'e+':
+            path, version, metadata, blocks = change[1:]
+            if not self.getEntry(path, version):
+                for block in blocks:
+                    self.incBlockRef(block)
+            self.setEntry(path, version, metadata, blocks)
+        elif change[0] == 'e-':
+            self.delEntry(*change[1:])
+        elif change[0] == 'o+':
+            self.setObject(*change[1:])
+        elif change[0] == 'o-':
+            self.delObject(change[1])
 
     def getEntry(self, path, version = None):
-        try:
-            if not version:
-                version = self.listVersions(path)[-1]
-            metadata, blocks = loads(self.db['v%s,%d' % (path, version)])
-            return { 'path': path, 'version': version,
-                     'metadata': metadata, 'blocks': blocks }
-        except KeyError:
+        if not version:
+            row = self.db.execute( 'SELECT latest FROM entries WHERE path = ?',
+                                   (path,) ).fetchone()
+            if not row:
+                return None
+            version = row[0]
+        row = self.db.execute(
+            'SELECT %s, extra, nblocks, blocks FROM versions '
+            'WHERE path = ? AND version = ?' % VERSION_COLUMNS,
+            (path, version) ).fetchone()
+        if not row:
             return None
+        return make_entry(path, version, row)
+
+    def listEntriesAt(self, prefix, timestamp = None):
+        '''Returns the entries for `prefix` and all paths below it, in the
+           latest version stored at or before `timestamp` (or the latest
+           version, if `timestamp` is None), ordered by path.'''
+        prefix = prefix.rstrip('/')
+        # Paths below the prefix sort between prefix + '/' and prefix + '0'
+        where = 'v.path = ? OR (v.path >= ? AND v.path < ?)'
+        args  = [ prefix, prefix + '/', prefix + '0' ]
+        if timestamp is None:
+            select = 'SELECT latest FROM entries WHERE path = v.path'
+        else:
+            select = ( 'SELECT MAX(version) FROM versions w '
+                       'WHERE w.path = v.path AND w.stored <= ?' )
+            args.append(timestamp)
+        rows = self.db.execute(
+            'SELECT v.path, v.version, %s, extra, nblocks, blocks '
+            'FROM versions v WHERE (%s) AND v.version = (%s) '
+            'ORDER BY v.path' % (
+                ', '.join([ 'v.' + column for key, column in METADATA_COLUMNS ]),
+                where, select ),
+            args ).fetchall()
+        return [ make_entry(row[0], row[1], row[2:]) for row in rows ]
 
     def setEntry(self, path, version, metadata, blocks):
-        self.db['v%s,%d' % (path, version)] = dumps((metadata, blocks))
-        key = 'i' + path
-        try: versions = loads(self.db[key])
-        except KeyError: versions = []
-        if version not in versions:
-            versions.append(version)
-            self.db[key] = dumps(versions)
+        self.modified()
+        before = self.getLatest(path)
+        extra = dict([ (k, v) for k, v in metadata.items()
+                       if k not in dict(METADATA_COLUMNS) ])
+        if extra: extra = buffer(dumps(extra, 2))
+        else:     extra = None
+        self.db.execute(
+            'INSERT OR REPLACE INTO versions VALUES (?, ?, %s, ?, ?, ?)' %
+                ', '.join(['?']*len(METADATA_COLUMNS)),
+            [ path, version ] + [ metadata.get(k) for k, c in METADATA_COLUMNS ] +
+            [ extra, len(blocks), join_blocks(blocks) ] )
+        if before:
+            self.db.execute( 'UPDATE entries SET latest = ? WHERE path = ? AND '
+                             'latest < ?', (version, path, version) )
+        else:
+            self.db.execute( 'INSERT INTO entries VALUES (?, ?, ?, ?)',
+                             (path, version, self.directory(dirname(path))[-1],
+                              basename(path)) )
+        self.account(path, before, self.getLatest(path))
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.commit()
+
+    def delEntry(self, path, version):
+        '''Removes a version of an entry, and releases its blocks.'''
+        entry = self.getEntry(path, version)
+        if not entry:
+            return
+        self.modified()
+        before = self.getLatest(path)
+        for hash in entry['blocks']:
+            self.decBlockRef(hash)
+        self.db.execute( 'DELETE FROM versions WHERE path = ? AND version = ?',
+                         (path, version) )
+        row = self.db.execute( 'SELECT MAX(version) FROM versions WHERE path = ?',
+                               (path,) ).fetchone()
+        if row[0] is None:
+            self.db.execute('DELETE FROM entries WHERE path = ?', (path,))
+        else:
+            self.db.execute( 'UPDATE entries SET latest = ? WHERE path = ?',
+                             (row[0], path) )
+        self.account(path, before, self.getLatest(path))
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.commit()
+
+    def getLatest(self, path):
+        '''Returns the latest version of an entry and its size (which is None
+           if unknown), or None if there is no such entry.'''
+        row = self.db.execute(
+            'SELECT e.latest, v.size FROM entries e LEFT JOIN versions v '
+            'ON v.path = e.path AND v.version = e.latest WHERE e.path = ?',
+            (path,) ).fetchone()
+        if row:
+            return tuple(row)
+
+    def directory(self, path):
+        '''Returns the ids of a directory and its ancestors (from the root
+           down), adding them to the directory index if necessary.'''
+        ids = self.dirs.get(path)
+        if ids is None:
+            parent = dirname(path)
+            if parent == path:
+                ids, parent_id, name = [], None, ''
+            else:
+                ids = self.directory(parent)
+                parent_id, name = ids[-1], basename(path)
+            row = self.db.execute( 'SELECT id FROM dirs WHERE parent IS ? AND '
+                                   'name = ?', (parent_id, name) ).fetchone()
+            if row:
+                id = row[0]
+            else:
+                id = self.db.execute( 'INSERT INTO dirs (parent, name) VALUES (?, ?)',
+                                      (parent_id, name) ).lastrowid
+            ids = ids + [ id ]
+            self.dirs[path] = ids
+        return ids
+
+    def account(self, path, before, after):
+        '''Updates the aggregates of the directories containing `path`, given
+           the latest version and size of its entry before and after a change
+           (as returned by getLatest()).'''
+        files = (after is not None) - (before is not None)
+        size  = (after and after[1] or 0) - (before and before[1] or 0)
+        if files or size:
+            for id in self.directory(dirname(path)):
+                delta = self.deltas.setdefault(id, [ 0, 0 ])
+                delta[0] += files
+                delta[1] += size
+
+    def writeDeltas(self):
+        for id, (files, size) in self.deltas.items():
+            self.db.execute( 'UPDATE dirs SET files = files + ?, size = size + ? '
+                             'WHERE id = ?', (files, size, id) )
+        self.deltas = {}
+
+    def indexPaths(self):
+        '''Adds all entries to the directory index.'''
+        for path, size in self.db.execute(
+                'SELECT e.path, v.size FROM entries e JOIN versions v '
+                'ON v.path = e.path AND v.version = e.latest' ).fetchall():
+            self.db.execute( 'UPDATE entries SET dir = ?, name = ? WHERE path = ?',
+                             (self.directory(dirname(path))[-1], basename(path), path) )
+            self.account(path, None, (0, size))
+        self.commit()
+
+    def findDirectory(self, path):
+        '''Returns the id of a directory in the directory index, or None.'''
+        if path in self.dirs:
+            return self.dirs[path][-1]
+        parent = dirname(path)
+        if parent == path:
+            parent_id, name = None, ''
+        else:
+            parent_id, name = self.findDirectory(parent), basename(path)
+            if parent_id is None:
+                return None
+        row = self.db.execute( 'SELECT id FROM dirs WHERE parent IS ? AND name = ?',
+                               (parent_id, name) ).fetchone()
+        return row and row[0]
+
+    def getDirectory(self, path):
+        '''Returns the number of entries below a directory and the total size
+           of their latest versions, or None if there are no entries below it.'''
+        id = self.findDirectory(path)
+        if id is not None:
+            self.writeDeltas()
+            row = self.db.execute( 'SELECT files, size FROM dirs WHERE id = ?',
+                                   (id,) ).fetchone()
+            if row[0]:
+                return tuple(row)
+
+    def listDirectory(self, path, offset = 0, limit = -1, min_size = 0):
+        '''Returns the contents of a directory as (name, item) tuples: first
+           the subdirectories, with `item` a (files, size) tuple as returned by
+           getDirectory(), then the entries, with `item` their latest version
+           (without its blocks). Both are ordered by name, and only entries of
+           at least `min_size` bytes are included. At most `limit` items are
+           returned (if it is not negative), starting at `offset`.'''
+        id = self.findDirectory(path)
+        if id is None:
+            return []
+        self.writeDeltas()
+        count = self.db.execute( 'SELECT COUNT(*) FROM dirs WHERE parent = ? AND '
+                                 'files > 0', (id,) ).fetchone()[0]
+        items = [ (name, (files, size)) for name, files, size in self.db.execute(
+            'SELECT name, files, size FROM dirs WHERE parent = ? AND files > 0 '
+            'ORDER BY name LIMIT ? OFFSET ?', (id, limit, offset) ) ]
+        if limit >= 0:
+            limit -= len(items)
+        rows = self.db.execute(
+            'SELECT e.path, e.name, e.latest, %s, v.extra, 0, NULL '
+            'FROM entries e JOIN versions v ON v.path = e.path AND '
+            'v.version = e.latest WHERE e.dir = ? AND COALESCE(v.size, 0) >= ? '
+            'ORDER BY e.name LIMIT ? OFFSET ?' % ENTRY_COLUMNS,
+            (id, min_size, limit, max(offset - count, 0)) )
+        return items + [ (row[1], make_entry(row[0], row[2], row[3:]))
+                         for row in rows ]
+
+    def listMatching(self, pattern, offset = 0, limit = -1, min_size = 0):
+        '''Returns the latest versions (without their blocks) of the entries
+           of at least `min_size` bytes whose paths match a pattern (see
+           rules.py), ordered by path. Only the paths that start with the part
+           of the pattern up to the last slash before the first wildcard are
+           examined. `offset` and `limit` are as for listDirectory().'''
+        match = WILDCARDS.search(pattern)
+        if match:
+            prefix = pattern[:pattern.rfind('/', 0, match.start()) + 1]
+        else:
+            prefix = pattern
+        where, args = 'COALESCE(v.size, 0) >= ?', [ min_size ]
+        if prefix:
+            where += ' AND e.path >= ? AND e.path < ?'
+            args  += [ prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1) ]
+        regex = re.compile(glob_to_regex(pattern) + r'\Z')
+        rows = self.db.execute(
+            'SELECT e.path, e.latest, %s, v.extra, 0, NULL '
+            'FROM entries e JOIN versions v ON v.path = e.path AND '
+            'v.version = e.latest WHERE %s ORDER BY e.path' % (
+                ENTRY_COLUMNS, where ), args )
+        entries = ( make_entry(row[0], row[1], row[2:])
+                    for row in rows if regex.match(row[0]) )
+        if limit < 0: end = None
+        else:         end = offset + limit
+        return list(islice(entries, offset, end))
+
+    def listVersionsStored(self, start = None, end = None, prefix = None,
+                           offset = 0, limit = -1, min_size = 0):
+        '''Returns the versions (without their blocks) of at least `min_size`
+           bytes that were stored between `start` and `end` (inclusive; either
+           may be None), of `prefix` and the paths below it (or all paths, if it
+           is None), ordered by storage time. `offset` and `limit` are as for
+           listDirectory().'''
+        where, args = [ 'COALESCE(size, 0) >= ?' ], [ min_size ]
+        if start is not None:
+            where.append('stored >= ?')
+            args.append(start)
+        if end is not None:
+            where.append('stored <= ?')
+            args.append(end)
+        if start is None and end is None:
+            where.append('stored IS NOT NULL')
+        if prefix is not None:
+            prefix = prefix.rstrip('/')
+            where.append('(path = ? OR (path >= ? AND path < ?))')
+            args += [ prefix, prefix + '/', prefix + '0' ]
+        rows = self.db.execute(
+            'SELECT path, version, %s, extra, 0, NULL FROM versions WHERE %s '
+            'ORDER BY stored, path LIMIT ? OFFSET ?' % (
+                VERSION_COLUMNS, ' AND '.join(where) ),
+            args + [ limit, offset ] )
+        return [ make_entry(row[0], row[1], row[2:]) for row in rows ]
+
+    def getInode(self, dev, ino):
+        '''Returns the (size, mtime, path, version) last recorded for a file
+           identity, or None if nothing is recorded.'''
+        row = self.db.execute( 'SELECT size, mtime, path, version FROM inodes '
+                               'WHERE dev = ? AND ino = ?', (dev, ino) ).fetchone()
+        if row:
+            return tuple(row)
+
+    def setInode(self, dev, ino, size, mtime, path, version):
+        self.modified()
+        self.db.execute( 'INSERT OR REPLACE INTO inodes VALUES (?, ?, ?, ?, ?, ?)',
+                         (dev, ino, size, mtime, path, version) )
 
     def hasBlock(self, hash):
-        return self.db.has_key('b' + hash)
+        return self.db.execute( 'SELECT 1 FROM blocks WHERE hash = ?',
+                                (buffer(hash),) ).fetchone() is not None
 
-    def addBlock(self, hash):
-        self.db['b' + hash] = str(0)
+    def addBlock(self, hash, location = None, length = None):
+        '''Adds a block, with its location if it is packed. `length` is the
+           stored size of an unpacked block, if it is known.'''
+        self.modified()
+        self.db.execute( 'INSERT OR REPLACE INTO blocks (hash, length, added) '
+                         'VALUES (?, ?, ?)', (buffer(hash), length, int(time())) )
+        if location:
+            self.setBlockLocation(hash, location)
+
+    def delBlock(self, hash):
+        self.modified()
+        self.db.execute('DELETE FROM blocks WHERE hash = ?', (buffer(hash),))
+        self.delObject('b' + hash)
+
+    def setBlockLocation(self, hash, location):
+        pack, offset, length, cid = location
+        self.db.execute( 'UPDATE blocks SET pack = ?, offset = ?, length = ?, '
+                         'cid = ? WHERE hash = ?',
+                         (pack, offset, length, cid, buffer(hash)) )
+
+    def getBlockLocation(self, hash):
+        '''Returns the location of a packed block, or None if the block is not
+           stored in a pack (or its location is unknown).'''
+        row = self.db.execute( 'SELECT pack, offset, length, cid FROM blocks '
+                               'WHERE hash = ?', (buffer(hash),) ).fetchone()
+        if row and row[0] is not None:
+            return tuple(row)
 
     def incBlockRef(self, hash):
-        key = 'b' + hash
-        count = int(self.db[key])
-        self.db[key] = str(count + 1)
+        self.modified()
+        cursor = self.db.execute( 'UPDATE blocks SET refs = refs + 1 '
+                                  'WHERE hash = ?', (buffer(hash),) )
+        if not cursor.rowcount:
+            raise KeyError(hash)
 
     def decBlockRef(self, hash):
-        key = 'b' + hash
-        count = int(self.db[key])
-        if count == 0:
-            raise "reference count is zero"
-        self.db[key] = str(count - 1)
+        self.modified()
+        row = self.db.execute( 'SELECT refs FROM blocks WHERE hash = ?',
+                               (buffer(hash),) ).fetchone()
+        if not row:
+            raise KeyError(hash)
+        if row[0] == 0:
+            raise ValueError('reference count is zero')
+        self.db.execute( 'UPDATE blocks SET refs = refs - 1 WHERE hash = ?',
+                         (buffer(hash),) )
+
+    def countBlockRefs(self):
+        '''Returns a dictionary that maps the hashes of all blocks referenced
+           by versions to their number of references.'''
+        counts = {}
+        for nblocks, blocks in self.db.execute(
+                'SELECT nblocks, blocks FROM versions' ):
+            for hash in split_blocks(blocks, nblocks):
+                counts[hash] = counts.get(hash, 0) + 1
+        return counts
+
+    def listBlockRefs(self):
+        '''Returns a list of (hash, refs) tuples of all blocks.'''
+        return [ (str(hash), refs) for hash, refs in self.db.execute(
+            'SELECT hash, refs FROM blocks' ) ]
+
+    def setBlockRefs(self, hash, refs):
+        self.modified()
+        self.db.execute( 'UPDATE blocks SET refs = ? WHERE hash = ?',
+                         (refs, buffer(hash)) )
+
+    def listGarbage(self, before):
+        '''Returns the blocks that are not referenced and were added before
+           time `before`, as a tuple (blocks, packs, partial). `blocks` is a
+           list of (hash, length) tuples of such unpacked blocks; `packs` maps
+           every pack of which no block is used to a list of such tuples of all
+           its blocks, and `partial` maps the other packs to a list of their
+           unused blocks. Lengths are None if unknown.'''
+        live = set([ row[0] for row in self.db.execute(
+            'SELECT DISTINCT pack FROM blocks WHERE pack IS NOT NULL AND '
+            '(refs > 0 OR added >= ?)', (before,) ) ])
+        blocks, packs, partial = [], {}, {}
+        for hash, pack, length in self.db.execute(
+                'SELECT hash, pack, length FROM blocks WHERE refs = 0 AND '
+                '(added IS NULL OR added < ?)', (before,) ):
+            if pack is None:
+                blocks.append((str(hash), length))
+            elif pack in live:
+                partial.setdefault(pack, []).append((str(hash), length))
+            else:
+                packs.setdefault(pack, []).append((str(hash), length))
+        return blocks, packs, partial
+
+    def listPackBlocks(self, pack):
+        '''Returns a list of (hash, location) tuples of the blocks in a pack.'''
+        return [ (str(row[0]), tuple(row[1:])) for row in self.db.execute(
+            'SELECT hash, pack, offset, length, cid FROM blocks WHERE pack = ? '
+            'ORDER BY offset', (pack,) ) ]
+
+    def listBlocks(self):
+        '''Returns a list of the hashes of all blocks, ordered by location.'''
+        return [ str(row[0]) for row in self.db.execute(
+            'SELECT hash FROM blocks ORDER BY pack, offset' ) ]
+
+    def setObject(self, key, size, digest):
+        self.modified()
+        self.db.execute( 'INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                         (buffer(key), size, digest) )
+
+    def delObject(self, key):
+        self.modified()
+        self.db.execute('DELETE FROM objects WHERE key = ?', (buffer(key),))
+
+    def listObjects(self):
+        '''Returns a dictionary that maps the keys of all packs and unpacked
+           blocks to a (size, digest) tuple. The size of a pack is derived from
+           its blocks if it was not recorded, and the size of an unpacked block
+           and the digest are None if they are unknown.'''
+        objects = {}
+        for pack, size in self.db.execute(
+                'SELECT pack, MAX(offset + length) FROM blocks '
+                'WHERE pack IS NOT NULL GROUP BY pack' ):
+            objects['p' + pack] = (size, None)
+        for hash, length in self.db.execute(
+                'SELECT hash, length FROM blocks WHERE pack IS NULL' ):
+            if length is None: objects['b' + str(hash)] = (None, None)
+            else:              objects['b' + str(hash)] = (1 + length, None)
+        for key, size, digest in self.db.execute(
+                'SELECT key, size, digest FROM objects' ):
+            if str(key) in objects:
+                objects[str(key)] = (size, digest)
+        return objects
 
     def listEntries(self):
-        for key in self.db:
-            if key <> '' and key[0] == 'i':
-                yield key[1:]
+        # Fetch all rows first, so the caller can modify the database
+        for row in self.db.execute('SELECT path FROM entries').fetchall():
+            yield row[0]
+
+    def listAllEntries(self):
+        '''Returns a listing of all versions of all entries, as (path, version,
+           metadata, blocks) tuples.'''
+        for row in self.db.execute(
+                'SELECT path, version, %s, extra, nblocks, blocks '
+                'FROM versions ORDER BY path, version' % VERSION_COLUMNS ):
+            entry = make_entry(row[0], row[1], row[2:])
+            yield row[0], row[1], entry['metadata'], entry['blocks']
+
+    def listVersionTimes(self):
+        '''Returns the storage times of all versions of all entries, as a
+           tuple (paths, indices, versions, times). `paths` is a list of the
+           paths of all entries; the other elements are arrays with an element
+           per version: the index of its path, the version and its storage
+           time (or -1 if it is unknown). Versions are ordered by path, and by
+           descending version per path.'''
+        paths    = []
+        indices  = array('l')
+        versions = array('l')
+        times    = array('l')
+        last = None
+        for path, version, stored in self.db.execute(
+                'SELECT path, version, stored FROM versions '
+                'ORDER BY path, version DESC' ):
+            if path <> last:
+                paths.append(path)
+                last = path
+            indices.append(len(paths) - 1)
+            versions.append(version)
+            if stored is None: times.append(-1)
+            else:              times.append(stored)
+        return paths, indices, versions, times
 
     def listVersions(self, path):
-        return loads(self.db['i' + path])
+        versions = [ row[0] for row in self.db.execute(
+            'SELECT version FROM versions WHERE path = ? ORDER BY version',
+            (path,) ) ]
+        if not versions:
+            raise KeyError(path)
+        return versions
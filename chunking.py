@@ -0,0 +1,109 @@
+'''Chunking module.
+
+Splits file contents into blocks. Two methods are available:
+
+  fixed     Blocks of exactly `blocksize` bytes (except for the last block).
+            Cheap, but inserting or removing data shifts all following
+            block boundaries, so none of the following blocks can be shared
+            with an earlier version of the file.
+
+  content   Content-defined chunking: block boundaries are placed where the
+            data matches a signature, so they move along with the data when
+            bytes are inserted or removed. Blocks are between `minblock` and
+            `maxblock` bytes long, and `blocksize` bytes on average. If
+            `minblock` is not smaller than `blocksize`, a quarter of
+            `blocksize` is used instead, and if `maxblock` is not larger,
+            four times `blocksize` is used.
+
+Content-defined boundaries are found with a rolling signature that maps every
+byte to a single bit (through a fixed pseudo-random table) and cuts the data
+after each occurrence of a fixed bit pattern. Since the translation and the
+pattern search are both done by string primitives implemented in C, this is
+fast enough to keep up with reading the file.'''
+
+from md5 import new as MD5
+from math import log
+
+# Maps every byte to '0' or '1'
+BIT_TABLE = ''.join([ '01'[ord(MD5('bit %d' % i).digest()[0]) & 1]
+                      for i in xrange(256) ])
+
+# The bit pattern that marks a block boundary (a prefix of this is used)
+SIGNATURE = ''.join([ '01'[ord(c) >> 7] for c in
+                      MD5('signature').digest() + MD5('signature 2').digest() ])
+
+# Number of bytes read from the file at once (at least `maxblock`)
+READ_SIZE = 4*1024*1024
+
+
+def fixed_chunks(f, blocksize):
+    '''Yields consecutive blocks of `blocksize` bytes read from `f`.'''
+    while True:
+        data = f.read(blocksize)
+        if not data:
+            break
+        yield data
+
+def signature_bits(minblock, avgblock):
+    '''Returns the signature length for the given minimum and average block
+       size. A signature of n bits matches once every 2**n bytes on average.'''
+    return min(len(SIGNATURE), max(1, int(round(log(max(avgblock - minblock, 2), 2)))))
+
+def block_limits(minblock, avgblock, maxblock):
+    '''Returns the minimum and maximum block size to use for content-defined
+       chunking with the given average block size.'''
+    if minblock >= avgblock:
+        minblock = avgblock/4
+    if maxblock <= avgblock:
+        maxblock = avgblock*4
+    return minblock, maxblock
+
+def content_chunks(f, minblock, avgblock, maxblock):
+    '''Yields content-defined blocks read from `f`.'''
+
+    minblock, maxblock = block_limits(minblock, avgblock, maxblock)
+    bits      = signature_bits(minblock, avgblock)
+    signature = SIGNATURE[:bits]
+    minblock  = max(minblock, bits)
+    maxblock  = max(maxblock, minblock)
+    read_size = max(READ_SIZE, maxblock)
+
+    buf = sig = ''
+    start, eof = 0, False
+    while True:
+
+        # Make sure at least a maximum-size block is buffered
+        if len(buf) - start < maxblock and not eof:
+            data = f.read(read_size)
+            if data:
+                buf = buf[start:] + data
+                sig = sig[start:] + data.translate(BIT_TABLE)
+                start = 0
+            else:
+                eof = True
+            continue
+
+        end = min(start + maxblock, len(buf))
+        if start == end:
+            break
+
+        # Find the first signature that ends at least `minblock` bytes
+        # from the start of the block
+        if start + minblock < end:
+            pos = sig.find(signature, start + minblock - bits, end)
+            if pos >= 0:
+                end = pos + bits
+
+        yield buf[start:end]
+        start = end
+
+def chunks(f, args):
+    '''Yields blocks read from `f`, split according to the file arguments.
+
+       Raises ValueError if the chunking method is not supported.'''
+    if args['chunking'] == 'fixed':
+        return fixed_chunks(f, args['blocksize'])
+    if args['chunking'] == 'content':
+        return content_chunks( f, args['minblock'], args['blocksize'],
+                               args['maxblock'] )
+    raise ValueError('Unsupported chunking method: ' + args['chunking'])
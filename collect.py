@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+'''Removes data blocks that are no longer used from the repository.
+
+Usage: collect [options]
+
+Purging versions (see backup.py) releases the references to their blocks, but
+leaves the blocks themselves in the repository. This tool first recounts the
+references to every block from the versions in the cache (the mark phase),
+correcting reference counts that have drifted, and then deletes the blocks that
+are not referenced (the sweep phase).
+
+Blocks that were added less than the grace period ago are never deleted, since
+a back-up that is still in progress may have stored them without having stored
+the entries that refer to them yet. A pack is only deleted once none of its
+blocks is used; unused blocks in packs that are still used are reported, and
+only reclaimed by moving their used blocks to new packs once at least a
+configured share of their bytes is unused.
+
+Deletions are sent as bulk requests where the storage supports them, and as
+concurrent requests otherwise. Finally, temporary objects left behind by
+writes that were interrupted before the grace period are removed.
+
+Garbage collection must not run at the same time as a back-up (or the back-up
+daemon): a back-up may reuse a block that has no references, without storing
+it again, just before it is deleted. Both lock the cache, so this tool refuses
+to run while a back-up holds it (and vice versa).'''
+
+from optparse import OptionParser
+from time import time
+from sys import exit
+from logging import debug, info, warning, error, critical, exception
+from defs import parse_quantity
+from init import init, setting
+from storage.StorageBase import pack_key
+
+
+def mark(cache, correct = True):
+    '''Recounts the references to all blocks, and corrects the reference
+       counts in the cache (if `correct` is set). Returns the number of blocks
+       with a wrong count and the number of referenced blocks that are missing
+       from the cache.'''
+    counts = cache.countBlockRefs()
+    fixed = 0
+    for hash, refs in cache.listBlockRefs():
+        count = counts.pop(hash, 0)
+        if refs <> count:
+            debug( 'Block %s has %d references, not %d',
+                   hash.encode('hex'), count, refs )
+            if correct:
+                cache.setBlockRefs(hash, count)
+            fixed += 1
+    for hash in counts:
+        error('Block %s is referenced, but not in the cache', hash.encode('hex'))
+    return fixed, len(counts)
+
+def total(blocks):
+    return sum([ length or 0 for hash, length in blocks ])
+
+def repack(cache, storage, partial, threshold):
+    '''Moves the used blocks of the packs in `partial` in which at least
+       `threshold` percent of the bytes is unused to new packs. Returns a
+       dictionary that maps the packs that were emptied to their unused
+       blocks.'''
+    emptied = {}
+    for pack, unused in partial.items():
+        blocks = cache.listPackBlocks(pack)
+        size = sum([ location[2] for hash, location in blocks ])
+        if total(unused)*100 < threshold*size:
+            continue
+        data = storage.retrieve(pack_key(pack))
+        if data is None or len(data) < size:
+            error('Pack %s is missing or truncated; not repacked', pack)
+            continue
+        unused_ids = set([ hash for hash, length in unused ])
+        for hash, (_, offset, length, cid) in blocks:
+            if hash not in unused_ids:
+                location = storage.setBlock(hash, cid, data[offset:offset + length])
+                cache.setBlockLocation(hash, location or (None, None, length, None))
+        emptied[pack] = unused
+    if emptied:
+        storage.flush()
+        info('Moved the used blocks of %d packs to new packs', len(emptied))
+    return emptied
+
+def sweep(cache, storage, before, workers, threshold, dry_run = False):
+    '''Deletes the blocks that are not referenced and were added before time
+       `before`. Returns the number of blocks, objects and bytes deleted, and
+       the number of unused bytes left in packs that are still used.'''
+    blocks, packs, partial = cache.listGarbage(before)
+    if not dry_run and threshold:
+        packs.update(repack(cache, storage, partial, threshold))
+        for pack in packs:
+            partial.pop(pack, None)
+    ids = [ hash for hash, length in blocks ]
+    deleted = len(ids) + sum(map(len, packs.values()))
+    objects = len(ids) + 2*len(packs)
+    reclaimed = total(blocks) + sum(map(total, packs.values()))
+    waste = sum(map(total, partial.values()))
+    if dry_run or not deleted:
+        return deleted, objects, reclaimed, waste
+
+    # The cache is updated first (and invalidated until the new revision is
+    # set), so an interrupted run never leaves blocks in the cache that are
+    # gone from the repository.
+    packs = dict([ (pack, [ hash for hash, length in packs[pack] ])
+                   for pack in packs ])
+    for hash in ids:
+        cache.delBlock(hash)
+    for pack in packs:
+        for hash in packs[pack]:
+            cache.delBlock(hash)
+    cache.commit()
+    storage.delBlocks(ids, workers)
+    storage.delPacks(packs, workers)
+    cache.updateRevision(storage)
+    return deleted, objects, reclaimed, waste
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option( '-g', '--grace',
+                       help = 'only delete blocks added longer ago than this '
+                              '[default: 1 day, or as configured]' )
+    parser.add_option( '-w', '--workers', type = 'int',
+                       help = 'number of concurrent delete requests '
+                              '[default: storage connections]' )
+    parser.add_option( '-r', '--repack', type = 'int',
+                       help = 'repack packs of which at least this percentage '
+                              'is unused; 0 disables repacking '
+                              '[default: 50, or as configured]' )
+    parser.add_option( '-n', '--dry-run', action = 'store_true', default = False,
+                       help = 'only report what would be deleted' )
+    options, args = parser.parse_args()
+    if args:
+        parser.error('unexpected arguments')
+
+    cache, storage = init(True, True, True)
+    if not cache or not storage:
+        print 'Sorry, cache or storage not available'
+        exit(1)
+
+    grace = setting('gc', 'grace', 24*3600)
+    if options.grace:
+        try:
+            grace = parse_quantity(options.grace)
+        except ValueError, e:
+            parser.error(str(e))
+    workers = options.workers or setting('storage', 'connections', 8)
+    threshold = options.repack
+    if threshold is None:
+        threshold = setting('gc', 'repack', 50)
+
+    fixed, missing = mark(cache, not options.dry_run)
+    if fixed:
+        warning('%d blocks had a wrong reference count', fixed)
+        if not options.dry_run:
+            # Reference counts are not stored in the repository, so the cache
+            # is still up to date with its revision
+            cache.setRevision(storage.getRevision())
+    if missing:
+        error('%d referenced blocks are missing from the cache', missing)
+
+    start = time()
+    blocks, objects, reclaimed, waste = sweep( cache, storage,
+        int(time()) - grace, workers, threshold, options.dry_run )
+    elapsed = max(time() - start, 1e-6)
+    if options.dry_run:
+        print 'Would delete %d blocks, reclaiming %d bytes' % (blocks, reclaimed)
+    else:
+        print ( 'Deleted %d blocks (%d objects), reclaiming %d bytes in %.1f s '
+                '(%.1f objects/s, %.1f MB/s)' % (
+                blocks, objects, reclaimed, elapsed, objects/elapsed,
+                reclaimed/elapsed/1048576 ) )
+    if waste:
+        print '%d bytes of unused blocks remain in packs that are still used' % waste
+    if not options.dry_run:
+        removed = storage.cleanup(int(time()) - grace)
+        if removed:
+            info('Removed %d temporary files left by interrupted writes', removed)
+    cache.close()
+    storage.close()
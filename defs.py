@@ -1,5 +1,7 @@
 '''Definitions module.'''
 
+from time import mktime, strptime
+
 # Units available for use in the configuration files, and their value.
 UNITS = {
     'sec':          1,
@@ -23,11 +25,39 @@ UNITS = {
     'gb':  1073741824 }
 
 
+def parse_quantity(value):
+    '''Parses a number with an optional unit suffix (eg. "64kb", "5 min").
+       Raises ValueError if the value cannot be parsed.'''
+    value = value.strip().lower()
+    number = value.rstrip('abcdefghijklmnopqrstuvwxyz').strip()
+    unit   = value[len(number):].strip()
+    if unit and unit not in UNITS:
+        raise ValueError('Unknown unit: "%s"' % unit)
+    return int(float(number) * UNITS.get(unit, 1))
+
+def parse_time(value):
+    '''Parses a time given as seconds since the epoch, or as a local date of
+       the form YYYY-MM-DD, optionally followed by HH:MM or HH:MM:SS.'''
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(mktime(strptime(value, format)))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time: "%s"' % value)
+
+
 # Default storage configuration -- keys and values must be strings!
 # 'version' should be 1 for the current version
-# 'hash_function' should be either MD5 or SHA1 for now
+# 'hash_function' names the function that computes block ids (see hash.py);
+# new repositories use the one set in the [storage] section of the
+# configuration file, and repositories that do not record one use MD5
 CONFIG_DEFAULTS = {
-    'version':          '1' }
+    'version':          '1',
+    'hash_function':    'MD5' }
 
 
 # Default arguments for file matching
@@ -37,5 +67,22 @@ DEFAULT_ARGS = {
     'period':       1*UNITS['hour'],
     'compress':     'deflate',
     'level':        0,
-    'blocksize':    1*UNITS['mb'] }         # was: 64kb
+    'chunking':     'fixed',
+    'blocksize':    1*UNITS['mb'],          # was: 64kb; see tune.py
+    'minblock':     256*UNITS['kb'],
+    'maxblock':     4*UNITS['mb'],
+    'verify_moved': 0,
+    'verify_appended': 3,
+    'probe':        1 }
+
+# Extensions of file types that are (nearly) always compressed already; blocks
+# of such files are stored without trying to compress them.
+INCOMPRESSIBLE = set([
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic',
+    'mp3', 'ogg', 'oga', 'flac', 'aac', 'm4a', 'opus',
+    'mp4', 'm4v', 'mkv', 'avi', 'mov', 'webm', 'wmv', 'flv',
+    'zip', 'gz', 'tgz', 'bz2', 'tbz', 'xz', 'txz', 'lz', 'lzma', 'zst', 'z',
+    '7z', 'rar', 'jar', 'apk', 'deb', 'rpm', 'cab', 'dmg',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'odp', 'epub',
+    'gpg', 'pgp' ])
 
@@ -1,9 +1,39 @@
-import md5, sha
+'''Hash functions that compute block ids.
+
+The hash function of a repository is recorded in its configuration when the
+repository is created, and selected by init(). Block ids are the binary digests
+of these functions.
+
+All functions release the global interpreter lock while hashing a block (as
+hashlib does for data of 2 KB or more), so blocks that are hashed by different
+threads are hashed in parallel: by the hash workers of the back-up pipeline
+(see pipeline.py), and by the fetchers that check retrieved blocks.'''
+
+import hashlib
 
 def MD5(data):
-    return md5.new(data).digest()
+    return hashlib.md5(data).digest()
 
 def SHA1(data):
-    return sha.new(data).digest()
+    return hashlib.sha1(data).digest()
+
+def SHA256(data):
+    return hashlib.sha256(data).digest()
+
+functions = { 'MD5': MD5, 'SHA1': SHA1, 'SHA256': SHA256 }
+
+# BLAKE2b is part of hashlib as of Python 3.6; for earlier versions, it is
+# provided by the (optional) pyblake2 package.
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+if blake2b:
+    def BLAKE2b(data):
+        return blake2b(data, digest_size = 32).digest()
 
-functions = { 'MD5': MD5, 'SHA1': SHA1 }
+    functions['BLAKE2b-256'] = BLAKE2b
@@ -1,14 +1,23 @@
 from os import getenv
 from os.path import join
+from fcntl import flock, LOCK_EX, LOCK_NB
 from logging import debug, info, warning, error, critical, exception
 from ConfigParser import ConfigParser
 import logging
-from defs import CONFIG_DEFAULTS
+from defs import CONFIG_DEFAULTS, UNITS, parse_quantity
 from cache import Cache
+from hash import functions as hash_functions
 import storage as storage_module
 
 home = getenv('HOME')
 
+# The parsed configuration file; set by init()
+config = None
+
+# The lock file of the cache, while it is locked by init()
+cache_lock = None
+
+
 def openConfig():
     paths = [ '/usr/local/etc/backup/config', '/etc/backup/config' ]
     # Add config file in home dir
@@ -28,7 +37,59 @@ def get_with_default(self, section, option, default = None):
     else:
         return default
 
-def init(online = True):
+def setting(section, option, default = None):
+    '''Returns the value of a configuration option, or `default` if the option
+       is not set. If `default` is a boolean, the value is parsed as one
+       ("yes" or "no"); if it is an integer, the value is parsed as a
+       quantity (which may have a unit suffix, like "16mb" or "5 min").'''
+    if not config or not config.has_option(section, option):
+        return default
+    value = config.get(section, option)
+    if isinstance(default, bool):
+        if value.strip().lower() in ('yes', 'true', 'on', '1'):
+            return True
+        if value.strip().lower() in ('no', 'false', 'off', '0'):
+            return False
+        warning( 'Invalid value "%s" for option "%s" in section [%s]; '
+                 'using default (%s)', value, option, section, default )
+        return default
+    if isinstance(default, int):
+        try:
+            return parse_quantity(value)
+        except ValueError:
+            warning( 'Invalid value "%s" for option "%s" in section [%s]; '
+                     'using default (%s)', value, option, section, default )
+            return default
+    return value
+
+def configured_roots():
+    '''Returns the directories to back up listed in the configuration file.'''
+    return [ line.strip() for line in setting('backup', 'roots', '').split('\n')
+             if line.strip() ]
+
+def lock_cache(cache_path):
+    '''Takes an exclusive lock on the cache for the rest of the process.
+       Returns False if another process holds it.'''
+    global cache_lock
+    f = file(cache_path + '.lock', 'a')
+    try:
+        flock(f.fileno(), LOCK_EX | LOCK_NB)
+    except IOError:
+        f.close()
+        return False
+    cache_lock = f
+    return True
+
+def init(online = True, use_cache = True, exclusive = False):
+    '''Reads the configuration, and opens the storage (if `online` is set)
+       and the cache (if `use_cache` is set), bringing the cache up to date.
+       Returns a (cache, storage) tuple.
+
+       If `exclusive` is set, the cache is locked first (see lock_cache()),
+       so that tools that may not run alongside each other (back-ups and
+       garbage collection) cannot; if it is already locked, nothing is
+       opened.'''
+    global config
 
     # Read config file
     f = openConfig()
@@ -38,6 +99,7 @@ def init(online = True):
     cp = ConfigParser()
     cp.__class__.xget = get_with_default
     cp.readfp(f)
+    config = cp
 
     # Initialize logging
     try: log_level = int(cp.xget('logging', 'level', logging.WARNING))
@@ -75,11 +137,34 @@ def init(online = True):
             critical('Requested storage module "%s" not supported', storage_name)
             return None, None
 
+        # Configuration of a new repository
+        create_config = CONFIG_DEFAULTS.copy()
+        create_config['hash_function'] = cp.xget( 'storage', 'hash_function',
+            CONFIG_DEFAULTS['hash_function'] )
+        if create_config['hash_function'] not in hash_functions:
+            critical( 'Hash function "%s" not supported',
+                      create_config['hash_function'] )
+            return None, None
+
         storage_class  = storage_module.backends[storage_name]
         storage = storage_class( cp.xget('storage', 'connection'), \
                                  cp.xget('storage', 'username'), \
                                  cp.xget('storage', 'password'), \
-                                 CONFIG_DEFAULTS  )
+                                 create_config )
+        storage.setConnections( setting('storage', 'connections', 8),
+                                setting('storage', 'idle_timeout', 30) )
+        storage.setPackSize(setting('storage', 'pack_size', 16*UNITS['mb']))
+        storage.journal_size = setting('storage', 'journal', storage.journal_size)
+        storage.manifest_size = setting( 'storage', 'manifests',
+                                         storage.manifest_size )
+        storage.entry_objects = setting( 'storage', 'entry_objects',
+                                         storage.entry_objects )
+        if hasattr(storage, 'sync_batch'):
+            storage.sync_batch = setting('storage', 'sync_batch', storage.sync_batch)
+        if home: block_cache_path = join(home, '.backup', 'blocks')
+        else:    block_cache_path = 'blocks'
+        storage.setBlockCache( cp.xget('cache', 'blocks', block_cache_path),
+                               setting('cache', 'blocks_size', 0) )
         storage_config = storage.getConfig()
         if not storage_config:
             critical('No configuration stored in repository (invalid connection?)')
@@ -94,11 +179,28 @@ def init(online = True):
         if storage_config['version'] <> '1':
             raise "Invalid storage version: %s (expected: 1)" % storage_config['version']
 
+        # Select the hash function the repository was created with
+        hash_name = storage_config['hash_function']
+        if hash_name not in hash_functions:
+            critical('Repository uses unsupported hash function "%s"', hash_name)
+            return None, None
+        if hash_name <> create_config['hash_function']:
+            warning( 'Repository uses hash function "%s"; the configured '
+                     'function only applies to new repositories', hash_name )
+        storage.hash_function = hash_functions[hash_name]
+
+    if not use_cache:
+        return None, storage
+
     # Get cache location
     if home: cache_path = join(home, '.backup', 'cache.db')
     else:    cache_path = 'cache.db'
     cache_path = cp.xget('cache', 'path', cache_path)
 
+    if exclusive and not cache_lock and not lock_cache(cache_path):
+        critical('The cache is in use by a back-up or garbage collection')
+        return None, None
+
     try:
         cache = Cache(cache_path)
     except:
@@ -107,15 +209,24 @@ def init(online = True):
         if not online:
             info('Local cache not available; will attempt to reconstruct from remote storage')
             # Retry with online repository
-            return init(True)
+            return init(True, True, exclusive)
+
+    if cache:
+        cache.batch = setting('cache', 'batch', cache.batch)
 
     if online:
         # Check cache and storage consistency
         if cache and storage.getRevision() <> cache.getRevision():
             warning("Revision mismatch between cache and storage!")
-            cache = None
+            if cache.replay(storage):
+                info("Cache updated from the repository journal")
+            else:
+                info("Repository journal does not cover the cache revision")
+                cache.close()
+                cache = None
         if not cache:
             info("Recreating cache from remote storage...")
             cache = Cache(cache_path, storage)
+            cache.batch = setting('cache', 'batch', cache.batch)
 
     return cache, storage
@@ -0,0 +1,84 @@
+'''Minimal interface to the Linux inotify API (through ctypes).'''
+
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from os import read, close, strerror
+from os.path import join
+from struct import unpack_from, calcsize
+
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+
+IN_CLOEXEC      = 0x00080000
+IN_NONBLOCK     = 0x00000800
+
+# Events that indicate a file's contents or metadata may have changed, or that
+# a directory has appeared
+WATCH_MASK = ( IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO |
+               IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF )
+
+EVENT_HEADER = 'iIII'
+EVENT_SIZE   = calcsize(EVENT_HEADER)
+
+libc = None
+
+
+class Inotify:
+    '''An inotify instance watching a set of directories.
+
+    Raises OSError if inotify is not available.'''
+
+    def __init__(self):
+        global libc
+        if not libc:
+            libc = CDLL(find_library('c'), use_errno = True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), strerror(get_errno()))
+        self.paths = {}     # watch descriptor -> directory path
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        close(self.fd)
+
+    def watch(self, path):
+        '''Watches a directory. Raises OSError if the watch cannot be added
+           (for example, because the limit on watches has been reached).'''
+        wd = libc.inotify_add_watch(self.fd, path, WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            raise OSError(get_errno(), strerror(get_errno()), path)
+        self.paths[wd] = path
+
+    def read(self):
+        '''Returns a list of (path, mask) tuples of pending events. For events
+           on the queue itself (like IN_Q_OVERFLOW), path is None.'''
+        try:
+            data = read(self.fd, 65536)
+        except OSError:
+            return []
+        events, pos = [], 0
+        while pos + EVENT_SIZE <= len(data):
+            wd, mask, cookie, length = unpack_from(EVENT_HEADER, data, pos)
+            name = data[pos + EVENT_SIZE:pos + EVENT_SIZE + length].rstrip('\0')
+            pos += EVENT_SIZE + length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            path = self.paths.get(wd)
+            if path is not None and name:
+                path = join(path, name)
+            events.append((path, mask))
+        return events
@@ -1,12 +1,75 @@
 #!/usr/bin/env python
+'''Lists the contents of the repository, using only the local cache.
 
-from time import ctime
+Usage: list [options] [<path>]
+
+A directory (by default, /) is listed with its subdirectories, with the number
+of files below them and their total size, and with its files, with the size
+and storage time of their latest version. A file is listed with all of its
+versions, and a path with wildcards (as in rules files) lists all matching
+files. With --since or --until, the versions stored in that period (of the
+path and everything below it) are listed instead, in the order they were
+stored.
+
+All listings are answered from indices in the cache, so that their cost
+depends on the size of the result rather than on the size of the repository.
+--offset and --limit select a page of the result.'''
+
+from optparse import OptionParser
+from time import localtime, strftime
 from logging import debug, info, warning, error, critical, exception
-from compression import cidmap
+from defs import parse_quantity, parse_time
+from rules import WILDCARDS
 from init import init
 from sys import exit
 
+
+def format_time(t):
+    if t is None:
+        return '%-16s' % '-'
+    return strftime('%Y-%m-%d %H:%M', localtime(t))
+
+def format_entry(name, entry):
+    metadata = entry['metadata']
+    return '%-40s %14s  %s  version %d' % ( name, metadata.get('s', '-'),
+        format_time(metadata.get('t')), entry['version'] )
+
+def format_version(entry):
+    metadata = entry['metadata']
+    return 'version %-6d %14s  %s' % ( entry['version'], metadata.get('s', '-'),
+        format_time(metadata.get('t')) )
+
+def format_directory(name, (files, size)):
+    return '%-40s %14d  %d files' % (name + '/', size, files)
+
+
 if __name__ == '__main__':
+    parser = OptionParser(usage = 'usage: %prog [options] [<path>]')
+    parser.add_option( '-o', '--offset', type = 'int', default = 0,
+                       help = 'number of items to skip [%default]' )
+    parser.add_option( '-n', '--limit', type = 'int', default = -1,
+                       help = 'maximum number of items to list [all]' )
+    parser.add_option( '-m', '--min-size', default = '0',
+                       help = 'only list files of at least this size [%default]' )
+    parser.add_option( '--since',
+                       help = 'list the versions stored at or after this time '
+                              '(seconds since the epoch, or YYYY-MM-DD [HH:MM])' )
+    parser.add_option( '--until',
+                       help = 'list the versions stored at or before this time' )
+    options, args = parser.parse_args()
+    if len(args) > 1:
+        parser.error('more than one path given')
+    path = (args and args[0] or '/').rstrip('/') or '/'
+    try:
+        min_size = parse_quantity(options.min_size)
+        since = until = None
+        if options.since is not None:
+            since = parse_time(options.since)
+        if options.until is not None:
+            until = parse_time(options.until)
+    except ValueError, e:
+        parser.error(str(e))
+    offset, limit = max(options.offset, 0), options.limit
 
     cache, _ = init(False)
 
@@ -14,17 +77,33 @@ if __name__ == '__main__':
         print 'Sorry, no storage cache available'
         exit(1)
 
-    paths = list(cache.listEntries())
-    paths.sort()
-    for path in paths:
+    if since is not None or until is not None:
+        if path == '/':
+            path = None
+        for entry in cache.listVersionsStored( since, until, path,
+                                               offset, limit, min_size ):
+            print format_entry(entry['path'], entry)
+    elif WILDCARDS.search(path):
+        for entry in cache.listMatching(path, offset, limit, min_size):
+            print format_entry(entry['path'], entry)
+    elif cache.getLatest(path):
+        versions = cache.listVersions(path)
+        versions.reverse()
+        entries = [ cache.getEntry(path, version) for version in versions ]
+        entries = [ entry for entry in entries
+                    if entry['metadata'].get('s', 0) >= min_size ]
+        if limit >= 0: entries = entries[offset:offset + limit]
+        else:          entries = entries[offset:]
         print path
-        for version in cache.listVersions(path):
-            print "  version %d:" % version
-            entry = cache.getEntry(path)
-            print "    blocks:             %d" % len(entry['blocks'])
-            metadata = entry['metadata']
-            if 't' in metadata:
-                print "    stored at:          %s" % ctime(metadata['t'])
-            if 'm' in metadata:
-                print "    modification time:  %s" % ctime(metadata['m'])
-        print
+        for entry in entries:
+            print '  ' + format_version(entry)
+    elif cache.getDirectory(path):
+        print '%s:' % path
+        for name, item in cache.listDirectory(path, offset, limit, min_size):
+            if isinstance(item, tuple):
+                print '  ' + format_directory(name, item)
+            else:
+                print '  ' + format_entry(name, item)
+    else:
+        print '%s: not in the repository' % path
+        exit(1)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+'''Converts the repository to the current storage layout.
+
+Usage: migrate
+
+Only the storage is accessed (the local cache is neither needed nor changed),
+and the conversion may safely be restarted if it is interrupted.'''
+
+from logging import debug, info, warning, error, critical, exception
+from init import init
+from sys import exit
+
+if __name__ == '__main__':
+
+    _, storage = init(True, False)
+
+    if not storage:
+        print 'Sorry, storage not available'
+        exit(1)
+
+    if storage.migrate():
+        print 'Repository converted to the current layout'
+    else:
+        print 'Repository already uses the current layout'
+    storage.close()
@@ -0,0 +1,356 @@
+'''Block storage pipeline.
+
+Blocks read by the back-up scanner are hashed, compressed and stored by three
+pools of worker threads, so that reading the next block from disk, hashing and
+compressing blocks and uploading them to the (possibly high-latency) remote
+storage all happen concurrently. The stages are connected by bounded queues,
+so at most a fixed number of blocks is held in memory at any time.
+
+Hashed blocks return to the scanner's thread, which looks them up in the
+cache: blocks that are already stored, or that are already being stored for
+another file, are not compressed and stored again.
+
+The scanner registers a commit callback for each file, together with the jobs
+for the blocks that file depends on. Commits are run in submission order, on
+the scanner's thread, and only after all of their blocks have been stored.
+This ensures that entries never refer to blocks that do not exist remotely,
+and that the cache is only ever accessed from a single thread.'''
+
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+from time import time
+import zlib
+from logging import debug, info, warning, error, critical, exception
+from compression import compressors
+
+
+# Blocks are probed by compressing up to three samples of this size with the
+# fastest deflate level; if that saves less than PROBE_SAVING of the sample
+# size, the block is assumed to be incompressible and stored as is.
+PROBE_SAMPLE = 4096
+PROBE_SAVING = 0.05
+
+def compressible(data):
+    '''Returns whether a quick probe suggests that the data compresses.'''
+    if len(data) <= 3*PROBE_SAMPLE:
+        sample = data
+    else:
+        middle = (len(data) - PROBE_SAMPLE)/2
+        sample = ( data[:PROBE_SAMPLE] + data[middle:middle + PROBE_SAMPLE] +
+                   data[-PROBE_SAMPLE:] )
+    return len(zlib.compress(sample, 1)) < len(sample)*(1 - PROBE_SAVING)
+
+def compress_block(data, compress, level, probe = False, stats = None):
+    '''Compresses block data with the named compressor. If the compressed data
+       is not smaller than the original, the data is stored uncompressed
+       instead. If `probe` is true, data that does not appear to be
+       compressible is not compressed at all. Returns a (compressor, cdata)
+       tuple.
+
+       Raises ValueError if the compression method is not supported.'''
+
+    try:
+        compressor = compressors[compress]
+    except KeyError:
+        raise ValueError('Unsupported compression method: ' + compress)
+    if compressor is compressors['none']:
+        return compressor, compressor.compress(data)
+
+    if probe:
+        start = time()
+        skip  = not compressible(data)
+        if stats:
+            stats.probed(time() - start)
+        if skip:
+            debug('Block appears incompressible; not compressing')
+            if stats:
+                stats.skipped(compress, len(data), 'probe')
+            compressor = compressors['none']
+            return compressor, compressor.compress(data)
+
+    start = time()
+    if level: cdata = compressor.compress(data, level)
+    else:     cdata = compressor.compress(data)
+    if stats:
+        stats.compressed(compress, len(data), time() - start)
+    if len(cdata) >= len(data):
+        # Compressed version is larger than uncompressed; store as is
+        debug('Reverting to uncompressed data')
+        if stats:
+            stats.update('wasted')
+        compressor = compressors['none']
+        cdata      = compressor.compress(data)
+
+    return compressor, cdata
+
+
+class CompressionStats:
+    '''Counts the blocks that were compressed, and those that were not
+       because they were found (or known) to be incompressible. The time
+       saved is estimated from the measured throughput of each compressor.'''
+
+    def __init__(self):
+        self.lock       = Lock()
+        self.rates      = {}    # compressor name -> [bytes, seconds]
+        self.skips      = {}    # compressor name -> bytes not compressed
+        self.counts     = { 'probe': 0, 'type': 0, 'compressed': 0, 'wasted': 0 }
+        self.probe_time = 0.0
+
+    def update(self, name, value = 1):
+        self.lock.acquire()
+        try:
+            self.counts[name] += value
+        finally:
+            self.lock.release()
+
+    def compressed(self, compress, size, seconds):
+        self.lock.acquire()
+        try:
+            rate = self.rates.setdefault(compress, [0, 0.0])
+            rate[0] += size
+            rate[1] += seconds
+            self.counts['compressed'] += 1
+        finally:
+            self.lock.release()
+
+    def skipped(self, compress, size, reason):
+        self.lock.acquire()
+        try:
+            self.skips[compress] = self.skips.get(compress, 0) + size
+            self.counts[reason] += 1
+        finally:
+            self.lock.release()
+
+    def probed(self, seconds):
+        self.lock.acquire()
+        try:
+            self.probe_time += seconds
+        finally:
+            self.lock.release()
+
+    def saved(self):
+        '''Returns the estimated number of seconds of compression saved.'''
+        total = 0.0
+        for compress, size in self.skips.items():
+            done, seconds = self.rates.get(compress, (0, 0.0))
+            if done:
+                total += size*seconds/done
+        return total
+
+    def report(self):
+        '''Logs the counters.'''
+        c = self.counts
+        info( 'Compression: %d blocks compressed (%d without effect), '
+              '%d skipped by probe, %d skipped by file type; '
+              'estimated %.2f s saved, %.2f s spent probing',
+              c['compressed'], c['wasted'], c['probe'], c['type'],
+              self.saved(), self.probe_time )
+
+
+class Job:
+    '''A data block queued for storage.'''
+
+    def __init__(self, data, compress, level, probe, bypass):
+        self.hash       = None
+        self.data       = data
+        self.size       = len(data)
+        self.compress   = compress
+        self.level      = level
+        self.probe      = probe     # probe compressibility first
+        self.bypass     = bypass    # known to be incompressible
+        self.compressor = None
+        self.cdata      = None
+        self.csize      = None      # size of the stored data
+        self.location   = None
+        self.exception  = None
+        self.source     = None      # job that stores the same block, if any
+        self.stored     = False     # whether this job stores the block
+        self.dispatched = False
+        self.acked      = False
+        self.hashed     = Event()
+        self.done       = Event()
+
+    def finished(self):
+        '''Returns whether the block of the job has been stored (or found to
+           be stored already), or has failed.'''
+        return self.dispatched and (self.source or self).done.isSet()
+
+
+class Pipeline:
+    '''Hashes, compresses and stores blocks concurrently.
+
+    `stored` is called (on the submitting thread) exactly once for every job
+    that has stored its block successfully, before any commit that depends on
+    it. `known` is called (on the submitting thread as well) with the hash of
+    every block, and should return whether the block is stored already.'''
+
+    def __init__( self, storage, stored = None,
+                  compressors = 1, uploaders = 4, depth = 16,
+                  hashers = 2, known = None ):
+        self.storage        = storage
+        self.stored         = stored
+        self.known          = known
+        self.jobs           = {}    # hash -> unacknowledged job storing it
+        self.commits        = []    # (jobs, callback) in submission order
+        self.stats          = CompressionStats()
+        self.hash_queue     = Queue(max(depth, 1))
+        self.hashed_queue   = Queue()
+        self.compress_queue = Queue(max(depth, 1))
+        self.upload_queue   = Queue(max(depth, 1))
+        for i in xrange(max(hashers, 1)):
+            self.start(self.hash_worker)
+        for i in xrange(max(compressors, 1)):
+            self.start(self.compress_worker)
+        for i in xrange(max(uploaders, 1)):
+            self.start(self.upload_worker)
+
+    def start(self, target):
+        thread = Thread(target = target)
+        thread.setDaemon(True)
+        thread.start()
+
+    def pending(self, hash):
+        '''Returns whether a block with the given hash is being stored, but
+           has not been acknowledged yet.'''
+        return hash in self.jobs
+
+    def submit(self, data, compress, level, probe = False, bypass = False):
+        '''Queues a block for hashing and storage, and returns its job.
+           Blocks if the queue is full. If `probe` is true, blocks that appear
+           to be incompressible are not compressed; if `bypass` is true, the
+           block is known to be incompressible, and is never compressed.'''
+        job = Job(data, compress, level, probe, bypass)
+        self.hash_queue.put(job)
+        self.poll()
+        return job
+
+    def hashes(self, jobs):
+        '''Waits until the given jobs have been hashed, and returns their
+           hashes. Re-raises the exception of a job that could not be hashed.'''
+        for job in jobs:
+            job.hashed.wait()
+            if job.hash is None:
+                raise job.exception
+        return [ job.hash for job in jobs ]
+
+    def commit(self, jobs, callback):
+        '''Schedules `callback` to be called once all `jobs` are stored, and
+           after all previously scheduled callbacks have been called.'''
+        self.commits.append((jobs, callback))
+        self.poll()
+
+    def flush(self):
+        '''Waits until all pending jobs are stored and all commits are run.'''
+        self.poll(True)
+
+    def dispatch(self, wait = False):
+        '''Passes the jobs that have been hashed on to compression, unless
+           their block is stored already or is being stored by another job.
+           If `wait` is true, waits for at least one hashed job.'''
+        while True:
+            try:
+                job = self.hashed_queue.get(wait)
+            except Empty:
+                return
+            wait = False
+            job.dispatched = True
+            if job.exception:
+                job.done.set()
+            elif job.hash in self.jobs:
+                job.source = self.jobs[job.hash]
+                job.data   = None
+            elif self.known and self.known(job.hash):
+                job.data = None
+                job.done.set()
+            else:
+                job.stored = True
+                self.jobs[job.hash] = job
+                self.compress_queue.put(job)
+
+    def poll(self, wait = False):
+        '''Runs the commits that are ready, in order. If `wait` is true, waits
+           for all commits to become ready. Re-raises the exception of a job
+           that failed.'''
+        self.dispatch()
+        while self.commits:
+            jobs, callback = self.commits[0]
+            for job in jobs:
+                while not job.finished():
+                    if not wait:
+                        return
+                    if job.dispatched:
+                        (job.source or job).done.wait()
+                    else:
+                        self.dispatch(True)
+            del self.commits[0]
+            for job in jobs:
+                self.acknowledge(job)
+            callback()
+
+    def acknowledge(self, job):
+        if job.acked:
+            return
+        job.acked = True
+        if self.jobs.get(job.hash) is job:
+            del self.jobs[job.hash]
+        if job.source:
+            # The job storing the block may belong to a later commit; it is
+            # acknowledged first, so the block is known before it is used
+            self.acknowledge(job.source)
+        if job.exception:
+            raise job.exception
+        if job.stored and self.stored:
+            self.stored(job)
+
+
+    #
+    # Worker threads
+    #
+
+    def hash_worker(self):
+        while True:
+            job = self.hash_queue.get()
+            try:
+                # Hash functions release the interpreter lock, so blocks are
+                # hashed in parallel
+                job.hash = self.storage.hash_function(job.data)
+            except Exception, e:
+                job.exception = e
+                job.data = None
+            job.hashed.set()
+            self.hashed_queue.put(job)
+
+    def compress_worker(self):
+        while True:
+            job = self.compress_queue.get()
+            try:
+                if job.bypass:
+                    if job.compress <> 'none':
+                        self.stats.skipped(job.compress, job.size, 'type')
+                    job.compressor, job.cdata = compress_block(
+                        job.data, 'none', 0 )
+                else:
+                    job.compressor, job.cdata = compress_block(
+                        job.data, job.compress, job.level, job.probe,
+                        self.stats )
+            except Exception, e:
+                job.exception = e
+                job.data = None
+                job.done.set()
+                continue
+            job.data = None
+            self.upload_queue.put(job)
+
+    def upload_worker(self):
+        while True:
+            job = self.upload_queue.get()
+            try:
+                info( 'Storing data block with hash %s, size %d (compressed: %d)',
+                      job.hash.encode('hex'), job.size, len(job.cdata) )
+                job.location = self.storage.setBlock(
+                    job.hash, job.compressor.cid, job.cdata )
+            except Exception, e:
+                job.exception = e
+            job.csize = len(job.cdata)
+            job.cdata = None
+            job.done.set()
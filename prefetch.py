@@ -0,0 +1,142 @@
+'''Concurrent block fetcher for restoring files.
+
+Blocks are retrieved, decompressed and verified by a pool of worker threads,
+ahead of the block that is currently being written. Results are produced in
+order, and at most `window` blocks are fetched ahead, which bounds the amount
+of memory used.'''
+
+from threading import Thread, Event
+from Queue import Queue
+from collections import deque
+from time import time
+from logging import debug, info, warning, error, critical, exception
+from compression import cidmap
+
+
+class Block:
+    '''A block being fetched. When done, `data` holds the decompressed data,
+       or None if the block could not be retrieved at all; `errors` is set if
+       any error occured, and `decompressed` if the data was decompressed.'''
+
+    def __init__(self, index, hash, location):
+        self.index        = index
+        self.hash         = hash
+        self.location     = location
+        self.data         = None
+        self.stored       = 0       # size of the stored data
+        self.errors       = False
+        self.decompressed = False
+        self.done         = Event()
+
+
+class Fetcher:
+    '''Fetches blocks from `storage` with `workers` threads. `hash_function`
+       is used to verify the data of every block. If `bypass` is set, blocks
+       are always retrieved from the storage, instead of the block cache.'''
+
+    def __init__( self, storage, cache, hash_function, workers = 8, window = 32,
+                  bypass = False ):
+        self.storage       = storage
+        self.bypass        = bypass
+        self.cache         = cache
+        self.hash_function = hash_function
+        self.workers       = max(workers, 1)
+        self.window        = max(window, 1)
+        self.bytes         = 0
+
+    def fetch(self, hashes):
+        '''Yields a Block for every hash in `hashes`, in order.'''
+        queue = Queue()
+        threads = [ Thread(target = self.work, args = (queue,))
+                    for i in xrange(self.workers) ]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        start, ahead = time(), deque()
+        try:
+            hashes = iter(hashes)
+            index  = 0
+            while True:
+                # Keep the window filled
+                for hash in hashes:
+                    # The cache is only accessed from this thread
+                    block = Block(index, hash, self.cache.getBlockLocation(hash))
+                    queue.put(block)
+                    ahead.append(block)
+                    index += 1
+                    if len(ahead) >= self.window:
+                        break
+                if not ahead:
+                    break
+                block = ahead.popleft()
+                block.done.wait()
+                if block.data is not None:
+                    self.bytes += len(block.data)
+                yield block
+        finally:
+            for thread in threads:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+            elapsed = max(time() - start, 1e-6)
+            info( 'Fetched %d bytes in %.1f s (%.1f MB/s)',
+                  self.bytes, elapsed, self.bytes/elapsed/1048576 )
+
+    def work(self, queue):
+        while True:
+            block = queue.get()
+            if block is None:
+                break
+            try:
+                self.process(block)
+            except Exception, e:
+                block.errors = True
+                exception( 'Fetching block %d (hash: %s) failed',
+                           block.index, block.hash.encode('hex') )
+            block.done.set()
+
+    def process(self, block):
+        b, hash = block.index, block.hash
+        debug('Restoring block %d (hash: %s)', b, hash.encode('hex'))
+
+        # Retrieve block
+        if self.bypass:
+            stored = self.storage.fetchBlock(hash, block.location)
+        else:
+            stored = self.storage.getBlock(hash, block.location)
+        if not stored:
+            block.errors = True
+            error( 'Block %d (hash: %s) not found in repository; skipped',
+                    b, hash.encode('hex') )
+            return
+
+        # Determine compressor to use
+        cid, cdata = stored
+        block.stored = len(cdata)
+        if cid not in cidmap:
+            block.errors = True
+            error( 'Block %d (hash: %s) uses unknown compressor (cid: %s); '
+                   'assuming no compression.',
+                   b, hash.encode('hex'), cid )
+            cid = '-'
+        compressor = cidmap[cid]
+
+        # Decompress block
+        debug( 'Decompressing with compressor %s (%s)', compressor.name, cid )
+        try:
+            block.data = compressor.decompress(cdata)
+        except Exception, e:
+            block.errors = True
+            error( 'Decompressing of block %d (hash: %s) with '
+                    'compressor %s (%s) failed; error: %s',
+                    b, hash.encode('hex'), compressor.name, cid,
+                    str(e) )
+            block.data = cdata
+        else:
+            # Decompression ok; recompute hash
+            block.decompressed = True
+            data_hash = self.hash_function(block.data)
+            if hash <> data_hash:
+                block.errors = True
+                error( 'Block %d (hash: %s) failed hash check (calculated: %s)',
+                    b, hash.encode('hex'), data_hash.encode('hex') )
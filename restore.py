@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
-from time import ctime
-from sys import argv, exit
+from time import ctime, time
+from sys import argv, exit, stdout
+from tarfile import TarInfo, open as taropen, REGTYPE
+from stat import S_ISUID, S_ISGID
+from os import makedirs
+from os.path import join, dirname, basename, isdir
 from logging import debug, info, warning, error, critical, exception
-from compression import cidmap
-from init import init
+from init import init, setting
+from defs import parse_time
+from prefetch import Fetcher
 
-from md5 import new as MD5
-hash_function = lambda data: MD5(data).digest()
 
 def restore(path, destination, version = None):
     '''Restores a file from the repository.
@@ -35,7 +38,7 @@ file is stored correctly in the repository.'
         version = cached_entry['version']
 
     stored_entry = storage.getEntry(path, version)
-    if not stored_entry:
+    if not stored_entry and storage.entry_objects:
         errors = True
         error('Storage has no file "%s" with version %d', path, version)
 
@@ -60,9 +63,10 @@ file is stored correctly in the repository.'
                 metadata = entry['metadata']
                 break
     elif cached_entry:
-        warning('Continuing using cached data only')
+        if storage.entry_objects:
+            warning('Continuing using cached data only')
         entry      = cached_entry
-        metadadata = entry['metadata']
+        metadata   = entry['metadata']
         blocks     = entry['blocks']
     elif stored_entry:
         warning('Continuing using stored data only')
@@ -74,10 +78,12 @@ file is stored correctly in the repository.'
         return False
 
     info( 'Attempting to restore file "%s" version %d (%s); %d blocks',
-          path, entry['version'], ctime(metadadata.get('t'), len(blocks) )
+          path, entry['version'], ctime(metadata.get('t')), len(blocks) )
 
     # Open output file
-    if destination:
+    if destination == '-':
+        f = stdout
+    elif destination:
         f = file(destination, 'wb')
 
     # Restore metadata
@@ -87,62 +93,30 @@ file is stored correctly in the repository.'
     # TODO
 
     # Restore contents
+    fetcher = Fetcher( storage, cache, storage.hash_function,
+                       setting('restore', 'fetchers', 8),
+                       setting('restore', 'window', 32) )
     last_block_size = written = 0
-    for b in xrange(len(entry['blocks'])):
-        hash = entry['blocks'][b]
-        info('Restoring block %d (hash: %s)', b, hash.encode('hex'))
-
-        # Retrieve block
-        block = storage.getBlock(hash)
-        if not block:
+    for block in fetcher.fetch(blocks):
+        if block.errors:
             errors = True
-            error( 'Block %d (hash: %s) not found in repository; skipped',
-                    b, hash.encode('hex') )
-            f.write(last_block_size*'\0')
-            written += last_block_size
+        data = block.data
+        if data is None:
+            # Block is missing; write zeroes instead
+            data = last_block_size*'\0'
             # FIXME: truncate to filesize if this is the last block
-        else:
-
-            # Determine compressor to use
-            cid, cdata = block
-            if cid not in cidmap:
-                errors = True
-                error( 'Block %d (hash: %s) uses unknown compressor (cid: %s); '
-                       'assuming no compression.',
-                       b, hash.encode('hex'), cid )
-                cid = '-'
-            compressor = cidmap[cid]
-
-            # Decompress block
-            info( 'Decompressing with compressor %s (%s)', compressor.name, cid )
-            try:
-                data = compressor.decompress(cdata)
-            except Exception, e:
-                errors = True
-                error( 'Decompressing of block %d (hash: %s) with '
-                        'compressor %s (%s) failed; error: %s',
-                        b, hash.encode('hex'), compressor.name, cid,
-                        str(e) )
-                data = cdata
-            else:
-                # Decompression ok; recompute hash
-                data_hash = hash_function(data)
-                if hash <> data_hash:
-                    errors = True
-                    error( 'Block %d (hash: %s) failed hash check (calculated: %s)',
-                        b, hash.encode('hex'), data_hash.encode('hex') )
-
-                # Keep size of last good block as an estimate of the size of
-                # missing blocks
-                last_block_size = len(data)
+        elif block.decompressed:
+            # Keep size of last good block as an estimate of the size of
+            # missing blocks
+            last_block_size = len(data)
 
-            # Write block to disk
-            if destination:
-                info('Writing to disk')
-                f.write(data)
-                written += len(data)
+        # Write block to disk
+        if destination:
+            f.write(data)
+        written += len(data)
 
-    f.close()
+    if destination and f is not stdout:
+        f.close()
 
     # Check if filesize matches
     if 's' not in entry['metadata']:
@@ -151,13 +125,240 @@ file is stored correctly in the repository.'
         if written <> entry['metadata']['s']:
             errors = True
             error( 'Cached filesize (%d bytes) does not match actual size of '
-                   'file "%s" (%d bytes)', entry['metadata']['s'], path, size )
+                   'file "%s" (%d bytes)', entry['metadata']['s'], path, written )
 
     return not errors
 
 
+def restore_tree(prefix, destination, timestamp = None):
+    '''Restores all files at or below `prefix`, in the latest version stored
+at or before `timestamp` (or the latest version, if `timestamp` is None). The
+files are written below `destination`, at their path relative to `prefix`; if
+`destination` is None, the files are only verified.
+
+Every distinct block is retrieved from the storage only once. It is written
+where it first occurs, and copied from there (on the local disk) to every
+other place it occurs.
+
+    Raises IOError if a destination file cannot be opened or written.'''
+
+    errors = False  # set whenever an error occurs, and returned in the end
+
+    entries = cache.listEntriesAt(prefix, timestamp)
+    if not entries:
+        error('Cache has no files matching "%s"', prefix)
+        return False
+
+    # Determine the order in which blocks are first needed
+    unique, seen, total = [], set(), 0
+    for entry in entries:
+        for hash in entry['blocks']:
+            if hash not in seen:
+                seen.add(hash)
+                unique.append(hash)
+        total += entry['metadata'].get('s', 0)
+    info( 'Restoring %d files (%d bytes) with %d distinct blocks',
+          len(entries), total, len(unique) )
+
+    start   = time()
+    fetcher = Fetcher( storage, cache, storage.hash_function,
+                       setting('restore', 'fetchers', 8),
+                       setting('restore', 'window', 32) )
+    fetched = fetcher.fetch(unique)
+    written = {}    # hash -> (path, offset, size) of where it was written
+    sources = {}    # path -> file opened for copying blocks
+    last_block_size = copied = 0
+
+    for entry in entries:
+        path = entry['path']
+        if destination:
+            target = join(destination, path[len(prefix.rstrip('/')):].lstrip('/')
+                                       or basename(path))
+            if not isdir(dirname(target)):
+                makedirs(dirname(target))
+            f = file(target, 'w+b')
+        else:
+            target = f = None
+
+        offset = 0
+        for hash in entry['blocks']:
+            if hash not in written:
+                block = fetched.next()
+                if block.errors:
+                    errors = True
+                data = block.data
+                if data is None:
+                    # Block is missing; leave a hole of the estimated size
+                    size = last_block_size
+                else:
+                    size = len(data)
+                    if block.decompressed:
+                        last_block_size = size
+                    if f:
+                        f.seek(offset)
+                        f.write(data)
+                written[hash] = (target, offset, size)
+            else:
+                # Copy the block from where it was written before
+                source, source_offset, size = written[hash]
+                if f and source:
+                    if source == target:
+                        src = f
+                    else:
+                        if source not in sources:
+                            if len(sources) >= 64:
+                                for src in sources.values():
+                                    src.close()
+                                sources.clear()
+                            sources[source] = file(source, 'rb')
+                        src = sources[source]
+                    src.seek(source_offset)
+                    data = src.read(size)
+                    f.seek(offset)
+                    f.write(data)
+                copied += size
+            offset += size
+
+        if f:
+            f.truncate(offset)
+            f.close()
+        if 's' in entry['metadata'] and offset <> entry['metadata']['s']:
+            errors = True
+            error( 'Cached filesize (%d bytes) does not match actual size of '
+                   'file "%s" (%d bytes)', entry['metadata']['s'], path, offset )
+
+    fetched.close()
+    for src in sources.values():
+        src.close()
+
+    elapsed = max(time() - start, 1e-6)
+    info( 'Restored %d bytes in %.1f s (%.1f MB/s); %d bytes retrieved, '
+          '%d bytes copied locally', total, elapsed, total/elapsed/1048576,
+          fetcher.bytes, copied )
+    return not errors
+
+class BlockReader:
+    '''A file-like object reading the contents of an entry from a stream of
+       fetched blocks. Exactly the size recorded in the metadata is produced:
+       missing data is replaced by zeroes, and excess data is dropped.'''
+
+    def __init__(self, entry, blocks):
+        self.entry     = entry
+        self.blocks    = blocks
+        self.count     = len(entry['blocks'])
+        self.remaining = entry['metadata'].get('s', 0)
+        self.buffer    = ''
+        self.offset    = 0
+        self.errors    = False
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        while len(self.buffer) - self.offset < size and self.count:
+            block = self.blocks.next()
+            self.count -= 1
+            if block.errors or block.data is None:
+                self.errors = True
+            if block.data is not None:
+                self.buffer = self.buffer[self.offset:] + block.data
+                self.offset = 0
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        if len(data) < size:
+            self.errors = True
+            data += '\0'*(size - len(data))
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        # Skip the blocks that were not read
+        while self.count:
+            self.blocks.next()
+            self.count -= 1
+        if self.offset < len(self.buffer):
+            self.errors = True
+
+
+def restore_tar(prefix, output, timestamp = None):
+    '''Writes all files at or below `prefix` as a tar archive to `output`,
+in the latest version stored at or before `timestamp` (or the latest version,
+if `timestamp` is None). The archive is streamed: no more than the blocks in
+the fetch window are kept in memory, and no temporary files are written.'''
+
+    errors = False  # set whenever an error occurs, and returned in the end
+
+    entries = cache.listEntriesAt(prefix, timestamp)
+    if not entries:
+        error('Cache has no files matching "%s"', prefix)
+        return False
+
+    start   = time()
+    fetcher = Fetcher( storage, cache, storage.hash_function,
+                       setting('restore', 'fetchers', 8),
+                       setting('restore', 'window', 32) )
+    hashes  = [ hash for entry in entries for hash in entry['blocks'] ]
+    blocks  = fetcher.fetch(hashes)
+    tar     = taropen(mode = 'w|', fileobj = output)
+    total   = 0
+    for entry in entries:
+        metadata = entry['metadata']
+        member = TarInfo(entry['path'].lstrip('/'))
+        member.type  = REGTYPE
+        member.size  = metadata.get('s', 0)
+        member.mtime = metadata.get('m', 0)
+        member.uid   = metadata.get('o', 0)
+        member.gid   = metadata.get('g', 0)
+        member.mode  = metadata.get('p', 0644) & 0777
+        if metadata.get('p', 0) & 02000: member.mode |= S_ISUID
+        if metadata.get('p', 0) & 04000: member.mode |= S_ISGID
+        reader = BlockReader(entry, blocks)
+        tar.addfile(member, reader)
+        reader.close()
+        if reader.errors:
+            errors = True
+            error('File "%s" was not restored completely', entry['path'])
+        total += member.size
+    tar.close()
+    blocks.close()
+
+    elapsed = max(time() - start, 1e-6)
+    info( 'Streamed %d files (%d bytes) in %.1f s (%.1f MB/s)',
+          len(entries), total, elapsed, total/elapsed/1048576 )
+    return not errors
+
 if __name__ == '__main__':
-    if len(argv) == 3:
+    if len(argv) in (4, 5) and argv[1] == '--tree':
+        prefix, destination = argv[2:4]
+        timestamp = None
+        if len(argv) == 5:
+            try:
+                timestamp = parse_time(argv[4])
+            except ValueError, e:
+                error(str(e))
+                exit(1)
+        cache, storage = init()
+        try:
+            ok = restore_tree(prefix, destination, timestamp)
+        except IOError, e:
+            error('Can not write to destination; %s', e)
+            exit(1)
+        if storage.block_cache:
+            storage.block_cache.report()
+        exit(not ok)
+    elif len(argv) in (3, 4) and argv[1] == '--tar':
+        prefix, timestamp = argv[2], None
+        if len(argv) == 4:
+            try:
+                timestamp = parse_time(argv[3])
+            except ValueError, e:
+                error(str(e))
+                exit(1)
+        cache, storage = init()
+        ok = restore_tar(prefix, stdout, timestamp)
+        stdout.flush()
+        if storage.block_cache:
+            storage.block_cache.report()
+        exit(not ok)
+    elif len(argv) == 3 and argv[1] not in ('--tree', '--tar'):
         _, path, destination = argv
         version = None
     elif len(argv) == 4:
@@ -172,6 +373,9 @@ if __name__ == '__main__':
             exit(1)
     else:
         print 'Usage: restore <path> <destination> [<version>]'
+        print '       restore --tree <path> <destination directory> [<time>]'
+        print '       restore --tar <path> [<time>] > archive.tar'
+        print 'A destination of "-" writes the file to standard output.'
         exit(0)
 
     cache, storage = init()
@@ -181,3 +385,5 @@ if __name__ == '__main__':
     except IOError, e:
         error('Can not write to destination; %s', e)
         exit(1)
+    if storage.block_cache:
+        storage.block_cache.report()
@@ -0,0 +1,109 @@
+'''Selection of the versions to keep when purging.
+
+A retention policy keeps, for every path:
+  - the latest version (always);
+  - the `last` most recent versions;
+  - for each of the `hourly`, `daily`, `weekly` and `monthly` policies, the
+    most recent version in each of that many most recent periods in which
+    versions were stored (only periods with versions count).
+Versions without a storage time, or stored in the future, are kept as well.
+
+The versions of all paths are processed together, as flat arrays ordered by
+path and by descending version (which are loaded from the cache with a single
+query). Period numbers and the boundaries between paths and between periods
+are computed with map() over whole arrays, instead of examining the versions
+of every path one at a time.'''
+
+from array import array
+from operator import ne, or_
+from time import timezone
+
+HOUR = 3600
+DAY  = 24*HOUR
+
+def month_number(days):
+    '''Returns year*12 + month - 1 of a day number (days since 1970-01-01).'''
+    # Civil calendar computation from day numbers (proleptic Gregorian)
+    z   = days + 719468
+    era = z//146097
+    doe = z - era*146097
+    yoe = (doe - doe//1460 + doe//36524 - doe//146096)//365
+    doy = doe - (365*yoe + yoe//4 - yoe//100)
+    mp  = (5*doy + 2)//153
+    if mp < 10:
+        return (yoe + era*400)*12 + mp + 2
+    return (yoe + era*400 + 1)*12 + mp - 10
+
+# Functions mapping (local) storage times to period numbers
+PERIODS = [
+    ('hourly',  lambda t: t//HOUR),
+    ('daily',   lambda t: t//DAY),
+    ('weekly',  lambda t: (t//DAY + 3)//7),     # weeks start on Monday
+    ('monthly', lambda t: month_number(t//DAY)) ]
+
+
+class Policy:
+    '''Numbers of versions and periods to keep.'''
+
+    def __init__(self, last = 0, hourly = 0, daily = 0, weekly = 0, monthly = 0):
+        self.last    = last
+        self.hourly  = hourly
+        self.daily   = daily
+        self.weekly  = weekly
+        self.monthly = monthly
+
+    def enabled(self):
+        return bool( self.last or self.hourly or self.daily or
+                     self.weekly or self.monthly )
+
+
+def boundaries(values, starts = None):
+    '''Returns the positions at which the value differs from the previous
+       one, including the first position (and those in `starts`).'''
+    changed = map(ne, values[1:], values[:-1])
+    if starts is not None:
+        changed = map(or_, changed, starts[1:])
+    return [ 0 ] + [ i + 1 for i, c in enumerate(changed) if c ]
+
+def select(indices, times, policy, now):
+    '''Returns an array with an element per version, which is 1 for versions
+       to keep and 0 for versions to drop. `indices` and `times` are as
+       returned by Cache.listVersionTimes().'''
+    n = len(indices)
+    keep = array('b', [ 0 ])*n
+    if not n:
+        return keep
+
+    # Start positions of the versions of each path
+    path_starts = boundaries(indices)
+    is_start = array('b', [ 0 ])*n
+    for start in path_starts:
+        is_start[start] = 1
+    ends = path_starts[1:] + [ n ]
+
+    # Keep the latest and the last versions
+    count = max(policy.last, 1)
+    for start, end in zip(path_starts, ends):
+        for i in xrange(start, min(start + count, end)):
+            keep[i] = 1
+
+    # Keep versions with unknown and future times
+    unusual = map(lambda t: t < 0 or t > now, times)
+    for i in [ i for i, c in enumerate(unusual) if c ]:
+        keep[i] = 1
+
+    # Keep the most recent version of each period
+    local = map(lambda t: t - timezone, times)
+    for name, period in PERIODS:
+        limit = getattr(policy, name)
+        if not limit:
+            continue
+        numbers = map(period, local)
+        taken = 0
+        for i in boundaries(numbers, is_start):
+            if is_start[i]:
+                taken = 0
+            if taken < limit and times[i] >= 0:
+                keep[i] = 1
+                taken += 1
+    return keep
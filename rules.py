@@ -0,0 +1,196 @@
+'''File selection rules.
+
+A rules file consists of lines of the form:
+    <pattern> <name>=<value> ...
+Empty lines and lines starting with '#' are ignored. A bare name is short for
+name=1 (so "skip" means skip=1), and values may use units (as in "10 min" or
+"1mb"; see defs.UNITS), in which case they must be quoted if they contain
+spaces.
+
+A pattern without slashes is matched against the name of a file or directory;
+other patterns are matched against the full path, and must start with a slash.
+A pattern that ends with a slash only matches directories. In patterns, '*'
+matches any sequence of characters except a slash, '**' matches any sequence of
+characters, '?' matches a single character except a slash, and [...] matches
+a character class.
+
+Files and directories inherit the parameters of the directory they are in
+(starting with defs.DEFAULT_ARGS), and every matching rule then changes the
+parameters it names, in the order the rules are listed. Skipped directories
+are not walked at all.
+
+All patterns are compiled once: patterns of the form '*.ext' and patterns
+without wildcards are looked up in dictionaries, and all other patterns are
+combined into a single regular expression, so that a path that matches none of
+them is rejected with a single match. The parameters of every directory are
+computed only once.'''
+
+import re
+from shlex import split
+from os.path import basename, dirname
+from logging import debug, info, warning, error, critical, exception
+from defs import DEFAULT_ARGS, parse_quantity
+
+WILDCARDS = re.compile(r'\*\*|[*?]|\[[^]]*\]')
+
+
+def glob_to_regex(pattern):
+    '''Returns a regular expression that matches the same strings as a
+       pattern.'''
+    parts, pos = [], 0
+    for m in WILDCARDS.finditer(pattern):
+        parts.append(re.escape(pattern[pos:m.start()]))
+        token = m.group()
+        if token == '**':
+            parts.append('.*')
+        elif token == '*':
+            parts.append('[^/]*')
+        elif token == '?':
+            parts.append('[^/]')
+        else:
+            if token[1:2] == '!':
+                token = '[^' + token[2:]
+            parts.append(token)
+        pos = m.end()
+    parts.append(re.escape(pattern[pos:]))
+    return ''.join(parts)
+
+def parse_value(name, value):
+    '''Converts a parameter value to the type of its default.'''
+    if name not in DEFAULT_ARGS:
+        raise ValueError('Unknown parameter: "%s"' % name)
+    if not isinstance(DEFAULT_ARGS[name], int):
+        return value
+    if value.lower() in ('yes', 'true', 'on'):
+        return 1
+    if value.lower() in ('no', 'false', 'off'):
+        return 0
+    return parse_quantity(value)
+
+
+class Matcher:
+    '''Finds the rules whose patterns match a string.'''
+
+    def __init__(self):
+        self.literals   = {}    # string -> rule numbers
+        self.extensions = {}    # extension -> rule numbers
+        self.globs      = []    # (compiled pattern, rule number)
+        self.combined   = None
+
+    def add(self, pattern, number, names):
+        if not WILDCARDS.search(pattern):
+            self.literals.setdefault(pattern, []).append(number)
+        elif ( names and pattern.startswith('*.') and
+               not WILDCARDS.search(pattern[2:]) and '.' not in pattern[2:] ):
+            self.extensions.setdefault(pattern[2:], []).append(number)
+        else:
+            self.globs.append((glob_to_regex(pattern), number))
+
+    def compile(self):
+        if self.globs:
+            self.combined = re.compile(
+                '|'.join([ '(?:%s)' % regex for regex, number in self.globs ]) + r'\Z' )
+            self.globs = [ (re.compile(regex + r'\Z'), number)
+                           for regex, number in self.globs ]
+
+    def match(self, string, name):
+        '''Returns the numbers of the rules that match `string`. `name` is the
+           last component of the string, used to find its extension.'''
+        numbers = self.literals.get(string, [])
+        if self.extensions:
+            dot = name.rfind('.')
+            if dot > 0:
+                numbers = numbers + self.extensions.get(name[dot + 1:], [])
+        if self.combined and self.combined.match(string):
+            numbers = numbers + [ number for regex, number in self.globs
+                                  if regex.match(string) ]
+        return numbers
+
+
+class Rules:
+    '''A compiled set of rules.'''
+
+    def __init__(self, lines = []):
+        self.rules = []     # parameter dictionaries, in order
+        self.names = [ Matcher(), Matcher() ]   # for files, directories
+        self.paths = [ Matcher(), Matcher() ]
+        self.memo  = {}     # directory -> parameters
+        for number, line in enumerate(lines):
+            self.parse(line, number + 1)
+        for matcher in self.names + self.paths:
+            matcher.compile()
+
+    def parse(self, line, number):
+        '''Adds the rule on a line. Raises ValueError if it is invalid.'''
+        try:
+            words = split(line, comments = True)
+        except ValueError, e:
+            raise ValueError('Line %d: %s' % (number, e))
+        if not words:
+            return
+        pattern, settings = words[0], {}
+        for word in words[1:]:
+            name, sep, value = word.partition('=')
+            try:
+                settings[name] = parse_value(name, sep and value or '1')
+            except ValueError, e:
+                raise ValueError('Line %d: %s' % (number, e))
+
+        dirs_only = pattern.endswith('/') and len(pattern) > 1
+        if dirs_only:
+            pattern = pattern.rstrip('/')
+        if '/' in pattern and not pattern.startswith('/'):
+            raise ValueError( 'Line %d: patterns with a slash must start '
+                              'with one' % number )
+        matchers = ('/' in pattern) and self.paths or self.names
+        rule = len(self.rules)
+        self.rules.append(settings)
+        for isdir in (False, True):
+            if isdir or not dirs_only:
+                matchers[isdir].add(pattern, rule, '/' not in pattern)
+
+    def apply(self, path, isdir, args):
+        '''Returns the parameters for `path`, given the parameters `args` of
+           its directory.'''
+        name = basename(path)
+        numbers = ( self.names[isdir].match(name, name) +
+                    self.paths[isdir].match(path, name) )
+        if not numbers:
+            return args
+        args = args.copy()
+        numbers.sort()
+        for number in numbers:
+            args.update(self.rules[number])
+        return args
+
+    def directory(self, path):
+        '''Returns the parameters for a directory.'''
+        args = self.memo.get(path)
+        if args is None:
+            parent = dirname(path)
+            if parent == path:
+                args = self.apply(path, True, DEFAULT_ARGS)
+            else:
+                args = self.apply(path, True, self.directory(parent))
+            self.memo[path] = args
+        return args
+
+    def file(self, path):
+        '''Returns the parameters for a file.'''
+        return self.apply(path, False, self.directory(dirname(path)))
+
+
+def load_rules(path):
+    '''Reads a rules file. Returns an empty set of rules if `path` is None.
+
+       Raises IOError if the file cannot be read, or ValueError if it
+       contains an invalid rule.'''
+    if not path:
+        return Rules()
+    f = file(path)
+    try:
+        rules = Rules(f.readlines())
+    finally:
+        f.close()
+    info('Read %d rules from "%s"', len(rules.rules), path)
+    return rules
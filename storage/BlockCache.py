@@ -0,0 +1,207 @@
+'''Local on-disk cache of retrieved blocks.
+
+Blocks are stored in their stored (compressed) form in files named after the
+block id, spread over 256 subdirectories. Every file starts with the
+compressor id and a CRC-32 of the data, which is checked whenever the block is
+read; corrupt files are removed and treated as misses.
+
+The cache is limited to a number of bytes. When it grows beyond that, the
+least recently used blocks are removed until it is 10% below the limit. Since
+the modification time of a file is updated whenever it is used, the order is
+preserved when the cache is reopened.'''
+
+from os import listdir, stat, unlink, rename, mkdir, makedirs, utime, getpid
+from os.path import join, isdir
+from struct import pack, unpack, calcsize
+from zlib import crc32
+from threading import Lock
+from logging import debug, info, warning, error, critical, exception
+from StorageBase import SHARDS
+
+HEADER      = '>ci'
+HEADER_SIZE = calcsize(HEADER)
+
+
+class BlockCache:
+    '''A cache of at most `size` bytes of blocks in the directory `path`.'''
+
+    def __init__(self, path, size):
+        self.path  = path
+        self.size  = size
+        self.lock  = Lock()
+        self.index = None       # id -> [last use, size]; loaded on first use
+        self.adding = set()     # ids of blocks being written by put()
+        self.used  = 0          # total size of cached files
+        self.clock = 0
+        self.temp  = 0
+        self.hits = self.misses = self.hit_bytes = self.miss_bytes = 0
+        self.evictions = self.evicted_bytes = self.corrupt = 0
+
+    def get(self, id):
+        '''Returns a cached block as a (cid, data) tuple, or None.'''
+        self.lock.acquire()
+        try:
+            self.load()
+            cached = id in self.index
+            if cached:
+                self.clock += 1
+                self.index[id][0] = self.clock
+        finally:
+            self.lock.release()
+        if cached:
+            path = self.name(id)
+            try:
+                f = file(path, 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+                utime(path, None)
+            except (IOError, OSError), e:
+                # Evicted by another thread in the mean time
+                data = None
+            if data is not None:
+                if len(data) >= HEADER_SIZE:
+                    cid, crc = unpack(HEADER, data[:HEADER_SIZE])
+                    data = data[HEADER_SIZE:]
+                    if crc32(data) == crc:
+                        self.count(hits = 1, hit_bytes = len(data))
+                        return cid, data
+                warning('Cached block %s is corrupt; removed', id.encode('hex'))
+                self.count(corrupt = 1)
+                self.discard(id)
+        self.count(misses = 1)
+        return None
+
+    def put(self, id, cid, data):
+        '''Adds a block that was retrieved from the storage.'''
+        self.count(miss_bytes = len(data))
+        if HEADER_SIZE + len(data) > self.size:
+            return
+        self.lock.acquire()
+        try:
+            self.load()
+            if id in self.index or id in self.adding:
+                return
+            self.adding.add(id)
+            self.temp += 1
+            temp = join(self.path, '.tmp-%d-%d' % (getpid(), self.temp))
+        finally:
+            self.lock.release()
+
+        try:
+            f = file(temp, 'wb')
+            try:
+                f.write(pack(HEADER, cid, crc32(data)))
+                f.write(data)
+            finally:
+                f.close()
+            rename(temp, self.name(id))
+        except (IOError, OSError), e:
+            warning('Could not add block to the block cache: %s', e)
+            self.lock.acquire()
+            try:
+                self.adding.discard(id)
+            finally:
+                self.lock.release()
+            return
+
+        self.lock.acquire()
+        try:
+            self.adding.discard(id)
+            self.clock += 1
+            self.index[id] = [ self.clock, HEADER_SIZE + len(data) ]
+            self.used += HEADER_SIZE + len(data)
+            if self.used > self.size:
+                self.evict(self.size*9/10)
+        finally:
+            self.lock.release()
+
+    def discard(self, id):
+        '''Removes a block from the cache, if it is cached.'''
+        self.lock.acquire()
+        try:
+            self.load()
+            entry = self.index.pop(id, None)
+            if entry:
+                self.used -= entry[1]
+        finally:
+            self.lock.release()
+        if entry:
+            try:
+                unlink(self.name(id))
+            except OSError:
+                pass
+
+    def report(self):
+        '''Logs the cache counters.'''
+        info( 'Block cache: %d hits (%d bytes), %d misses (%d bytes), '
+              '%d evictions (%d bytes), %d corrupt; %d bytes used',
+              self.hits, self.hit_bytes, self.misses, self.miss_bytes,
+              self.evictions, self.evicted_bytes, self.corrupt, self.used )
+
+
+    #
+    # Internal implementation follows
+    #
+
+    def name(self, id):
+        hex = id.encode('hex')
+        return join(self.path, hex[:2], hex)
+
+    def count(self, **counters):
+        self.lock.acquire()
+        try:
+            for name in counters:
+                setattr(self, name, getattr(self, name) + counters[name])
+        finally:
+            self.lock.release()
+
+    def load(self):
+        '''Reads the contents of the cache directory. Must be called with the
+           lock held.'''
+        if self.index is not None:
+            return
+        if not isdir(self.path):
+            makedirs(self.path)
+        files = []
+        for dir in SHARDS:
+            dir = join(self.path, dir)
+            if not isdir(dir):
+                mkdir(dir)
+                continue
+            for name in listdir(dir):
+                try:
+                    st = stat(join(dir, name))
+                    files.append((st.st_mtime, name.decode('hex'), st.st_size))
+                except (OSError, TypeError):
+                    pass
+        for name in listdir(self.path):
+            if name.startswith('.tmp-'):
+                unlink(join(self.path, name))
+        files.sort()
+        self.index = {}
+        for mtime, id, size in files:
+            self.clock += 1
+            self.index[id] = [ self.clock, size ]
+            self.used += size
+        debug('Block cache holds %d blocks (%d bytes)', len(files), self.used)
+        if self.used > self.size:
+            self.evict(self.size*9/10)
+
+    def evict(self, target):
+        '''Removes the least recently used blocks, until at most `target`
+           bytes are used. Must be called with the lock held.'''
+        entries = [ (last, size, id) for id, (last, size) in self.index.items() ]
+        entries.sort()
+        for last, size, id in entries:
+            if self.used <= target:
+                break
+            del self.index[id]
+            self.used -= size
+            self.evictions += 1
+            self.evicted_bytes += size
+            try:
+                unlink(self.name(id))
+            except OSError:
+                pass
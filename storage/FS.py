@@ -4,32 +4,69 @@ Stores data and metadata in a filesystem directory.
 
 The connection string should be an (absolute) path to a directory,
     eg. "/var/db/my-storage"
-When the storage is first created, this directory should not yet exist.'''
+When the storage is first created, this directory should not yet exist.
 
-from StorageBase import StorageBase
-from os import listdir, unlink, rmdir, mkdir
-from os.path import pathsep, join, isdir
+Objects are spread over 256 subdirectories (named after a hash of the key),
+so that directories stay small enough to be listed and searched quickly.
+Repositories created with the older flat layout (which is recognized by the
+absence of a ".layout" file) can still be used, and can be converted with
+migrate().
+
+Objects are written to a temporary file that is renamed into place, so an
+object is either stored completely or not at all. Renames are deferred until
+a batch of objects has been written, so that the whole batch is made durable
+with a single sync of the file system (instead of an fsync per object).
+Temporary files left behind by a crash are removed by cleanup().'''
+
+from StorageBase import StorageBase, shard, SHARDS
+from os import listdir, unlink, rmdir, mkdir, rename, fsync, stat, fstat, \
+               lstat, \
+               open as os_open, read as os_read, write as os_write, \
+               close as os_close, \
+               O_RDONLY, O_WRONLY, O_CREAT, O_EXCL
+from os.path import join, isdir, exists
+from mmap import mmap, PROT_READ, MAP_SHARED
+from errno import ENOENT
+from random import getrandbits
+from threading import Lock
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
 from base64 import urlsafe_b64encode as encode_key, urlsafe_b64decode as decode_key
+from logging import debug, info, warning, error, critical, exception
+
+libc = None
+
 
 class StorageFS (StorageBase):
     '''The storage class
 
     May raise IOError or OSError.'''
 
+    # Number of objects written before they are made durable and renamed
+    # into place; if 0, objects are renamed immediately and never synced.
+    sync_batch = 256
+
     def __init__(self, path, _username, _password, create_config = None):
-        self.path = path
+        self.path      = path
+        self.pending   = {}     # key -> temporary file not yet renamed
+        self.lock      = Lock()
+        self.sync_lock = Lock()
         if not isdir(path):
             if not create_config:
                 raise Exception('path does not exist, and no configuration specified')
             mkdir(path)
+            for name in SHARDS:
+                mkdir(join(path, name))
+            self.write(join(path, '.layout'), 'sharded\n')
+            self.sharded = True
             self.setConfig(create_config)
             self.setRevision(0)
+        else:
+            self.sharded = exists(join(path, '.layout'))
 
     def close(self):
-        '''Disconnects from the repository and cleans up.
-
-        To be implemented in subclasses.'''
-        raise MissingImplementation(self.close)
+        '''Makes all stored objects durable.'''
+        self.sync()
 
     def destroy(self):
         '''Completely erases the repository and all of its contents.
@@ -37,32 +74,287 @@ class StorageFS (StorageBase):
 
         for key in self.list():
             self.delete(key)
-        unlink(self.path)
+        if self.sharded:
+            for name in SHARDS:
+                rmdir(join(self.path, name))
+            unlink(join(self.path, '.layout'))
+        rmdir(self.path)
 
     def list(self):
         '''Returns a listing of object keys.'''
-        for name in listdir(self.path):
-            yield decode_key(name)
+        if self.sharded:
+            dirs = [ join(self.path, name) for name in SHARDS ]
+        else:
+            dirs = [ self.path ]
+        listed = set()
+        for dir in dirs:
+            for name in listdir(dir):
+                if name[0] <> '.' and name not in SHARDS:
+                    key = decode_key(name)
+                    listed.add(key)
+                    yield key
+        self.lock.acquire()
+        try:
+            pending = [ key for key in self.pending if key not in listed ]
+        finally:
+            self.lock.release()
+        for key in pending:
+            yield key
+
+    def listInfo(self):
+        for key in self.list():
+            try:
+                size = stat(self.name(key)).st_size
+            except OSError, e:
+                if e.errno <> ENOENT:
+                    raise
+                # Not renamed into place yet
+                fd = self.open(key)
+                if fd is None:
+                    continue
+                try:
+                    size = fstat(fd).st_size
+                finally:
+                    os_close(fd)
+            yield key, size, None
 
     def store(self, key, value):
         '''Stores an object with the given key and value.'''
-        file(join(self.path, encode_key(key)), 'wb').write(value)
+        path = self.name(key)
+        temp = join(path[:path.rfind('/')], '.tmp-%016x' % getrandbits(64))
+        self.write(temp, value)
+        if not self.sync_batch:
+            rename(temp, path)
+            return
+        self.lock.acquire()
+        try:
+            replaced = self.pending.get(key)
+            self.pending[key] = temp
+            full = len(self.pending) >= self.sync_batch
+        finally:
+            self.lock.release()
+        if replaced:
+            self.remove(replaced)
+        if full:
+            self.sync()
 
     def retrieve(self, key):
         '''Retrieves the value of the object with the given key, or
            returns None if no such object exists.'''
+        fd = self.open(key)
+        if fd is None:
+            return None
         try:
-            f = file(join(self.path, encode_key(key)), 'rb')
-        except IOError:
+            # A single read of the known size avoids the buffering and
+            # repeated reallocation of file objects
+            size = fstat(fd).st_size
+            data = os_read(fd, size)
+            while len(data) < size:
+                more = os_read(fd, size - len(data))
+                if not more:
+                    break
+                data += more
+            return data
+        finally:
+            os_close(fd)
+
+    def retrieveRange(self, key, offset, length):
+        '''Retrieves part of the value of the object with the given key, or
+           returns None if no such object exists.'''
+        fd = self.open(key)
+        if fd is None:
             return None
-        return f.read()
+        try:
+            size = fstat(fd).st_size
+            if offset >= size or length <= 0:
+                return ''
+            # Blocks are sliced directly from the page cache
+            m = mmap(fd, size, MAP_SHARED, PROT_READ)
+            try:
+                return m[offset:offset + length]
+            finally:
+                m.close()
+        finally:
+            os_close(fd)
 
     def delete(self, key):
         '''Deletes the object with the given key, if it exists.'''
+        self.lock.acquire()
         try:
-            unlink(join(self.path, encode_key(key)))
+            temp = self.pending.pop(key, None)
+        finally:
+            self.lock.release()
+        if temp:
+            self.remove(temp)
+        self.remove(self.name(key))
+
+    def deleteMany(self, keys, workers = 8):
+        # Removing local files does not benefit from concurrency
+        for key in keys:
+            self.delete(key)
+
+    def sync(self):
+        '''Makes all written objects durable, and renames them into place.'''
+        self.sync_lock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                batch = self.pending.items()
+            finally:
+                self.lock.release()
+            if not batch:
+                return
+
+            # The data must be durable before the renames, and the renames
+            # before the objects are referred to.
+            if not self.syncfs():
+                for key, temp in batch:
+                    self.fsync(temp)
+            dirs = set()
+            for key, temp in batch:
+                try:
+                    rename(temp, self.name(key))
+                except OSError, e:
+                    # Replaced or deleted in the mean time
+                    if e.errno <> ENOENT:
+                        raise
+                dirs.add(temp[:temp.rfind('/')])
+            if not self.syncfs():
+                for dir in dirs:
+                    self.fsync(dir)
+
+            self.lock.acquire()
+            try:
+                for key, temp in batch:
+                    if self.pending.get(key) == temp:
+                        del self.pending[key]
+            finally:
+                self.lock.release()
+            debug('Synced %d objects', len(batch))
+        finally:
+            self.sync_lock.release()
+
+    def cleanup(self, before):
+        '''Removes the temporary files that were last written before time
+           `before` and are not pending in this session.'''
+        if self.sharded:
+            dirs = [ join(self.path, name) for name in SHARDS ]
+        else:
+            dirs = [ self.path ]
+        self.lock.acquire()
+        try:
+            pending = set(self.pending.values())
+        finally:
+            self.lock.release()
+        removed = 0
+        for dir in dirs:
+            for name in listdir(dir):
+                path = join(dir, name)
+                if not name.startswith('.tmp-') or path in pending:
+                    continue
+                try:
+                    if lstat(path).st_mtime >= before:
+                        # May still be written by another session
+                        continue
+                except OSError, e:
+                    if e.errno <> ENOENT:
+                        raise
+                    continue
+                self.remove(path)
+                removed += 1
+        return removed
+
+    def migrate(self):
+        '''Moves the objects of a repository with the flat layout into
+           subdirectories. May be resumed if it is interrupted.'''
+        if self.sharded:
+            return False
+        for name in SHARDS:
+            if not isdir(join(self.path, name)):
+                mkdir(join(self.path, name))
+        moved = 0
+        for name in listdir(self.path):
+            if name[0] <> '.' and name not in SHARDS:
+                rename( join(self.path, name),
+                        join(self.path, shard(decode_key(name)), name) )
+                moved += 1
+        info('Moved %d objects into subdirectories', moved)
+        if not self.syncfs():
+            self.fsync(self.path)
+            for name in SHARDS:
+                self.fsync(join(self.path, name))
+        self.write(join(self.path, '.layout'), 'sharded\n')
+        self.sharded = True
+        return True
+
+
+    #
+    # Internal implementation follows
+    #
+
+    def name(self, key):
+        '''Returns the file name of the object with the given key.'''
+        if self.sharded:
+            return join(self.path, shard(key), encode_key(key))
+        return join(self.path, encode_key(key))
+
+    def open(self, key):
+        '''Returns a file descriptor for the object with the given key, or
+           None if no such object exists.'''
+        self.lock.acquire()
+        try:
+            temp = self.pending.get(key)
+        finally:
+            self.lock.release()
+        for path in (temp, self.name(key)):
+            if path:
+                try:
+                    return os_open(path, O_RDONLY)
+                except OSError, e:
+                    # The temporary file may have been renamed meanwhile
+                    if e.errno <> ENOENT:
+                        raise
+        return None
+
+    def write(self, path, data):
+        fd = os_open(path, O_WRONLY | O_CREAT | O_EXCL, 0666)
+        try:
+            written = 0
+            while written < len(data):
+                written += os_write(fd, buffer(data, written))
+        finally:
+            os_close(fd)
+
+    def remove(self, path):
+        try:
+            unlink(path)
         except OSError, e:
-            # FIXME: use a platform-dependent constant instead of 2
-            if e.errno <> 2:
-                raise e
+            if e.errno <> ENOENT:
+                raise
+
+    def fsync(self, path):
+        fd = os_open(path, O_RDONLY)
+        try:
+            fsync(fd)
+        finally:
+            os_close(fd)
+
+    def syncfs(self):
+        '''Flushes the entire file system containing the repository with a
+           single syncfs() call. Returns False if that is not available.'''
+        global libc
+        if libc is None:
+            try:
+                libc = CDLL(find_library('c'), use_errno = True)
+                libc.syncfs
+            except (OSError, AttributeError):
+                libc = False
+        if not libc:
+            return False
+        fd = os_open(self.path, O_RDONLY)
+        try:
+            if libc.syncfs(fd) <> 0:
+                raise OSError(get_errno(), 'syncfs failed', self.path)
+        finally:
+            os_close(fd)
         return True
@@ -9,70 +9,316 @@ empty. Note that in the url "ftp://hostname/path/" 'path' specifies a path
 relative to the working directory assigned by the server upon connection,
 while "ftp://hostname//path/" specifies an absolute directory.
 
+Objects are spread over 256 subdirectories of the repository directory (named
+after a hash of the key), since many servers handle directories with very
+many files badly. Repositories created with the older flat layout (which is
+recognized by the absence of a ".layout" file) can still be used, and can be
+converted with migrate().
+
+Several FTP sessions are kept open, so that objects can be stored and
+retrieved concurrently, and subdirectories can be listed in parallel.
 '''
-from ftplib import FTP, error_perm
+from ftplib import FTP, error_perm, error_temp, error_reply
+from socket import error as SocketError
 from base64 import urlsafe_b64encode as encode_key, urlsafe_b64decode as decode_key
 from StringIO import StringIO
-from StorageBase import StorageBase
+from threading import Thread
+from Queue import Queue
+from logging import debug, info, warning, error, critical, exception
+from StorageBase import StorageBase, shard, SHARDS, run_concurrently
+from Pool import ConnectionPool
+
+# Errors that indicate that a session is no longer usable
+SESSION_ERRORS = (error_temp, error_reply, EOFError, SocketError)
+
+def basename(name):
+    # Some servers return listed names with the directory prefixed
+    return name[name.rfind('/') + 1:]
+
+def nlst(conn, dir):
+    '''Returns the names in a directory.'''
+    try:
+        return conn.nlst(dir)
+    except error_perm, e:
+        if str(e).startswith('550'):
+            # Many servers report an empty directory as an error
+            return []
+        raise
+
+def finish_aborted(conn):
+    '''Brings a session back in step after the data connection of a transfer
+       was closed before its end. Servers send a varying number of replies
+       to an aborted transfer and to ABOR, so a NOOP is sent after it and
+       replies are read until the one to the NOOP. Returns whether the
+       session may be reused.'''
+    try:
+        conn.putcmd('ABOR')
+        conn.putcmd('NOOP')
+        for i in range(4):
+            if conn.getmultiline().startswith('200'):
+                return True
+    except SESSION_ERRORS:
+        pass
+    return False
+
 
 class StorageFTP (StorageBase):
     '''The storage class'''
 
     def __init__(self, url, user, passw, create_config = None):
         if len(url) < 8 or url[:6] <> 'ftp://' or url[-1] <> '/':
-            raise 'Invalid FTP URL: "%s"' % url
+            raise ValueError('Invalid FTP URL: "%s"' % url)
         sep      = url.find('/', 6)
         hostname = url[6:sep]
         path     = url[sep + 1:-1]
         if path == '':
-            raise 'Empty repository path'
-
-        self.conn = FTP(hostname, user, passw)
+            raise ValueError('Empty repository path')
+        self.hostname, self.user, self.passw = hostname, user, passw
+        self.path    = path
+        self.sharded = False
 
         created = False
-        if create_config:
-            try:
-                self.conn.mkd(path)
-                created = True
-            except:
-                pass
+        conn = FTP(hostname, user, passw)
+        try:
+            if create_config:
+                try:
+                    conn.mkd(path)
+                    created = True
+                except error_perm:
+                    pass
+            conn.cwd(path)
+            if created:
+                # Create new repository
+                conn.storbinary('STOR .keep', StringIO(''))
+                for name in SHARDS:
+                    conn.mkd(name)
+                conn.storbinary('STOR .layout', StringIO('sharded\n'))
+        finally:
+            conn.quit()
 
-        self.conn.cwd(path)
+        self.pool    = ConnectionPool(self.connect)
+        self.sharded = self.run(self.readLayout)
         if created:
-            # Create new repository
-            self.conn.storbinary('STOR .keep', StringIO(''))
             self.setConfig(create_config)
             self.setRevision(0)
 
     def close(self):
-        self.conn.quit()
+        self.pool.close()
+
+    def setConnections(self, count, timeout):
+        self.pool.size    = count
+        self.pool.timeout = timeout
 
-    def destroy():
+    def destroy(self):
         '''Completely erases the repository and all of its contents.
            Use with caution!'''
         for key in self.list():
-            self.delFile(key)
-        self.conn.delete('.keep')
-        self.conn.rmd(path)
+            self.delete(key)
+        def remove(conn):
+            if self.sharded:
+                for name in SHARDS:
+                    conn.rmd(name)
+                conn.delete('.layout')
+            conn.delete('.keep')
+            conn.cwd('..')
+            conn.rmd(self.path.split('/')[-1])
+        self.run(remove)
+        self.pool.close()
 
     def list(self):
-        for name in self.conn.nlst('.'):
-            if name and name[0] <> '.':
-                yield decode_key(name)
+        for name, size in self.listDirectories(
+                lambda conn, dir: [ (name, None) for name in nlst(conn, dir) ] ):
+            yield decode_key(name)
+
+    def listInfo(self):
+        for name, size in self.listDirectories(self.listSizes):
+            yield decode_key(name), size, None
 
     def store(self, key, value):
-        self.conn.storbinary('STOR ' + encode_key(key), StringIO(value))
+        self.run(lambda conn:
+            conn.storbinary('STOR ' + self.name(key), StringIO(value)) )
 
     def retrieve(self, key):
-        f = StringIO()
+        def retrieve(conn):
+            f = StringIO()
+            try:
+                conn.retrbinary('RETR ' + self.name(key), f.write)
+                return f.getvalue()
+            except error_perm, e:
+                if str(e).startswith('550'):
+                    # File not found (or access denied :/)
+                    return None
+                raise
+        return self.run(retrieve)
+
+    def retrieveRange(self, key, offset, length):
+        def retrieve(conn):
+            # The offset (REST) is only meaningful for binary transfers
+            conn.voidcmd('TYPE I')
+            try:
+                sock = conn.transfercmd('RETR ' + self.name(key), offset)
+            except error_perm, e:
+                if str(e).startswith('550'):
+                    return None
+                raise
+            parts, remaining = [], length
+            while remaining > 0:
+                data = sock.recv(min(remaining, 65536))
+                if not data:
+                    break
+                parts.append(data)
+                remaining -= len(data)
+            sock.close()
+            if remaining > 0:
+                # The whole object was read
+                conn.voidresp()
+            elif not finish_aborted(conn):
+                conn.unusable = True
+            return ''.join(parts)
+        return self.run(retrieve)
+
+    def delete(self, key):
+        def delete(conn):
+            try:
+                conn.delete(self.name(key))
+            except error_perm, e:
+                if not str(e).startswith('550'):
+                    raise
+                # Not found; objects such as entries may not exist
+        self.run(delete)
+
+    def migrate(self):
+        '''Moves the objects of a repository with the flat layout into
+           subdirectories. May be resumed if it is interrupted.'''
+        if self.sharded:
+            return False
+        def prepare(conn):
+            existing = set(map(basename, conn.nlst('.')))
+            for name in SHARDS:
+                if name not in existing:
+                    conn.mkd(name)
+            return [ name for name in existing
+                     if name and name[0] <> '.' and name not in SHARDS ]
+        names = self.run(prepare)
+        info('Moving %d objects into subdirectories', len(names))
+
+        def move(name):
+            self.run(lambda conn:
+                conn.rename(name, shard(decode_key(name)) + '/' + name) )
+        # Raises the first error once all renames have finished; the layout
+        # is only marked as sharded if every object was moved
+        run_concurrently(move, names, max(self.pool.size, 1))
+
+        self.run(lambda conn: conn.storbinary('STOR .layout', StringIO('sharded\n')))
+        self.sharded = True
+        return True
+
+
+    #
+    # Internal implementation follows
+    #
+
+    def connect(self):
+        conn = FTP(self.hostname, self.user, self.passw)
+        conn.cwd(self.path)
+        return conn
+
+    def run(self, operation):
+        '''Calls `operation` with a session from the pool, and returns its
+           result. If a reused session turns out to be unusable (for example,
+           because the server closed it), the operation is retried on a new
+           session.'''
+        while True:
+            conn, reused = self.pool.get()
+            try:
+                result = operation(conn)
+            except SESSION_ERRORS, e:
+                self.pool.discard(conn)
+                if reused:
+                    debug('Reconnecting after error on reused session: %s', e)
+                    continue
+                raise
+            except:
+                self.putSession(conn)
+                raise
+            self.putSession(conn)
+            return result
+
+    def putSession(self, conn):
+        # Returns a session to the pool, unless it was left in an unknown state
+        if getattr(conn, 'unusable', False):
+            self.pool.discard(conn)
+        else:
+            self.pool.put(conn)
+
+    def listDirectories(self, listing):
+        '''Returns the (name, size) tuples returned by `listing` for the
+           repository directory (or all of its subdirectories, which are listed
+           in parallel), except for names that start with a dot.'''
+        if not self.sharded:
+            dirs = [ '.' ]
+        else:
+            dirs = SHARDS
+        results = Queue()
+        queue   = Queue()
+        for dir in dirs:
+            queue.put(dir)
+        def work():
+            while True:
+                try:
+                    dir = queue.get_nowait()
+                except:
+                    return
+                try:
+                    results.put(self.run(lambda conn: listing(conn, dir)))
+                except Exception, e:
+                    results.put(e)
+        for i in xrange(max(min(self.pool.size, len(dirs)), 1)):
+            thread = Thread(target = work)
+            thread.setDaemon(True)
+            thread.start()
+        for i in xrange(len(dirs)):
+            listed = results.get()
+            if isinstance(listed, Exception):
+                raise listed
+            for name, size in listed:
+                name = basename(name)
+                if name and name[0] <> '.':
+                    yield name, size
+
+    def listSizes(self, conn, dir):
+        '''Returns a list of (name, size) tuples of the files in a directory.
+           Uses a single MLSD command if the server supports it, and a SIZE
+           command per file otherwise.'''
+        lines = []
         try:
-            self.conn.retrbinary('RETR ' + encode_key(key), f.write)
-            return f.getvalue()
+            conn.retrlines('MLSD ' + dir, lines.append)
         except error_perm, e:
-            if str(e).startswith('550'):
-                # File not found (or access denied :/)
-                return None
-            raise
+            if not str(e)[:3] in ('500', '501', '502', '504'):
+                raise
+            conn.voidcmd('TYPE I')
+            return [ (name, conn.size(dir + '/' + basename(name)))
+                     for name in nlst(conn, dir) if basename(name)[:1] <> '.' ]
+        listed = []
+        for line in lines:
+            facts, sep, name = line.partition(' ')
+            # Fact names are case-insensitive
+            facts = dict([ fact.lower().split('=', 1)
+                           for fact in facts.split(';') if '=' in fact ])
+            if facts.get('type') == 'file' and 'size' in facts:
+                listed.append((name, int(facts['size'])))
+        return listed
 
-    def delete(self, key):
-        self.conn.delete(encode_key(key))
+    def readLayout(self, conn):
+        f = StringIO()
+        try:
+            conn.retrbinary('RETR .layout', f.write)
+        except error_perm:
+            return False
+        return f.getvalue().strip() == 'sharded'
+
+    def name(self, key):
+        '''Returns the file name of the object with the given key.'''
+        if self.sharded:
+            return shard(key) + '/' + encode_key(key)
+        return encode_key(key)
@@ -0,0 +1,80 @@
+'''Connection pool shared by storage modules that keep persistent connections.
+
+Connections must have a close() method.'''
+
+from threading import Lock, Condition
+from time import time as now
+
+
+class ConnectionPool:
+    '''A pool of persistent connections, created by calling `connect`.
+
+    At most `size` connections are in use at the same time; further requests
+    wait until a connection is returned. Connections that have been idle for
+    more than `timeout` seconds are closed instead of reused.'''
+
+    def __init__(self, connect, size = 8, timeout = 30):
+        self.connect   = connect
+        self.size      = size
+        self.timeout   = timeout
+        self.idle      = []     # (connection, time returned)
+        self.active    = 0
+        self.condition = Condition(Lock())
+
+    def get(self):
+        '''Returns a (connection, reused) tuple, where `reused` indicates
+           whether the connection has been used before.'''
+        self.condition.acquire()
+        try:
+            while self.active >= max(self.size, 1):
+                self.condition.wait()
+            self.active += 1
+            while self.idle:
+                conn, last_used = self.idle.pop()
+                if now() - last_used < self.timeout:
+                    return conn, True
+                conn.close()
+        finally:
+            self.condition.release()
+        try:
+            return self.connect(), False
+        except:
+            self.condition.acquire()
+            try:
+                self.release()
+            finally:
+                self.condition.release()
+            raise
+
+    def put(self, conn):
+        '''Returns a connection that may be reused.'''
+        self.condition.acquire()
+        try:
+            self.idle.append((conn, now()))
+            self.release()
+        finally:
+            self.condition.release()
+
+    def discard(self, conn):
+        '''Closes a connection that may not be reused.'''
+        conn.close()
+        self.condition.acquire()
+        try:
+            self.release()
+        finally:
+            self.condition.release()
+
+    def close(self):
+        '''Closes all idle connections.'''
+        self.condition.acquire()
+        try:
+            for conn, last_used in self.idle:
+                conn.close()
+            self.idle = []
+        finally:
+            self.condition.release()
+
+    def release(self):
+        # Must be called with the lock held
+        self.active -= 1
+        self.condition.notify()
@@ -10,6 +10,8 @@ Storage:
     blocks are stored under path/d<HASH>, where HASH is URL-safe base64-encoded.
     Metadata consists of 'cid'; the compression algorithm used.
 
+Requests are sent over persistent (keep-alive) connections, taken from a pool
+that is shared by all threads, so the storage may be used concurrently.
 '''
 
 from logging import debug, info, warning, error, critical, exception
@@ -18,14 +20,22 @@ from hmac import new as HMAC
 import sha
 from time import time as now, gmtime, strftime
 from urllib import quote as urlencode, unquote as urldecode
-from httplib import HTTPConnection
+from httplib import HTTPConnection, HTTPException
+from socket import error as SocketError, IPPROTO_TCP, TCP_NODELAY
+from Pool import ConnectionPool
 from xml.dom.minidom import parseString
+from xml.sax.saxutils import escape
 from base64 import urlsafe_b64encode as encode_key, urlsafe_b64decode as decode_key
-from StorageBase import StorageBase
+from StorageBase import StorageBase, run_concurrently
 
-def date_string(time = now()):
+# Maximum number of objects deleted by a single request
+DELETE_BATCH = 1000
+
+def date_string(time = None):
     "Constructs an RFC 822-compliant date string"
 
+    if time is None:
+        time = now()
     return strftime("%a, %d %b %Y %H:%M:%S GMT", gmtime(time))
 
 
@@ -54,6 +64,13 @@ class S3Error(Exception):
         return "%d %s: %s" % (self.status, self.reason, self.message)
 
 
+def text(elem, name):
+    "Returns the text of the first child element with the given name."
+    nodes = elem.getElementsByTagName(name)
+    if nodes and nodes[0].firstChild:
+        return nodes[0].firstChild.data
+    return ''
+
 def raiseOnFailure(response):
     "Raises an S3Error if the response status is not 2xx."
 
@@ -67,6 +84,19 @@ def raiseOnFailure(response):
         raise S3Error(response.status, response.reason, error, message)
 
 
+class Response:
+    "A HTTP response that has been read completely."
+
+    def __init__(self, response):
+        self.status  = response.status
+        self.reason  = response.reason
+        self.headers = dict(response.getheaders())
+        self.body    = response.read()
+
+    def read(self):
+        return self.body
+
+
 class StorageS3 (StorageBase):
     '''The storage class'''
 
@@ -89,13 +119,14 @@ class StorageS3 (StorageBase):
 
         self.access_id  = access_id
         self.access_key = access_key
+        self.pool       = ConnectionPool(self.connect)
 
         # Create bucket (in case it didn't exist)
         raiseOnFailure(self.execute('PUT', '/' + self.bucket))
 
         # Check for existence of marker
         data = self.getObject('')
-        if data:
+        if not data:
             if not create_config:
                 raise "Repository not found, and no configuration specified"
 
@@ -106,7 +137,11 @@ class StorageS3 (StorageBase):
             self.putObject('', '-')
 
     def close(self):
-        pass
+        self.pool.close()
+
+    def setConnections(self, count, timeout):
+        self.pool.size    = count
+        self.pool.timeout = timeout
 
     def destroy(self):
         for key in self.list():
@@ -117,33 +152,64 @@ class StorageS3 (StorageBase):
         # not empty; TODO: check for real error condition
 
     def list(self):
-        for name in self.listObjects('d'):
+        for name in self.listObjects():
             key = decode_key(name)
             if key:
                 yield key
 
+    def listInfo(self):
+        for name, size, etag in self.listObjects(details = True):
+            key = decode_key(name)
+            if key:
+                # The ETag of an object stored with a single request is the
+                # MD5 digest of its value
+                if len(etag) <> 32:
+                    etag = None
+                yield key, size, etag
+
     def store(self, key, value):
         return self.putObject(encode_key(key), value)
 
     def retrieve(self, key):
         return self.getObject(encode_key(key))
 
+    def retrieveRange(self, key, offset, length):
+        return self.getObject(encode_key(key), offset, length)
+
     def delete(self, key):
         raiseOnFailure(self.execute('DELETE', self.path + encode_key(key)))
 
+    def deleteMany(self, keys, workers = 8):
+        '''Deletes objects with multi-object delete requests, which are sent
+           concurrently.'''
+        names = map(encode_key, keys)
+        run_concurrently( self.delObjects,
+            [ names[i:i + DELETE_BATCH] for i in xrange(0, len(names), DELETE_BATCH) ],
+            workers )
+
 
     #
     # Internal implementation follows
     #
 
-    def getObject(self, path):
-        """Retrieves the object at the given relative path.
+    def connect(self):
+        conn = HTTPConnection(self.hostname)
+        conn.connect()
+        conn.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        return conn
+
+    def getObject(self, path, offset = None, length = None):
+        """Retrieves the object at the given relative path. If `offset` and
+           `length` are given, only that range of the object is retrieved.
            If the object does not exist, None is returned.
 
            Raises S3Error if the request fails"""
-        response = self.execute('GET', self.path + path)
+        headers = {}
+        if length is not None:
+            headers['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+        response = self.execute('GET', self.path + path, headers = headers)
         if response.status == 404:
-            return metadata, None
+            return None
         raiseOnFailure(response)
         return response.read()
 
@@ -155,9 +221,10 @@ class StorageS3 (StorageBase):
         raiseOnFailure(response)
         return True
 
-    def listObjects(self, delimiter = None):
+    def listObjects(self, delimiter = None, details = False):
         """Lists objects in the repository. Only objects starting with 'prefix'
            and not containing 'delimiter' (except inside the prefix) are returned.
+           If 'details' is set, (name, size, etag) tuples are returned.
 
            May raise S3Error if request fails."""
         query = 'prefix=%s&' % urlencode(self.prefix)
@@ -168,14 +235,19 @@ class StorageS3 (StorageBase):
         marker = ''
         done = False
         while not done:
-            q = query + 'marker=' + marker
+            q = query + 'marker=' + urlencode(marker.encode('utf-8'))
             response = self.execute('GET', '/' + self.bucket, q)
             raiseOnFailure(response)
             body = response.read()
             doc = parseString(body)
-            for elem in doc.getElementsByTagName('Key'):
-                marker = elem.firstChild.data
-                yield marker[prefix_len:].encode('utf-8')
+            for elem in doc.getElementsByTagName('Contents'):
+                marker = text(elem, 'Key')
+                name = marker[prefix_len:].encode('utf-8')
+                if details:
+                    yield ( name, int(text(elem, 'Size')),
+                            text(elem, 'ETag').strip('"').lower() )
+                else:
+                    yield name
             done = True
             for elem in doc.getElementsByTagName('IsTruncated'):
                 if elem.firstChild and elem.firstChild.data == 'true':
@@ -187,14 +259,36 @@ class StorageS3 (StorageBase):
         raiseOnFailure(self.execute('DELETE', self.path + path))
         return True
 
-    def execute(self, method, resource, query = '', data = '', metadata = { }):
+    def delObjects(self, paths):
+        """Deletes the objects with the given relative locations with a single
+           request (of at most DELETE_BATCH objects).
+           Raises S3Error if the request fails, or if any object could not be
+           deleted."""
+        body = '<Delete><Quiet>true</Quiet>%s</Delete>' % ''.join([
+            '<Object><Key>%s</Key></Object>' % escape(self.prefix + path)
+            for path in paths ])
+        response = self.execute('POST', '/%s/?delete' % self.bucket, '', body)
+        raiseOnFailure(response)
+        doc = parseString(response.read())
+        for elem in doc.getElementsByTagName('Error'):
+            key  = elem.getElementsByTagName('Key')
+            code = elem.getElementsByTagName('Code')
+            raise S3Error( response.status, response.reason, response.read(),
+                'Could not delete "%s": %s' % (
+                    key and key[0].firstChild.data,
+                    code and code[0].firstChild.data ) )
+        return True
+
+    def execute( self, method, resource, query = '', data = '', metadata = { },
+                 headers = { } ):
         """Executes a S3 request.
         'method' is the HTTP request method (eg. GET, PUT, DELETE)
         'resource' is the absolute path to the resource ("/bucket/objectid")
         'query' is the query string without the '?'; optional.
         'data' is the data to be sent as the request body (eg. when PUTting a file)
         'metadata' is a set of additional key/value pairs to be stored;
-            keys and values must be UTF-8 encoded strings"""
+            keys and values must be UTF-8 encoded strings
+        'headers' is a set of additional HTTP headers (that are not signed)"""
  
         date = date_string()
         if data: hash = MD5(data).digest().encode('base64').strip()
@@ -212,16 +306,33 @@ class StorageS3 (StorageBase):
         if query:
             resource += '?' + query
 
-        conn = HTTPConnection(self.hostname)
-        conn.putrequest(method, resource + '?' + query, True, True)
-        conn.putheader('Date', date)
-        conn.putheader('Host', self.hostname)
-        conn.putheader('Authorization', auth)
-        conn.putheader('Content-Length', str(len(data)))
-        if data:
-            conn.putheader('Content-Md5', hash)
-        for key in metadata:
-            conn.putheader('x-amz-meta-' + key, str(metadata[key]))
-        conn.endheaders()
-        conn.send(data)
-        return conn.getresponse()
+        # A reused connection may have been closed by the server in the mean
+        # time; in that case, the request is retried on a new connection.
+        while True:
+            conn, reused = self.pool.get()
+            try:
+                conn.putrequest(method, resource, True, True)
+                conn.putheader('Date', date)
+                conn.putheader('Host', self.hostname)
+                conn.putheader('Authorization', auth)
+                conn.putheader('Content-Length', str(len(data)))
+                if data:
+                    conn.putheader('Content-Md5', hash)
+                for key in metadata:
+                    conn.putheader('x-amz-meta-' + key, str(metadata[key]))
+                for key in headers:
+                    conn.putheader(key, headers[key])
+                # Send the headers and data together, to avoid a round trip
+                conn.endheaders(data)
+                response = Response(conn.getresponse())
+            except (HTTPException, SocketError), e:
+                self.pool.discard(conn)
+                if reused:
+                    debug('Reconnecting after error on reused connection: %s', e)
+                    continue
+                raise
+            if response.headers.get('connection', '').lower() == 'close':
+                self.pool.discard(conn)
+            else:
+                self.pool.put(conn)
+            return response
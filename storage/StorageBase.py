@@ -1,4 +1,10 @@
 from cPickle import loads, dumps as real_dumps, UnpicklingError
+from zlib import compress, decompress
+from random import getrandbits
+from threading import Lock, Thread
+from Queue import Queue, Empty
+from time import time
+from md5 import new as MD5
 dumps = lambda s: real_dumps(s, 2)
 
 # TODO: add errors to be raised from storage constructor
@@ -48,6 +54,160 @@ def decode_config(data):
 def entry_key(path, version):
     return 'e%d,%s' % (int(version), path)
 
+# Names of the subdirectories that objects are spread over, by storage modules
+# that do so
+SHARDS = [ '%02x' % i for i in xrange(256) ]
+
+def shard(key):
+    '''Returns the subdirectory name for the object with the given key.'''
+    return MD5(key).hexdigest()[:2]
+
+def run_concurrently(function, items, workers):
+    '''Calls `function` for every item with up to `workers` threads. If any
+       call raises an exception, no further calls are started, and the
+       exception is raised once all threads have finished.'''
+    queue, errors = Queue(), []
+    for item in items:
+        queue.put(item)
+    def work():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                function(item)
+            except Exception, e:
+                errors.append(e)
+    threads = [ Thread(target = work)
+                for i in xrange(max(min(workers, queue.qsize()), 1)) ]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if errors:
+        raise errors[0]
+
+def journal_key(rev):
+    return 'j' + str(rev)
+
+def pack_key(pack):
+    return 'p' + pack
+
+def index_key(pack):
+    return 'x' + pack
+
+def manifest_key(name):
+    return 'm' + name
+
+def snapshot_start(names):
+    '''Returns the position of the first part of the latest snapshot in a list
+       of manifest names, or -1 if there is no snapshot.'''
+    for i in xrange(len(names) - 1, -1, -1):
+        if names[i].endswith('-0'):
+            return i
+    return -1
+
+
+class Packer:
+    '''Aggregates small blocks into large pack objects.
+
+    Blocks are appended to an in-memory pack until it reaches the configured
+    pack size, after which the pack is stored as a single object, followed by
+    an index object that maps block hashes to their location in the pack.
+    A block location is a tuple (pack, offset, length, cid).
+
+    Entries are only stored once all packs that were open when they were
+    submitted have been stored, so stored entries never refer to missing
+    blocks. The packer may be used by several threads concurrently.'''
+
+    def __init__(self, storage, size):
+        self.storage  = storage
+        self.size     = size
+        self.lock     = Lock()
+        self.seq      = 0       # sequence number of the open pack
+        self.low      = 0       # all packs before this one have been stored
+        self.done     = set()   # sequence numbers of stored packs
+        self.entries  = []      # (seq, path, version, metadata, blocks)
+        self.open()
+
+    def open(self):
+        self.id     = '%08x%08x' % (int(time()), getrandbits(32))
+        self.data   = []
+        self.index  = []
+        self.offset = 0
+
+    def add(self, hash, cid, data):
+        '''Adds a block to the open pack and returns its location. Stores the
+           pack if it has become full.'''
+        self.lock.acquire()
+        try:
+            location = (self.id, self.offset, len(data), cid)
+            self.data.append(data)
+            self.index.append((hash,) + location[1:])
+            self.offset += len(data)
+            if self.offset < self.size:
+                return location
+            sealed = self.seal()
+        finally:
+            self.lock.release()
+        self.store(*sealed)
+        return location
+
+    def addEntry(self, path, version, metadata, blocks):
+        '''Stores an entry, or defers it until the open pack is stored.'''
+        self.lock.acquire()
+        try:
+            if self.data: seq = self.seq
+            else:         seq = self.seq - 1
+            if seq >= self.low:
+                self.entries.append((seq, path, version, metadata, blocks))
+                return
+        finally:
+            self.lock.release()
+        self.storage.storeEntry(path, version, metadata, blocks)
+
+    def flush(self):
+        '''Stores the open pack (if it is not empty) and all deferred entries.'''
+        self.lock.acquire()
+        try:
+            sealed = self.data and self.seal()
+        finally:
+            self.lock.release()
+        if sealed:
+            self.store(*sealed)
+        self.storeEntries()
+
+    def seal(self):
+        # Must be called with the lock held
+        sealed = (self.seq, self.id, ''.join(self.data), self.index)
+        self.seq += 1
+        self.open()
+        return sealed
+
+    def store(self, seq, id, data, index):
+        self.storage.store(pack_key(id), data)
+        self.storage.record('o+', pack_key(id), len(data), MD5(data).hexdigest())
+        self.storage.store(index_key(id), compress(dumps(index)))
+        self.storage.addPackIndex(id, index)
+        self.lock.acquire()
+        try:
+            self.done.add(seq)
+            while self.low in self.done:
+                self.done.remove(self.low)
+                self.low += 1
+        finally:
+            self.lock.release()
+        self.storeEntries()
+
+    def storeEntries(self):
+        self.lock.acquire()
+        try:
+            ready = [ e for e in self.entries if e[0] < self.low ]
+            self.entries = [ e for e in self.entries if e[0] >= self.low ]
+        finally:
+            self.lock.release()
+        for seq, path, version, metadata, blocks in ready:
+            self.storage.storeEntry(path, version, metadata, blocks)
+
 
 class StorageBase:
     '''Base class for storage modules
@@ -98,6 +258,67 @@ class StorageBase:
         '''Deletes the object with the given key, if it exists.'''
         raise MissingImplementation(self.retrieve)
 
+    def setConnections(self, count, timeout):
+        '''Sets the maximum number of concurrent connections to the storage,
+           and the time (in seconds) after which idle connections are closed.
+
+           Storage modules that keep persistent connections should override
+           this; by default, it is ignored.'''
+        pass
+
+    def sync(self):
+        '''Makes all stored objects durable.
+
+           Storage modules that buffer writes should override this; by
+           default, nothing is done.'''
+        pass
+
+    def migrate(self):
+        '''Converts the repository to the current storage layout. Returns
+           whether anything was changed.
+
+           Storage modules that support more than one layout should override
+           this; by default, nothing is done.'''
+        return False
+
+    def cleanup(self, before):
+        '''Removes what writes that were interrupted (for example, by a
+           crash) before time `before` left behind. Returns the number of
+           objects removed.
+
+           Storage modules that write objects in several steps should
+           override this; by default, nothing is done.'''
+        return 0
+
+    def deleteMany(self, keys, workers = 8):
+        '''Deletes the objects with the given keys, with up to `workers`
+           concurrent requests.
+
+           Storage modules that can delete several objects with one request
+           should override this; by default, delete() is called by `workers`
+           threads.'''
+        run_concurrently(self.delete, keys, workers)
+
+    def listInfo(self):
+        '''Returns a listing of (key, size, digest) tuples of all objects,
+           where digest is the MD5 digest of the value (in hexadecimal), or
+           None if the storage does not report it. No values are retrieved.
+
+           Storage modules should override this if they can list object
+           sizes; by default, sizes are None as well.'''
+        for key in self.list():
+            yield key, None, None
+
+    def retrieveRange(self, key, offset, length):
+        '''Retrieves `length` bytes at `offset` of the value of the object with
+           the given key, or returns None if no such object exists.
+
+           Storage modules should override this if they support ranged reads;
+           by default, the entire value is retrieved.'''
+        data = self.retrieve(key)
+        if data is not None:
+            return data[offset:offset + length]
+
     #
     # The following methods form the external interface. They are implemented
     # using the low level methods above, and are not normally overridden by
@@ -115,8 +336,166 @@ class StorageBase:
             raise DataError('Revision number is negative')
         return rev
 
-    def setRevision(self, rev):
+    def setRevision(self, rev, entries = None):
+        '''Stores all buffered data, writes the changes made since the last
+           revision to the journal and to a manifest, and sets the new
+           revision. Returns the list of changes written.
+
+           `entries` should be a listing of all entries after these changes,
+           as (path, version, metadata, blocks) tuples; it is only consumed
+           when a snapshot is due (see storeManifest()).'''
+        self.flush()
+        self.journal_lock.acquire()
+        try:
+            changes, self.journal = self.journal or [], []
+        finally:
+            self.journal_lock.release()
+        replaced = self.storeManifest(changes, entries)
+        self.store(journal_key(rev), compress(dumps(changes)))
+        revs = self.getJournalIndex() + [ str(int(rev)) ]
+        for old_rev in revs[:-self.journal_size]:
+            self.delete(journal_key(old_rev))
+        self.store('-jnl', '\n'.join(revs[-self.journal_size:]))
+        # Everything the revision refers to must be durable before it is set
+        self.sync()
         self.store('-rev', str(int(rev)))
+        self.sync()
+        # Manifests replaced by a snapshot are kept until it is durable
+        self.deleteMany(map(manifest_key, replaced))
+        return changes
+
+
+    # Number of journal segments to keep
+    journal_size = 1000
+
+    # Changes made since the last revision; written to the journal by
+    # setRevision(). Changes are tuples of one of the following forms:
+    #   ('b+', id, location)                    block added; the location of
+    #                                           an unpacked block is
+    #                                           (None, None, size, None)
+    #   ('b-', id)                              block removed
+    #   ('e+', path, version, metadata, blocks) entry added
+    #   ('e-', path, version)                   entry removed
+    #   ('o+', key, size, digest)               pack or unpacked block stored,
+    #                                           with the MD5 digest of its value
+    #   ('o-', key)                             pack removed
+    journal      = None
+    journal_lock = Lock()
+
+    def record(self, *change):
+        self.journal_lock.acquire()
+        try:
+            if self.journal is None:
+                self.journal = []
+            self.journal.append(change)
+        finally:
+            self.journal_lock.release()
+
+    def getJournalIndex(self):
+        '''Returns the list of revisions that have a journal segment, from
+           oldest to newest.'''
+        data = self.retrieve('-jnl')
+        if data:
+            return data.split('\n')
+        return []
+
+    def getJournal(self, since, until):
+        '''Returns the list of changes made between revisions `since` and
+           `until`, or None if the journal does not cover that range.'''
+        revs = self.getJournalIndex()
+        since, until = str(int(since)), str(int(until))
+        if since not in revs or not revs or revs[-1] <> until:
+            return None
+        changes = []
+        for rev in revs[revs.index(since) + 1:]:
+            data = self.retrieve(journal_key(rev))
+            if data is None:
+                return None
+            changes.extend(loads(decompress(data)))
+        return changes
+
+
+    # Number of manifests written after a snapshot, after which the next
+    # revision writes a new snapshot
+    manifest_size = 100
+
+    # Number of entries per snapshot object
+    snapshot_size = 100000
+
+    def getManifestIndex(self):
+        '''Returns the list of names of the current manifests, from oldest to
+           newest.'''
+        data = self.retrieve('-man')
+        if data:
+            return data.split('\n')
+        return []
+
+    def storeManifest(self, changes, entries = None):
+        '''Stores the entries added and removed by a revision as a manifest.
+
+           The manifests since the latest snapshot (a manifest of all entries,
+           stored in parts of `snapshot_size` entries) describe all entries of
+           the repository, so the cache can be rebuilt from them. If the
+           repository has no snapshot yet, or `manifest_size` manifests have
+           been written since the latest one, a new snapshot of `entries` is
+           stored instead (no manifests are written without a snapshot).
+           Returns the names of the manifests that a new snapshot replaced.'''
+        names = self.getManifestIndex()
+        start = snapshot_start(names)
+        if names:
+            name = max(int(time()*1000), int(names[-1].split('-')[0], 16) + 1)
+        else:
+            name = int(time()*1000)
+        name = '%012x' % name
+
+        written = len([ n for n in names[start + 1:] if '-' not in n ])
+        if entries is not None and (start < 0 or
+                                    written >= self.manifest_size):
+            parts, part = [], []
+            for path, version, metadata, blocks in entries:
+                part.append(('e+', path, version, metadata, blocks))
+                if len(part) >= self.snapshot_size:
+                    parts.append(self.storeManifestPart(name, len(parts), part))
+                    part = []
+            if part or not parts:
+                parts.append(self.storeManifestPart(name, len(parts), part))
+            self.store('-man', '\n'.join(parts))
+            return names
+
+        changes = [ c for c in changes if c[0] in ('e+', 'e-') ]
+        if start >= 0 and changes:
+            self.store(manifest_key(name), compress(dumps(changes)))
+            self.store('-man', '\n'.join(names + [ name ]))
+        return []
+
+    def storeManifestPart(self, name, number, changes):
+        name = '%s-%d' % (name, number)
+        self.store(manifest_key(name), compress(dumps(changes)))
+        return name
+
+    def listManifests(self):
+        '''Returns a listing of the entry changes recorded in the latest
+           snapshot and the manifests written after it, in order, or None if
+           the repository has no snapshot.'''
+        names = self.getManifestIndex()
+        start = snapshot_start(names)
+        if start < 0:
+            return None
+        return self.readManifests(names[start:])
+
+    def readManifests(self, names):
+        for name in names:
+            data = self.retrieve(manifest_key(name))
+            if data is None:
+                raise DataError('Manifest %s is missing' % name)
+            for change in loads(decompress(data)):
+                yield change
+
+    def flush(self):
+        '''Stores all buffered blocks and entries, and makes them durable.'''
+        if self.packer:
+            self.packer.flush()
+        self.sync()
 
 
     def getConfig(self):
@@ -128,23 +507,167 @@ class StorageBase:
         self.store('-cfg', encode_config(config))
 
 
+    # Packer used to aggregate blocks; None if packing is disabled
+    packer = None
+
+    # Maps ids of packed blocks to their location; loaded on first use, and
+    # kept up to date as packs are stored and deleted
+    pack_index = None
+    pack_index_lock = Lock()
+
+    # Local cache of retrieved blocks; None if disabled
+    block_cache = None
+
+    # Function that computes the id of a block from its data; selected by
+    # init() according to the repository configuration
+    hash_function = None
+
+    # Whether every entry is stored as a separate object, besides being
+    # recorded in a manifest
+    entry_objects = True
+
+    def setPackSize(self, size):
+        '''Sets the size of pack objects in bytes, or disables packing if
+           `size` is 0. Must be called before blocks are stored.'''
+        if size > 0:
+            self.packer = Packer(self, size)
+        else:
+            self.packer = None
+
+    def setBlockCache(self, path, size):
+        '''Caches up to `size` bytes of retrieved blocks in the directory
+           `path`, or disables caching if `size` is 0.'''
+        if size > 0:
+            from BlockCache import BlockCache
+            self.block_cache = BlockCache(path, size)
+        else:
+            self.block_cache = None
+
+    def listPacks(self):
+        '''Returns a listing of (pack, index) tuples, where index is a list of
+           (id, offset, length, cid) tuples describing the blocks in the pack.'''
+        for key in self.list():
+            if key and key[0] == 'x':
+                data = self.retrieve(key)
+                if data:
+                    yield key[1:], loads(decompress(data))
+
+    def addPackIndex(self, pack, index):
+        if self.pack_index is not None:
+            for id, offset, length, cid in index:
+                self.pack_index[id] = (pack, offset, length, cid)
+
+    def locateBlock(self, id):
+        '''Returns the location of a packed block, or None if no pack
+           contains the block.'''
+        if self.pack_index is None:
+            # Concurrent fetchers wait for a single thread to load the indices
+            self.pack_index_lock.acquire()
+            try:
+                if self.pack_index is None:
+                    pack_index = {}
+                    for pack, index in self.listPacks():
+                        for block_id, offset, length, cid in index:
+                            pack_index[block_id] = (pack, offset, length, cid)
+                    self.pack_index = pack_index
+            finally:
+                self.pack_index_lock.release()
+        return self.pack_index.get(id)
+
     def listBlocks(self):
+        for id, location in self.listBlockLocations():
+            yield id
+
+    def listBlockLocations(self):
+        '''Returns a listing of (id, location) tuples of all blocks, where
+           location is None for blocks that are not stored in a pack.'''
         for key in self.list():
             if key and key[0] == 'b':
-                yield key[1:]
-
-    def getBlock(self, id):
-        data = self.retrieve('b' + id)
-        if data:
-            return data[0], data[1:]
+                yield key[1:], None
+        for pack, index in self.listPacks():
+            for id, offset, length, cid in index:
+                yield id, (pack, offset, length, cid)
+
+    def getBlock(self, id, location = None):
+        '''Retrieves a block as a (cid, data) tuple, or returns None if the
+           block does not exist. If the location of a packed block is known,
+           it should be passed, so it can be read directly from its pack.'''
+        if self.block_cache:
+            block = self.block_cache.get(id)
+            if block:
+                return block
+        block = self.fetchBlock(id, location)
+        if block and self.block_cache:
+            self.block_cache.put(id, *block)
+        return block
+
+    def fetchBlock(self, id, location = None):
+        '''Retrieves a block from the storage, bypassing the block cache.'''
+        unpacked = location and location[0] is None
+        if not location and self.packer:
+            # Most blocks are packed; the pack indices are loaded only once
+            location = self.locateBlock(id)
+        if not location or unpacked:
+            data = self.retrieve('b' + id)
+            if data:
+                return data[0], data[1:]
+            if self.packer or unpacked:
+                return None
+            location = self.locateBlock(id)
+            if not location:
+                return None
+        pack, offset, length, cid = location
+        data = self.retrieveRange(pack_key(pack), offset, length)
+        if data is not None and len(data) == length:
+            return cid, data
 
     def setBlock(self, id, cid, data):
+        '''Stores a block, and returns its location if it was packed, or None
+           otherwise.'''
         if len(cid) <> 1:
             raise ValueError('cid should have length 1, not %d' % len(cid))
-        self.store('b' + id, cid + data)
+        if self.packer and len(data) < self.packer.size:
+            location = self.packer.add(id, cid, data)
+        else:
+            value = cid + data
+            self.store('b' + id, value)
+            self.record('o+', 'b' + id, len(value), MD5(value).hexdigest())
+            # Recorded explicitly, as the block may have been packed before
+            self.record('b+', id, (None, None, len(value), None))
+            return None
+        self.record('b+', id, location)
+        return location
 
     def delBlock(self, id):
+        '''Deletes a block that is not stored in a pack.'''
         self.delete('b' + id)
+        if self.block_cache:
+            self.block_cache.discard(id)
+        self.record('b-', id)
+
+    def delBlocks(self, ids, workers = 8):
+        '''Deletes a number of blocks that are not stored in a pack.'''
+        self.deleteMany([ 'b' + id for id in ids ], workers)
+        for id in ids:
+            if self.block_cache:
+                self.block_cache.discard(id)
+            self.record('b-', id)
+
+    def delPacks(self, packs, workers = 8):
+        '''Deletes packs, which must contain no blocks that are still used.
+           `packs` maps pack names to the ids of the blocks they contain.'''
+        # Indices go first, so an interrupted deletion leaves no index that
+        # refers to a missing pack
+        self.deleteMany(map(index_key, packs), workers)
+        self.deleteMany(map(pack_key, packs), workers)
+        for pack, ids in packs.items():
+            for id in ids:
+                if self.pack_index is not None:
+                    self.pack_index.pop(id, None)
+                if self.block_cache:
+                    self.block_cache.discard(id)
+                self.record('b-', id)
+            self.record('o-', pack_key(pack))
 
 
     def listEntries(self):
@@ -163,7 +686,17 @@ class StorageBase:
             return loads(data)
 
     def setEntry(self, path, version, metadata, blocks):
+        self.record('e+', path, version, metadata, blocks)
+        if not self.entry_objects:
+            return
+        if self.packer:
+            self.packer.addEntry(path, version, metadata, blocks)
+        else:
+            self.storeEntry(path, version, metadata, blocks)
+
+    def storeEntry(self, path, version, metadata, blocks):
         self.store(entry_key(path, version), dumps((metadata, blocks)))
 
     def delEntry(self, path, version):
         self.delete(entry_key(path, version))
+        self.record('e-', path, version)
@@ -0,0 +1,133 @@
+'''Tests of rebuilding and updating the cache from the repository.'''
+
+import sys, os, unittest
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ root, os.path.join(root, 'storage') ]
+
+from tempfile import mkdtemp
+from shutil import rmtree
+from hashlib import md5
+from time import time
+from FS import StorageFS
+from cache import Cache
+from collect import sweep
+
+
+class CacheTest (unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.storage = StorageFS( os.path.join(self.dir, 'repo'), None, None,
+                                  { 'test': 'yes' } )
+        self.storage.setPackSize(4096)
+        self.cache = Cache(os.path.join(self.dir, 'cache'), self.storage)
+
+    def tearDown(self):
+        self.cache.close()
+        rmtree(self.dir)
+
+    def store(self, path, version, *blocks):
+        ids = []
+        for data in blocks:
+            id = md5(data).digest()
+            if not self.cache.hasBlock(id):
+                location = self.storage.setBlock(id, 'n', data)
+                self.cache.addBlock(id, location, len(data) + 1)
+            self.cache.incBlockRef(id)
+            ids.append(id)
+        metadata = { 'size': sum(map(len, blocks)) }
+        self.storage.setEntry(path, version, metadata, ids)
+        self.cache.setEntry(path, version, metadata, ids)
+
+    def purge(self, path, version):
+        self.storage.delEntry(path, version)
+        self.cache.delEntry(path, version)
+
+    def rebuild(self):
+        return Cache(os.path.join(self.dir, 'rebuilt'), self.storage)
+
+    def contents(self, cache):
+        versions = [ (path, version, blocks) for path, version, metadata,
+                     blocks in cache.listAllEntries() ]
+        versions.sort()
+        refs = cache.listBlockRefs()
+        refs.sort()
+        return versions, refs
+
+
+class RebuildTest (CacheTest):
+
+    def test_rebuild(self):
+        self.store('/a', 1, 'a1', 'a2')
+        self.store('/b', 1, 'b1')
+        self.cache.updateRevision(self.storage)
+        rebuilt = self.rebuild()
+        self.assertEqual(self.contents(rebuilt), self.contents(self.cache))
+        rebuilt.close()
+
+    def test_rebuild_after_purge_and_collection(self):
+        self.store('/a', 1, 'a1', 'a2')
+        self.store('/a', 2, 'a1', 'a3')
+        self.store('/b', 1, 'b1')
+        self.cache.updateRevision(self.storage)
+        self.purge('/a', 1)
+        self.cache.updateRevision(self.storage)
+        deleted, objects, reclaimed, waste = sweep( self.cache, self.storage,
+            int(time()) + 1, 1, 1 )
+        self.assertEqual(deleted, 1)
+        self.failIf(self.cache.hasBlock(md5('a2').digest()))
+
+        rebuilt = self.rebuild()
+        self.assertEqual(self.contents(rebuilt), self.contents(self.cache))
+        self.assertEqual( rebuilt.getBlockLocation(md5('a3').digest()),
+                          self.cache.getBlockLocation(md5('a3').digest()) )
+        rebuilt.close()
+
+
+class ReplayTest (CacheTest):
+
+    def setUp(self):
+        CacheTest.setUp(self)
+        self.store('/a', 1, 'a1', 'a2')
+        self.cache.updateRevision(self.storage)
+        self.stale = self.rebuild()
+
+    def tearDown(self):
+        self.stale.close()
+        CacheTest.tearDown(self)
+
+    def test_replay(self):
+        self.store('/a', 2, 'a1', 'a3')
+        self.store('/b', 1, 'b1')
+        self.cache.updateRevision(self.storage)
+        self.purge('/a', 1)
+        self.cache.updateRevision(self.storage)
+
+        self.failUnless(self.stale.replay(self.storage))
+        self.assertEqual(self.stale.getRevision(), self.storage.getRevision())
+        self.assertEqual(self.contents(self.stale), self.contents(self.cache))
+
+    def test_block_moved_out_of_pack(self):
+        id = md5('a1').digest()
+        self.failUnless(self.stale.getBlockLocation(id))
+        self.storage.setPackSize(0)
+        self.storage.setBlock(id, 'n', 'a1')
+        self.cache.updateRevision(self.storage)
+
+        self.failUnless(self.stale.replay(self.storage))
+        self.assertEqual(self.stale.getBlockLocation(id), None)
+        self.assertEqual(self.storage.getBlock(id), ('n', 'a1'))
+
+    def test_journal_too_short(self):
+        self.storage.journal_size = 1
+        for version in (2, 3):
+            self.store('/a', version, 'a%d' % version)
+            self.cache.updateRevision(self.storage)
+
+        before = self.contents(self.stale)
+        self.failIf(self.stale.replay(self.storage))
+        self.assertEqual(self.contents(self.stale), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+'''Tests of the chunking module.'''
+
+import sys, os, unittest
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ root, os.path.join(root, 'storage') ]
+
+from StringIO import StringIO
+from random import Random
+from chunking import fixed_chunks, content_chunks, block_limits, chunks
+
+
+def random_data(size, seed = 1):
+    r = Random(seed)
+    return ''.join([ chr(r.randrange(256)) for i in xrange(size) ])
+
+
+class ChunkingTest (unittest.TestCase):
+
+    data = random_data(200000)
+
+    def content(self, data, minblock = 1024, avgblock = 4096, maxblock = 16384):
+        return list(content_chunks(StringIO(data), minblock, avgblock, maxblock))
+
+    def test_fixed(self):
+        blocks = list(fixed_chunks(StringIO(self.data), 4096))
+        self.assertEqual(''.join(blocks), self.data)
+        self.assertEqual(map(len, blocks[:-1]), [ 4096 ]*(len(blocks) - 1))
+        self.assertEqual(list(fixed_chunks(StringIO(''), 4096)), [])
+
+    def test_content_sizes(self):
+        blocks = self.content(self.data)
+        self.assertEqual(''.join(blocks), self.data)
+        for block in blocks[:-1]:
+            self.failUnless(1024 <= len(block) <= 16384, len(block))
+        average = len(self.data)/len(blocks)
+        self.failUnless(2048 <= average <= 8192, average)
+
+    def test_content_insertion(self):
+        # Only the blocks around an insertion change
+        before = self.content(self.data)
+        after  = self.content(self.data[:100000] + 'inserted' +
+                              self.data[100000:])
+        self.assertEqual(''.join(after), self.data[:100000] + 'inserted' +
+                         self.data[100000:])
+        changed = set(after) - set(before)
+        self.failUnless(1 <= len(changed) <= 3, len(changed))
+
+    def test_content_small(self):
+        self.assertEqual(self.content(''), [])
+        self.assertEqual(self.content('abc'), [ 'abc' ])
+
+    def test_limits(self):
+        self.assertEqual(block_limits(1024, 4096, 16384), (1024, 16384))
+        self.assertEqual(block_limits(4096, 4096, 16384), (1024, 16384))
+        self.assertEqual(block_limits(1024, 4096, 2048), (1024, 16384))
+
+    def test_methods(self):
+        args = { 'chunking': 'fixed', 'blocksize': 1000,
+                 'minblock': 0, 'maxblock': 0 }
+        self.assertEqual(len(list(chunks(StringIO(self.data), args))), 200)
+        args['chunking'] = 'other'
+        self.assertRaises(ValueError, chunks, StringIO(self.data), args)
+
+
+if __name__ == '__main__':
+    unittest.main()
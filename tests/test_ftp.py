@@ -0,0 +1,96 @@
+'''Tests of the FTP storage module, against fake sessions.'''
+
+import sys, os, unittest
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ root, os.path.join(root, 'storage') ]
+
+from FTP import StorageFTP
+from Pool import ConnectionPool
+
+
+class FakeSocket:
+
+    def __init__(self, data):
+        self.data = data
+
+    def recv(self, size):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    '''Serves a single object; `replies` are the replies the server sends
+       after a transfer is aborted.'''
+
+    def __init__(self, data, replies):
+        self.data     = data
+        self.replies  = replies
+        self.commands = []
+        self.closed   = False
+
+    def voidcmd(self, cmd):
+        self.commands.append(cmd)
+
+    def transfercmd(self, cmd, rest = None):
+        self.commands.append(cmd)
+        return FakeSocket(self.data[rest or 0:])
+
+    def voidresp(self):
+        self.commands.append('<226>')
+
+    def putcmd(self, cmd):
+        self.commands.append(cmd)
+
+    def getmultiline(self):
+        if not self.replies:
+            raise EOFError
+        return self.replies.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class Storage (StorageFTP):
+
+    def __init__(self, session):
+        self.sharded = False
+        self.pool    = ConnectionPool(lambda: session)
+
+
+class RetrieveRangeTest (unittest.TestCase):
+
+    def retrieve(self, replies, offset, length):
+        session = FakeSession('0123456789', replies)
+        storage = Storage(session)
+        data = storage.retrieveRange('key', offset, length)
+        return data, session, storage.pool.idle
+
+    def test_binary_mode(self):
+        data, session, idle = self.retrieve([], 4, 10)
+        self.assertEqual(data, '456789')
+        self.assertEqual(session.commands[0], 'TYPE I')
+        self.assertEqual(session.commands[-1], '<226>')
+        self.assertEqual(len(idle), 1)
+
+    def test_aborted_transfer_is_drained(self):
+        replies = [ '426 Transfer aborted', '226 Abort successful', '200 OK',
+                    '220 Unrelated' ]
+        data, session, idle = self.retrieve(replies, 2, 3)
+        self.assertEqual(data, '234')
+        self.assertEqual(session.commands[-2:], [ 'ABOR', 'NOOP' ])
+        self.assertEqual(session.replies, [ '220 Unrelated' ])
+        self.assertEqual(len(idle), 1)
+        self.failIf(session.closed)
+
+    def test_unsynchronized_session_is_discarded(self):
+        data, session, idle = self.retrieve([ '426 Transfer aborted' ], 0, 3)
+        self.assertEqual(data, '012')
+        self.assertEqual(idle, [])
+        self.failUnless(session.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
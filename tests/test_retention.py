@@ -0,0 +1,77 @@
+'''Tests of the selection of versions to keep when purging.'''
+
+import sys, os, unittest
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ root, os.path.join(root, 'storage') ]
+
+from time import timezone
+from retention import Policy, select, month_number, HOUR, DAY
+
+DAY0 = 15000    # a day number, in local time
+
+def local(day, hour = 0):
+    # Storage time of an hour of a (local) day
+    return (DAY0 + day)*DAY + hour*HOUR + timezone
+
+
+class SelectTest (unittest.TestCase):
+
+    now = local(10)
+
+    def select(self, versions, **policy):
+        '''Returns the kept versions, from (path index, time) tuples ordered
+           by path and by descending version.'''
+        indices = [ index for index, time in versions ]
+        times   = [ time for index, time in versions ]
+        keep = select(indices, times, Policy(**policy), self.now)
+        return [ v for v, k in zip(versions, keep) if k ]
+
+    def test_empty(self):
+        self.assertEqual(len(select([], [], Policy(last = 1), self.now)), 0)
+
+    def test_last(self):
+        versions = [ (0, local(3)), (0, local(2)), (0, local(1)),
+                     (1, local(3)), (2, local(2)), (2, local(1)) ]
+        self.assertEqual( self.select(versions),
+                          [ (0, local(3)), (1, local(3)), (2, local(2)) ] )
+        self.assertEqual( self.select(versions, last = 2),
+                          [ (0, local(3)), (0, local(2)),
+                            (1, local(3)), (2, local(2)), (2, local(1)) ] )
+
+    def test_unusual_times(self):
+        versions = [ (0, local(3)), (0, local(11)), (0, -1), (0, local(1)) ]
+        self.assertEqual( self.select(versions),
+                          [ (0, local(3)), (0, local(11)), (0, -1) ] )
+
+    def test_daily(self):
+        versions = [ (0, local(5, 20)), (0, local(5, 8)),
+                     (0, local(3, 23)), (0, local(3, 1)),
+                     (0, local(1, 12)),
+                     (1, local(4, 1)), (1, local(4, 0)) ]
+        # Only days with versions count
+        self.assertEqual( self.select(versions, daily = 2),
+                          [ (0, local(5, 20)), (0, local(3, 23)),
+                            (1, local(4, 1)) ] )
+        self.assertEqual( self.select(versions, last = 3, hourly = 1),
+                          [ (0, local(5, 20)), (0, local(5, 8)),
+                            (0, local(3, 23)), (1, local(4, 1)),
+                            (1, local(4, 0)) ] )
+
+    def test_periods_start_per_path(self):
+        # The first version of a path starts a period, even if the previous
+        # path's last version is in the same period
+        versions = [ (0, local(2)), (0, local(1, 3)),
+                     (1, local(1, 2)), (1, local(1, 1)) ]
+        self.assertEqual( self.select(versions, daily = 2),
+                          [ (0, local(2)), (0, local(1, 3)),
+                            (1, local(1, 2)) ] )
+
+    def test_month_number(self):
+        self.assertEqual(month_number(0), 1970*12)
+        self.assertEqual(month_number(11016), 2000*12 + 1)     # 2000-02-29
+        self.assertEqual(month_number(11017), 2000*12 + 2)     # 2000-03-01
+        self.assertEqual(month_number(-1), 1969*12 + 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+'''Tests of the file selection rules.'''
+
+import sys, os, unittest
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ root, os.path.join(root, 'storage') ]
+
+from rules import Matcher, Rules
+from defs import DEFAULT_ARGS, UNITS
+
+
+class MatcherTest (unittest.TestCase):
+
+    def matcher(self, *patterns):
+        matcher = Matcher()
+        for number, pattern in enumerate(patterns):
+            matcher.add(pattern, number, '/' not in pattern)
+        matcher.compile()
+        return matcher
+
+    def match(self, matcher, string):
+        numbers = matcher.match(string, string[string.rfind('/') + 1:])
+        numbers.sort()
+        return numbers
+
+    def test_literals_and_extensions(self):
+        m = self.matcher('core', '*.o', '*.tar.gz', '*.o')
+        self.assertEqual(m.literals, { 'core': [ 0 ] })
+        self.assertEqual(m.extensions, { 'o': [ 1, 3 ] })
+        self.assertEqual(self.match(m, 'core'), [ 0 ])
+        self.assertEqual(self.match(m, 'main.o'), [ 1, 3 ])
+        self.assertEqual(self.match(m, 'x.tar.gz'), [ 2 ])
+        self.assertEqual(self.match(m, '.o'), [])
+        self.assertEqual(self.match(m, 'main.c'), [])
+
+    def test_globs(self):
+        m = self.matcher('a?c', '[!x]*.tmp', '/home/*/cache', '/var/**/log')
+        self.assertEqual(self.match(m, 'abc'), [ 0 ])
+        self.assertEqual(self.match(m, 'abbc'), [])
+        self.assertEqual(self.match(m, 'y.tmp'), [ 1 ])
+        self.assertEqual(self.match(m, 'x.tmp'), [])
+        self.assertEqual(self.match(m, '/home/joe/cache'), [ 2 ])
+        self.assertEqual(self.match(m, '/home/joe/src/cache'), [])
+        self.assertEqual(self.match(m, '/var/spool/mail/log'), [ 3 ])
+        self.assertEqual(self.match(m, '/var/log/x'), [])
+
+
+class RulesTest (unittest.TestCase):
+
+    rules = Rules([
+        '# comment',
+        '',
+        '*.log        compress=none',
+        '/tmp/        skip',
+        'build/       skip',
+        '/home/*/big  blocksize=4mb chunking=content',
+        '*.log        level=9',
+        '/home/**/keep.log level=1' ])
+
+    def test_order_and_inheritance(self):
+        args = self.rules.file('/home/joe/x.log')
+        self.assertEqual((args['compress'], args['level']), ('none', 9))
+        args = self.rules.file('/home/joe/big/data/keep.log')
+        self.assertEqual((args['compress'], args['level']), ('none', 1))
+        self.assertEqual(args['blocksize'], 4*UNITS['mb'])
+        self.assertEqual(args['chunking'], 'content')
+        self.assertEqual(self.rules.file('/home/joe/y'), DEFAULT_ARGS)
+
+    def test_directories_only(self):
+        self.failUnless(self.rules.directory('/tmp')['skip'])
+        self.failIf(self.rules.file('/tmp')['skip'])
+        self.failUnless(self.rules.directory('/src/build')['skip'])
+        self.failIf(self.rules.file('/src/build')['skip'])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Rules, [ '*.o unknown=1' ])
+        self.assertRaises(ValueError, Rules, [ 'src/*.o skip' ])
+        self.assertRaises(ValueError, Rules, [ '*.o blocksize=lots' ])
+        self.assertRaises(ValueError, Rules, [ '"*.o skip' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
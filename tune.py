@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''Benchmarks compression methods, levels and block sizes on a sample of files,
+and recommends parameters per file type.
+
+Usage: tune [options] [<directory>...]
+
+Samples files from the given directories (or the configured back-up roots),
+splits them into blocks of every block size, and compresses the distinct
+blocks with every compressor and level. Reports the compression throughput,
+the compression ratio and the share of duplicate data for every combination.
+
+The parameters that minimize the estimated time to back up a byte (the time
+spent compressing it, plus the time to upload what remains at the given
+bandwidth) are then printed as rules for the most common file types. Since
+everything else is printed as comments, the output can be used as a rules
+file directly.'''
+
+from optparse import OptionParser
+from os.path import splitext
+from random import shuffle, seed
+from time import time
+from sys import exit, stderr
+from md5 import new as MD5
+from defs import parse_quantity
+from compression import compressors
+from walker import Walker
+from init import init, configured_roots
+
+LEVELS = { 'none': [ 0 ], 'deflate': [ 1, 6, 9 ], 'bzip2': [ 1, 9 ] }
+
+
+class Result:
+    '''Totals for one combination of parameters and one file type.'''
+
+    def __init__(self):
+        self.size    = 0    # bytes read
+        self.unique  = 0    # bytes in distinct blocks
+        self.stored  = 0    # bytes after compression
+        self.seconds = 0.0  # time spent compressing
+
+    def add(self, other):
+        self.size    += other.size
+        self.unique  += other.unique
+        self.stored  += other.stored
+        self.seconds += other.seconds
+
+    def cost(self, bandwidth):
+        '''Returns the estimated time to back up a byte.'''
+        return (self.seconds + float(self.stored)/bandwidth)/max(self.size, 1)
+
+def file_type(path):
+    return splitext(path)[1][1:].lower()
+
+def sample_files(roots, size, limit):
+    '''Returns the paths of a random sample of files in `roots`, that holds
+       about `size` bytes, reading at most `limit` bytes of a file.'''
+    files = [ (path, st.st_size) for path, st in Walker(roots) if st.st_size ]
+    shuffle(files)
+    total, sample = 0, []
+    for path, file_size in files:
+        if total >= size:
+            break
+        sample.append(path)
+        total += min(file_size, limit)
+    return sample
+
+def benchmark(paths, grid, blocksizes, limit):
+    '''Returns a dictionary mapping (compress, level, blocksize, type) to a
+       Result.'''
+    results = {}
+    seen    = {}    # blocksize -> set of hashes of blocks compressed
+    for path in paths:
+        try:
+            f = file(path, 'rb')
+            try:
+                data = f.read(limit)
+            finally:
+                f.close()
+        except IOError, e:
+            print >>stderr, '%s: %s' % (path, e.strerror)
+            continue
+        type = file_type(path)
+        for blocksize in blocksizes:
+            hashes = seen.setdefault(blocksize, set())
+            blocks = []
+            for offset in xrange(0, len(data), blocksize):
+                block = data[offset:offset + blocksize]
+                hash  = MD5(block).digest()
+                if hash not in hashes:
+                    hashes.add(hash)
+                    blocks.append(block)
+            unique = sum(map(len, blocks))
+            for compress, level in grid:
+                compressor = compressors[compress]
+                result = results.setdefault(
+                    (compress, level, blocksize, type), Result() )
+                result.size   += len(data)
+                result.unique += unique
+                start = time()
+                for block in blocks:
+                    if level: cdata = compressor.compress(block, level)
+                    else:     cdata = compressor.compress(block)
+                    result.stored += min(len(cdata), len(block))
+                result.seconds += time() - start
+    return results
+
+def totals(results, key):
+    '''Sums the results by the parts of the key selected by `key`.'''
+    sums = {}
+    for params, result in results.items():
+        sums.setdefault(key(params), Result()).add(result)
+    return sums
+
+def format_size(size):
+    for unit, factor in (('mb', 1048576), ('kb', 1024)):
+        if size >= factor and size % factor == 0:
+            return '%d%s' % (size/factor, unit)
+    return str(size)
+
+def format_rule(pattern, compress, level, blocksize):
+    rule = '%-12s compress=%s' % (pattern, compress)
+    if level:
+        rule += ' level=%d' % level
+    return rule + ' blocksize=%s' % format_size(blocksize)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage = 'usage: %prog [options] [<directory>...]')
+    parser.add_option( '-s', '--sample', default = '32mb',
+                       help = 'amount of data to sample [%default]' )
+    parser.add_option( '-l', '--limit', default = '8mb',
+                       help = 'maximum amount of data read per file [%default]' )
+    parser.add_option( '-c', '--compress', default = ','.join(LEVELS),
+                       help = 'compressors to test [%default]' )
+    parser.add_option( '-b', '--blocksizes', default = '64kb,256kb,1mb,4mb',
+                       help = 'block sizes to test [%default]' )
+    parser.add_option( '-w', '--bandwidth', default = '1mb',
+                       help = 'upload bandwidth per second [%default]' )
+    parser.add_option( '-m', '--min-share', type = 'float', default = 0.02,
+                       help = 'minimum share of the sample for a file type '
+                              'to get its own rule [%default]' )
+    parser.add_option( '--seed', type = 'int',
+                       help = 'random seed, to sample the same files again' )
+    options, roots = parser.parse_args()
+
+    try:
+        sample_size = parse_quantity(options.sample)
+        limit       = parse_quantity(options.limit)
+        bandwidth   = parse_quantity(options.bandwidth)
+        blocksizes  = map(parse_quantity, options.blocksizes.split(','))
+    except ValueError, e:
+        parser.error(str(e))
+    grid = []
+    for compress in options.compress.split(','):
+        if compress not in compressors:
+            parser.error('unknown compressor: "%s"' % compress)
+        for level in LEVELS.get(compress, [ 0 ]):
+            grid.append((compress, level))
+
+    if not roots:
+        init(False, False)
+        roots = configured_roots()
+    if not roots:
+        parser.error('no directories given, and no back-up roots configured')
+
+    seed(options.seed)
+    paths = sample_files(roots, sample_size, limit)
+    if not paths:
+        print >>stderr, 'No files found'
+        exit(1)
+    start   = time()
+    results = benchmark(paths, grid, blocksizes, limit)
+    overall = totals(results, lambda (c, l, b, t): (c, l, b))
+    sizes   = totals(results, lambda (c, l, b, t): t)
+    sample  = sum([ r.size for r in sizes.values() ])/len(overall)
+
+    print '# Sampled %d files (%d bytes) in %.1f s' % (
+        len(paths), sample, time() - start )
+    print '#'
+    print '# %-8s %5s %9s %10s %8s %8s %12s' % (
+        'compress', 'level', 'blocksize', 'MB/s', 'ratio', 'dedup', 'us/KB')
+    for params in sorted(overall):
+        compress, level, blocksize = params
+        r = overall[params]
+        print '# %-8s %5d %9s %10.1f %8.3f %8.3f %12.1f' % (
+            compress, level, format_size(blocksize),
+            r.unique/max(r.seconds, 1e-6)/1048576,
+            float(r.stored)/max(r.unique, 1),
+            1 - float(r.unique)/max(r.size, 1),
+            r.cost(bandwidth)*1024*1e6 )
+    print '#'
+    print '# Estimated cost per KB, uploading at %d bytes/s' % bandwidth
+    print
+
+    # Recommend the cheapest parameters overall, and for common file types
+    best = min(overall, key = lambda params: overall[params].cost(bandwidth))
+    print format_rule('*', *best)
+    for type in sorted(sizes, key = lambda type: -sizes[type].size):
+        if not type or sizes[type].size/len(overall) < options.min_share*sample:
+            continue
+        choices = [ params for params in results if params[3] == type ]
+        params  = min(choices, key = lambda params: results[params].cost(bandwidth))
+        if params[:3] <> best:
+            print format_rule('*.' + type, *params[:3])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''Checks the integrity of the blocks in the repository.
+
+Usage: verify [options]
+
+In full mode (the default), blocks are retrieved (bypassing the block cache),
+decompressed and hashed with the repository's hash function by a pool of
+threads, and the hashes are compared with the block ids.
+
+In fast mode, no data is retrieved at all: the sizes of the packs and unpacked
+blocks in a listing of the repository are compared with their sizes according
+to the cache, as are their MD5 digests where the storage reports them (S3 does,
+as ETags) and the cache recorded them when they were stored.
+
+Either mode can check a random sample of the blocks instead of all of them.
+Exits with status 1 if any problem was found.'''
+
+from optparse import OptionParser
+from random import sample
+from time import time
+from sys import exit
+from logging import debug, info, warning, error, critical, exception
+from init import init, setting
+from prefetch import Fetcher
+
+
+def describe(key):
+    if key[0] == 'p':
+        return 'Pack %s' % key[1:]
+    return 'Block %s' % key[1:].encode('hex')
+
+def choose(items, percentage):
+    '''Returns a random sample of a list, in the original order.'''
+    if percentage >= 100:
+        return items
+    count = int(round(len(items)*percentage/100.0))
+    return [ items[i] for i in sorted(sample(xrange(len(items)), count)) ]
+
+def verify_fast(cache, storage, percentage = 100):
+    '''Compares the sizes and digests of the stored objects with those
+       recorded in the cache. Returns the number of objects checked, the number
+       of digests compared, the number of bytes checked and the number of
+       problems found.'''
+    objects  = cache.listObjects()
+    expected = dict([ (key, objects[key])
+                      for key in choose(sorted(objects), percentage) ])
+    checked = digests = bytes = problems = 0
+    for key, size, digest in storage.listInfo():
+        if key not in expected:
+            continue
+        expected_size, expected_digest = expected.pop(key)
+        checked += 1
+        if size is not None and expected_size is not None and size <> expected_size:
+            error( '%s has size %d instead of %d',
+                   describe(key), size, expected_size )
+            problems += 1
+            continue
+        if digest and expected_digest:
+            digests += 1
+            if digest <> expected_digest:
+                error( '%s has digest %s instead of %s',
+                       describe(key), digest, expected_digest )
+                problems += 1
+                continue
+        bytes += size or 0
+    for key in expected:
+        error('%s is missing from the repository', describe(key))
+        problems += 1
+    return checked, digests, bytes, problems
+
+def verify_full(cache, storage, hash_function, percentage = 100,
+                workers = 8, window = 32):
+    '''Retrieves blocks and checks their hashes. Returns the number of blocks
+       checked, the number of bytes checked (after decompression), the number
+       of bytes retrieved and the number of problems found.'''
+    fetcher = Fetcher( storage, cache, hash_function, workers, window,
+                       bypass = True )
+    checked = stored = problems = 0
+    for block in fetcher.fetch(choose(cache.listBlocks(), percentage)):
+        checked += 1
+        stored  += block.stored
+        if block.errors:
+            problems += 1
+    return checked, fetcher.bytes, stored, problems
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage = 'usage: %prog [options]')
+    parser.add_option( '-f', '--fast', action = 'store_true', default = False,
+                       help = 'only compare sizes and digests reported by the '
+                              'storage, without retrieving data' )
+    parser.add_option( '-s', '--sample', type = 'float', default = 100,
+                       help = 'percentage of the blocks to check [%default]' )
+    parser.add_option( '-w', '--workers', type = 'int',
+                       help = 'number of concurrent requests '
+                              '[default: restore fetchers]' )
+    options, args = parser.parse_args()
+    if args:
+        parser.error('unexpected arguments')
+    if not 0 < options.sample <= 100:
+        parser.error('sample percentage must be between 0 and 100')
+
+    cache, storage = init()
+    if not cache or not storage:
+        print 'Sorry, cache or storage not available'
+        exit(1)
+
+    start = time()
+    if options.fast:
+        checked, digests, bytes, problems = verify_fast(
+            cache, storage, options.sample )
+        elapsed = max(time() - start, 1e-6)
+        print ( 'Checked %d objects (%d bytes; %d digests) in %.1f s '
+                '(%.1f MB/s); %d problems' % (
+                checked, bytes, digests, elapsed, bytes/elapsed/1048576,
+                problems ) )
+    else:
+        checked, bytes, stored, problems = verify_full(
+            cache, storage, storage.hash_function, options.sample,
+            options.workers or setting('restore', 'fetchers', 8),
+            setting('restore', 'window', 32) )
+        elapsed = max(time() - start, 1e-6)
+        print ( 'Verified %d blocks (%d bytes; %d stored) in %.1f s '
+                '(%.1f MB/s); %d problems' % (
+                checked, bytes, stored, elapsed, bytes/elapsed/1048576,
+                problems ) )
+    cache.close()
+    storage.close()
+    if problems:
+        exit(1)
@@ -0,0 +1,143 @@
+'''Concurrent directory walker.
+
+Walks one or more directory trees with a pool of worker threads per root, so
+that directory listings and stat() calls (which are slow on network file
+systems, and for large trees in general) are issued concurrently, and a slow
+root does not hold up the others.
+
+Regular files are produced as a stream of (path, stat) tuples while the walk
+is still in progress. The stat result is the one obtained during the walk, so
+callers do not need to stat the file again. Like os.walk(), symbolic links to
+directories are not followed.'''
+
+from os import listdir, lstat, stat
+from os.path import join
+from stat import S_ISDIR, S_ISREG, S_ISLNK, ST_MODE
+from threading import Thread, Lock
+from Queue import Queue
+from time import time
+from logging import debug, info, warning, error, critical, exception
+
+
+class Walker:
+    '''Iterating over a walker yields (path, stat) tuples for all regular files
+       in the given roots. `prune` is called with the path of every directory
+       found, and should return true if the directory should be skipped.'''
+
+    def __init__(self, roots, prune = None, workers = 4, depth = 1024):
+        self.roots     = roots
+        self.prune     = prune
+        self.workers   = max(workers, 1)
+        self.output    = Queue(max(depth, 1))
+        self.lock      = Lock()
+        self.files     = 0
+        self.dirs      = 0
+        self.stats     = 0
+        self.stat_time = 0.0
+        self.start     = None
+
+    def __iter__(self):
+        self.start = time()
+        for root in self.roots:
+            Pool(self, root)
+        remaining = len(self.roots)
+        while remaining:
+            item = self.output.get()
+            if item is None:
+                remaining -= 1
+            else:
+                yield item
+
+    def count(self, files, dirs, stats, stat_time):
+        self.lock.acquire()
+        try:
+            self.files     += files
+            self.dirs      += dirs
+            self.stats     += stats
+            self.stat_time += stat_time
+        finally:
+            self.lock.release()
+
+    def report(self):
+        '''Logs the throughput of the walk.'''
+        elapsed = max(time() - self.start, 1e-6)
+        info( 'Walked %d directories and %d files in %.1f s (%.0f files/s); '
+              '%d stat calls, %.3f ms average latency',
+              self.dirs, self.files, elapsed, self.files/elapsed,
+              self.stats, 1000*self.stat_time/max(self.stats, 1) )
+
+
+class Pool:
+    '''The worker threads walking a single root.'''
+
+    def __init__(self, walker, root):
+        self.walker      = walker
+        self.queue       = Queue()
+        self.lock        = Lock()
+        self.outstanding = 1    # directories queued or being listed
+        self.queue.put(root)
+        for i in xrange(walker.workers):
+            thread = Thread(target = self.work)
+            thread.setDaemon(True)
+            thread.start()
+
+    def work(self):
+        while True:
+            dirpath = self.queue.get()
+            if dirpath is None:
+                break
+            try:
+                subdirs = self.list(dirpath)
+            except Exception, e:
+                exception('Walking directory "%s" failed', dirpath)
+                subdirs = []
+            self.lock.acquire()
+            try:
+                self.outstanding += len(subdirs) - 1
+                done = self.outstanding == 0
+            finally:
+                self.lock.release()
+            for subdir in subdirs:
+                self.queue.put(subdir)
+            if done:
+                for i in xrange(self.walker.workers):
+                    self.queue.put(None)
+                self.walker.output.put(None)
+
+    def list(self, dirpath):
+        '''Lists a directory, produces its files, and returns the
+           subdirectories that should be walked.'''
+        walker = self.walker
+        try:
+            names = listdir(dirpath)
+        except OSError, e:
+            warning('%s: %s', e.filename, e.strerror)
+            return []
+
+        subdirs, files, stats, stat_time = [], 0, 0, 0.0
+        for name in names:
+            path = join(dirpath, name)
+            start = time()
+            try:
+                st = lstat(path)
+                stats += 1
+                if S_ISLNK(st[ST_MODE]):
+                    st = stat(path)
+                    stats += 1
+                    if S_ISDIR(st[ST_MODE]):
+                        continue
+            except OSError, e:
+                warning('%s: %s', e.filename, e.strerror)
+                continue
+            finally:
+                stat_time += time() - start
+
+            if S_ISDIR(st[ST_MODE]):
+                if not (walker.prune and walker.prune(path)):
+                    subdirs.append(path)
+            elif S_ISREG(st[ST_MODE]):
+                files += 1
+                walker.output.put((path, st))
+
+        walker.count(files, 1, stats, stat_time)
+        return subdirs